@@ -5,8 +5,11 @@ Script para indexar imágenes usando el nombre de la carpeta como categoría
 
 import requests
 import os
+import time
 from pathlib import Path
 
+from checkpoint import Checkpoint
+
 # Configuración
 API_URL = 'http://localhost:8000'
 BASE_PATH = "/home/kpalacio/Documentos/buentek/cordoba_de_antaño/www.xn--cordobadeantao-2nb.com.ar/images/igallery"
@@ -54,8 +57,8 @@ def inferir_metadata_basica(filename):
     
     return localidad, barrio, descripcion
 
-def indexar_carpeta(folder_name, categoria):
-    """Indexa todas las imágenes de una carpeta"""
+def indexar_carpeta(folder_name, categoria, checkpoint):
+    """Indexa todas las imágenes de una carpeta (salteando las que no cambiaron)"""
     folder_path = Path(BASE_PATH) / folder_name
     
     if not folder_path.exists():
@@ -80,13 +83,19 @@ def indexar_carpeta(folder_name, categoria):
     print("-" * 60)
     
     indexed = 0
+    skipped = 0
     errors = 0
     
     for img_path in images:
+        # Inferir metadata básica (si cambió, por ejemplo la categoría de la
+        # carpeta, la imagen no se saltea: /index actualiza la metadata)
+        localidad, barrio, descripcion = inferir_metadata_basica(img_path.name)
+        metadata = (barrio, localidad, categoria, descripcion)
+        if checkpoint.is_done(img_path, metadata):
+            skipped += 1
+            continue
+        
         try:
-            # Inferir metadata básica
-            localidad, barrio, descripcion = inferir_metadata_basica(img_path.name)
-            
             # Preparar datos
             with open(img_path, 'rb') as f:
                 files = {'file': (img_path.name, f, 'image/jpeg')}
@@ -100,7 +109,11 @@ def indexar_carpeta(folder_name, categoria):
                 
                 response = requests.post(f'{API_URL}/index', files=files, data=data)
                 response.raise_for_status()
-                indexed += 1
+                checkpoint.mark_done(img_path, metadata)
+                if response.json()['status'] == 'unchanged':
+                    skipped += 1
+                else:
+                    indexed += 1
                 
                 if indexed % 10 == 0:
                     print(f"   ✅ Indexadas: {indexed}/{len(images)}")
@@ -108,6 +121,7 @@ def indexar_carpeta(folder_name, categoria):
         except requests.exceptions.ConnectionError:
             print(f"\n❌ Error: No se puede conectar al backend en {API_URL}")
             print("   Asegurate de que el backend esté corriendo (python backend/app.py)")
+            checkpoint.save()
             return
         except Exception as e:
             print(f"   ❌ Error en {img_path.name}: {e}")
@@ -116,6 +130,7 @@ def indexar_carpeta(folder_name, categoria):
     print("-" * 60)
     print(f"✅ Carpeta '{folder_name}' completada:")
     print(f"   Éxitos: {indexed}")
+    print(f"   Sin cambios: {skipped}")
     print(f"   Errores: {errors}")
 
 def main():
@@ -127,15 +142,25 @@ def main():
     try:
         response = requests.get(f'{API_URL}/')
         print(f"✅ Backend conectado: {response.json()['message']}\n")
+        index_version = response.json()['index_version']
     except:
         print(f"❌ No se puede conectar al backend en {API_URL}")
         print("   Ejecutá primero: cd backend && python app.py")
         return
     
+    # Para indexar hace falta que el backend haya terminado de cargar el modelo
+    while requests.get(f'{API_URL}/health/ready').status_code != 200:
+        print("⏳ Esperando que el backend termine de cargar el modelo...")
+        time.sleep(5)
+    
+    # Archivos ya indexados (para retomar una corrida interrumpida)
+    checkpoint = Checkpoint('../indexado_checkpoint.json', index_version)
+    
     # Indexar cada carpeta
     total_indexed = 0
     for folder_name, categoria in FOLDERS_TO_INDEX.items():
-        indexar_carpeta(folder_name, categoria)
+        indexar_carpeta(folder_name, categoria, checkpoint)
+        checkpoint.save()
     
     print("\n" + "=" * 60)
     print("🎉 INDEXACIÓN COMPLETA")
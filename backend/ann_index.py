@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Índice aproximado (ANN) sobre los embeddings CLIP para el modo semántico.
+
+Hay dos implementaciones con la misma interfaz:
+- `IVFIndex`: listas invertidas sobre k-means, solo con numpy (default)
+- `HNSWIndex`: grafo HNSW usando `hnswlib` (opcional: pip install hnswlib)
+
+El índice se construye offline, se guarda al lado de cordoba.db y el
+backend lo actualiza incrementalmente con cada /index.
+
+Uso:
+    cd backend
+    python ann_index.py build                 # construir IVF
+    python ann_index.py build --tipo hnsw     # construir HNSW
+    python ann_index.py recall --k 10         # comparar exacto vs aproximado
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from vector_store import EmbeddingStore, normalize, top_k
+
+# Base de los archivos del índice (la extensión depende del tipo)
+ANN_PATH = "../cordoba.ann"
+
+
+class IVFIndex:
+    kind = "ivf"
+    extension = ".ivf.npz"
+
+    def __init__(self, dim: int = 512, nlist: int = None, nprobe: int = 32):
+        """
+        Índice IVF (inverted file) de producto interno.
+
+        Args:
+            dim: Dimensión de los embeddings
+            nlist: Cantidad de listas (centroides). Si es None se usa ~4*sqrt(N)
+            nprobe: Cuántas listas se recorren por búsqueda (más = mejor recall)
+        """
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self._list_vectors = []  # por lista: matriz (n_i, dim)
+        self._list_ids = []      # por lista: ids de la DB (n_i,)
+        self._where = {}         # id de la DB -> lista en la que está
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._list_ids)
+
+    @property
+    def ids(self) -> np.ndarray:
+        if not self._list_ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(self._list_ids)
+
+    def _assign(self, vectors: np.ndarray, block: int = 65536) -> np.ndarray:
+        """Centroide más cercano de cada vector (por bloques para acotar memoria)."""
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block):
+            assign[start:start + block] = np.argmax(vectors[start:start + block] @ self.centroids.T, axis=1)
+        return assign
+
+    def build(self, vectors: np.ndarray, ids: np.ndarray, iteraciones: int = 10, seed: int = 0):
+        """Entrena los centroides con k-means esférico y reparte los vectores."""
+        vectors = normalize(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        rng = np.random.default_rng(seed)
+
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+
+        # Entrenar sobre una muestra (alcanza con ~256 puntos por lista)
+        muestra = vectors
+        if len(vectors) > nlist * 256:
+            muestra = vectors[rng.choice(len(vectors), nlist * 256, replace=False)]
+
+        self.centroids = muestra[rng.choice(len(muestra), nlist, replace=False)].copy()
+        for _ in range(iteraciones):
+            assign = self._assign(muestra)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, muestra)
+            counts = np.bincount(assign, minlength=nlist)
+            # Listas vacías: reiniciar con un punto al azar
+            vacias = counts == 0
+            sums[vacias] = muestra[rng.choice(len(muestra), int(vacias.sum()))]
+            self.centroids = normalize(sums)
+
+        assign = self._assign(vectors)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+
+        with self._lock:
+            self.nlist = nlist
+            self._list_vectors = [vectors[order[bounds[i]:bounds[i + 1]]] for i in range(nlist)]
+            self._list_ids = [ids[order[bounds[i]:bounds[i + 1]]] for i in range(nlist)]
+            self._where = dict(zip(ids.tolist(), assign.tolist()))
+
+    def add(self, vectors: np.ndarray, ids):
+        """
+        Agrega vectores a la lista de su centroide más cercano.
+
+        Si un id ya estaba en el índice, se reemplaza su vector.
+        """
+        vectors = normalize(np.atleast_2d(vectors))
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        assign = self._assign(vectors)
+
+        with self._lock:
+            # Sacar primero los ids que ya estaban (actualizaciones)
+            viejos = {}
+            for row_id in ids.tolist():
+                if row_id in self._where:
+                    viejos.setdefault(self._where[row_id], []).append(row_id)
+            for lista, row_ids in viejos.items():
+                keep = ~np.isin(self._list_ids[lista], row_ids)
+                self._list_vectors[lista] = self._list_vectors[lista][keep]
+                self._list_ids[lista] = self._list_ids[lista][keep]
+
+            self._where.update(zip(ids.tolist(), assign.tolist()))
+            for lista in np.unique(assign):
+                sel = assign == lista
+                # Se reemplazan los arrays para no pisar búsquedas en curso
+                self._list_vectors[lista] = np.concatenate([self._list_vectors[lista], vectors[sel]])
+                self._list_ids[lista] = np.concatenate([self._list_ids[lista], ids[sel]])
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = None):
+        """Devuelve (ids, scores) de los k vecinos aproximados de la query."""
+        query = normalize(query)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        if nprobe == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        listas = top_k(self.centroids @ query, nprobe)
+        # Vectores e ids de cada lista juntos: `add` (desde otro thread) los reemplaza de a pares
+        with self._lock:
+            vectors = [self._list_vectors[i] for i in listas]
+            ids = [self._list_ids[i] for i in listas]
+        ids = np.concatenate(ids)
+        scores = np.concatenate([v @ query for v in vectors])
+
+        top = top_k(scores, k)
+        return ids[top], scores[top]
+
+    def save(self, base_path: str):
+        """Guarda el índice en `<base_path>.ivf.npz` (escritura atómica)."""
+        with self._lock:
+            sizes = np.array([len(ids) for ids in self._list_ids], dtype=np.int64)
+            vectors = np.concatenate(self._list_vectors) if self._list_vectors else np.zeros((0, self.dim), np.float32)
+            ids = self.ids
+        tmp = f"{base_path}.{os.getpid()}.tmp.npz"  # varios workers pueden guardar a la vez
+        np.savez(tmp, centroids=self.centroids, sizes=sizes, vectors=vectors, ids=ids,
+                 nprobe=np.array(self.nprobe))
+        os.replace(tmp, base_path + self.extension)
+
+    @classmethod
+    def load(cls, base_path: str):
+        data = np.load(base_path + cls.extension)
+        index = cls(dim=data["centroids"].shape[1], nprobe=int(data["nprobe"]))
+        index.centroids = data["centroids"]
+        index.nlist = len(index.centroids)
+        bounds = np.concatenate([[0], np.cumsum(data["sizes"])])
+        vectors, ids = data["vectors"], data["ids"]
+        index._list_vectors = [vectors[bounds[i]:bounds[i + 1]] for i in range(index.nlist)]
+        index._list_ids = [ids[bounds[i]:bounds[i + 1]] for i in range(index.nlist)]
+        index._where = {row_id: i for i, lista in enumerate(index._list_ids) for row_id in lista.tolist()}
+        return index
+
+
+class HNSWIndex:
+    kind = "hnsw"
+    extension = ".hnsw.bin"
+
+    def __init__(self, dim: int = 512, M: int = 16, ef_construction: int = 200, ef: int = 64):
+        """
+        Índice HNSW sobre producto interno (requiere `hnswlib`).
+
+        Args:
+            dim: Dimensión de los embeddings
+            M: Vecinos por nodo del grafo
+            ef_construction: Calidad de construcción
+            ef: Tamaño de la lista de candidatos al buscar (más = mejor recall)
+        """
+        import hnswlib
+
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self._lock = threading.Lock()
+        self._index = hnswlib.Index(space="ip", dim=dim)
+        self._index.init_index(max_elements=1024, M=M, ef_construction=ef_construction)
+        self._index.set_ef(ef)
+
+    def __len__(self):
+        return self._index.get_current_count()
+
+    @property
+    def ids(self) -> np.ndarray:
+        return np.array(self._index.get_ids_list(), dtype=np.int64)
+
+    def _reserve(self, extra: int):
+        needed = len(self) + extra
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+
+    def build(self, vectors: np.ndarray, ids: np.ndarray):
+        self.add(vectors, ids)
+
+    def add(self, vectors: np.ndarray, ids):
+        """Agrega vectores (hnswlib actualiza el vector si el id ya estaba)."""
+        vectors = normalize(np.atleast_2d(vectors))
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        with self._lock:
+            self._reserve(len(ids))
+            self._index.add_items(vectors, ids)
+
+    def search(self, query: np.ndarray, k: int, ef: int = None):
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if ef:
+            self._index.set_ef(max(ef, k))
+        elif self.ef < k:
+            self._index.set_ef(k)
+        labels, distances = self._index.knn_query(normalize(query), k=k)
+        # hnswlib devuelve distancia = 1 - producto interno
+        return labels[0].astype(np.int64), (1.0 - distances[0]).astype(np.float32)
+
+    def save(self, base_path: str):
+        with self._lock:
+            tmp = f"{base_path}.{os.getpid()}.tmp.bin"
+            self._index.save_index(tmp)
+            os.replace(tmp, base_path + self.extension)
+        with open(base_path + ".hnsw.json", "w") as f:
+            json.dump({"dim": self.dim, "M": self.M, "ef_construction": self.ef_construction, "ef": self.ef}, f)
+
+    @classmethod
+    def load(cls, base_path: str):
+        import hnswlib
+
+        with open(base_path + ".hnsw.json") as f:
+            params = json.load(f)
+        index = cls(**params)
+        index._index = hnswlib.Index(space="ip", dim=params["dim"])
+        index._index.load_index(base_path + cls.extension, allow_replace_deleted=False)
+        index._index.set_ef(params["ef"])
+        return index
+
+
+INDEX_TYPES = {"ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def create_index(tipo: str = "ivf", dim: int = 512):
+    return INDEX_TYPES[tipo](dim=dim)
+
+
+def load_index(base_path: str = ANN_PATH):
+    """Carga el índice guardado en `base_path` (el tipo que exista), o None."""
+    for cls in INDEX_TYPES.values():
+        if os.path.exists(base_path + cls.extension):
+            try:
+                return cls.load(base_path)
+            except ImportError:
+                print(f"⚠️  Hay un índice {cls.kind} pero falta su dependencia, se ignora")
+    return None
+
+
+def recall_report(store: EmbeddingStore, index, k: int = 10, n_queries: int = 200, seed: int = 0) -> dict:
+    """
+    Compara el scoring exacto contra el aproximado.
+
+    Usa como queries una muestra de los embeddings guardados y reporta el
+    recall@k promedio y la latencia de cada método.
+    """
+    rng = np.random.default_rng(seed)
+    n_queries = min(n_queries, len(store))
+    queries = store.matrix[rng.choice(len(store), n_queries, replace=False)]
+
+    recalls, t_exact, t_approx = [], [], []
+    for query in queries:
+        t0 = time.perf_counter()
+        exact_ids = store.ids[top_k(store.matrix @ query, k)]
+        t1 = time.perf_counter()
+        approx_ids, _ = index.search(query, k)
+        t2 = time.perf_counter()
+
+        recalls.append(len(np.intersect1d(exact_ids, approx_ids)) / max(len(exact_ids), 1))
+        t_exact.append(t1 - t0)
+        t_approx.append(t2 - t1)
+
+    return {
+        "tipo": index.kind,
+        "imagenes": len(store),
+        "queries": n_queries,
+        "k": k,
+        f"recall@{k}": float(np.mean(recalls)),
+        "exacto_ms_p50": float(np.median(t_exact) * 1000),
+        "aproximado_ms_p50": float(np.median(t_approx) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice ANN para búsqueda semántica")
+    parser.add_argument("accion", choices=["build", "recall"])
+    parser.add_argument("--db", default="../cordoba.db", help="Ruta a la base SQLite")
+    parser.add_argument("--salida", default=ANN_PATH, help="Base de los archivos del índice")
+    parser.add_argument("--tipo", default="ivf", choices=sorted(INDEX_TYPES))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    print("🔄 Cargando embeddings...")
+    store = EmbeddingStore()
+    conn = sqlite3.connect(args.db)
+    store.load_from_db(conn)
+    conn.close()
+    print(f"✅ {len(store)} embeddings")
+
+    if args.accion == "build":
+        t0 = time.perf_counter()
+        index = create_index(args.tipo, store.dim)
+        index.build(store.matrix, store.ids)
+        index.save(args.salida)
+        print(f"🎉 Índice {args.tipo} construido en {time.perf_counter() - t0:.1f}s → {args.salida}{index.extension}")
+    else:
+        index = load_index(args.salida)
+        if index is None:
+            print(f"❌ No hay índice en {args.salida}. Ejecutá primero: python ann_index.py build")
+            return
+        print(json.dumps(recall_report(store, index, args.k, args.queries), indent=2))
+
+
+if __name__ == "__main__":
+    main()
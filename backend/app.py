@@ -1,37 +1,193 @@
-from fastapi import FastAPI, UploadFile, File, Form, Query
+from fastapi import FastAPI, UploadFile, File, Form, Query, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import JSONResponse, PlainTextResponse
 from PIL import Image
 import sqlite3
 import numpy as np
 import io
 import json
 import os
+import hashlib
+import re
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Literal
+
+from vector_store import FACETS, EmbeddingStore, encode_embedding, decode_embedding
+from ann_index import ANN_PATH, load_index
+from query_cache import QueryEmbeddingCache, normalize_query
+from ranking_cache import Ranking, RankingCache
+from inference import InferenceScheduler
+from inference_service import InferenceClient, InferenceUnavailable
+from clip_backends import INFERENCE_BACKENDS, load_clip
+from db import DB_PATH, ConnectionPool, ReaderUnavailable
+from duplicates import clusters_generation, init_clusters, load_clusters
+from neighbors import NEIGHBORS_K, NeighborLists, init_neighbors
+from metrics import REGISTRY, instrument, span, timed
+from snapshot import EMBEDDING_SNAPSHOT, SNAPSHOT_COMPACT_ROWS, SNAPSHOT_POLL_SECONDS, EmbeddingSnapshot
+from thumbnails import THUMB_DIR, thumb_urls, has_thumbnails, make_thumbnails
+
+# Formato de los embeddings en la DB: "float32" (default) o "float16"
+EMBEDDING_DTYPE = os.environ.get("EMBEDDING_DTYPE", "float32")
+
+MODEL_NAME = 'clip-ViT-B-32'
+
+# Cache de embeddings de queries (TTL en segundos, 0 = sin vencimiento;
+# QUERY_CACHE_PATH vacío = no persistir a disco)
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "0"))
+QUERY_CACHE_PATH = os.environ.get("QUERY_CACHE_PATH", "")
+
+# Tamaño de batch para CLIP al indexar varias imágenes juntas
+ENCODE_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", "32"))
+
+# Micro-batching de inferencia: cuánto esperar a que lleguen más pedidos
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "5"))
+
+# Backend de CLIP en CPU: "torch" (float32) o "int8" (cuantizado, varias veces
+# más rápido; medir la pérdida con `python clip_backends.py check`)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+if INFERENCE_BACKEND not in INFERENCE_BACKENDS:
+    raise ValueError(f"INFERENCE_BACKEND desconocido: {INFERENCE_BACKEND} (opciones: {', '.join(INFERENCE_BACKENDS)})")
+# Threads de torch para la inferencia (0 = default de torch)
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "0"))
+
+# Versión de los embeddings que se guardan en `imagenes.model_version`: modelo y
+# backend, para no mezclar vectores int8 con los de float32 sin darse cuenta
+# (al cambiar de backend las imágenes se vuelven a calcular)
+MODEL_VERSION = f"{MODEL_NAME}:{INFERENCE_BACKEND}"
+
+# Servicio de inferencia compartido (inference_service.py): con un socket, este
+# proceso no carga CLIP y le pide los embeddings al servicio. Cuánto esperar
+# cada respuesta (segundos) y cuántos pedidos puede tener en vuelo cada worker
+INFERENCE_SOCKET = os.environ.get("INFERENCE_SOCKET", "")
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "30"))
+INFERENCE_MAX_INFLIGHT = int(os.environ.get("INFERENCE_MAX_INFLIGHT", "16"))
+
+# Con scoring=auto se usa el índice aproximado a partir de esta cantidad de imágenes
+ANN_MIN_SIZE = int(os.environ.get("ANN_MIN_SIZE", "50000"))
+# Cada cuántas imágenes nuevas se guarda el índice aproximado a disco
+ANN_SAVE_EVERY = int(os.environ.get("ANN_SAVE_EVERY", "500"))
+
+# Vecinos precalculados para /similar: cuánto esperar después de indexar para
+# recalcularlos de una vez (la cantidad por imagen es NEIGHBORS_K, 0 = no precalcular)
+NEIGHBORS_REFRESH_DELAY = float(os.environ.get("NEIGHBORS_REFRESH_DELAY", "5"))
+
+# Cada cuánto (segundos) se revisa si `duplicates.py` guardó grupos nuevos,
+# para aplicarlos sin reiniciar (0 = solo al arrancar)
+CLUSTERS_POLL_SECONDS = float(os.environ.get("CLUSTERS_POLL_SECONDS", "10"))
+
+# Al terminar de cargar el modelo, codificar un texto y una imagen de prueba para
+# que la primera búsqueda no pague la inicialización (1 = sí, 0 = no)
+WARMUP_ENCODE = os.environ.get("WARMUP_ENCODE", "1") == "1"
+
+# Paginación: cuántos resultados ordenados se calculan de una vez para las
+# páginas siguientes, y cuántos rankings se guardan (TTL en segundos)
+RANKING_DEPTH = int(os.environ.get("RANKING_DEPTH", "1000"))
+RANKING_CACHE_SIZE = int(os.environ.get("RANKING_CACHE_SIZE", "256"))
+RANKING_CACHE_TTL = float(os.environ.get("RANKING_CACHE_TTL", "300"))
+# Máximo de resultados por página en /search y /similar
+MAX_LIMIT = 500
+
+# Tiempo (segundos) de cada fase del arranque: se ve en GET /health/ready
+startup_times = {}
+
+@contextmanager
+def startup_phase(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_times[name] = round(time.perf_counter() - t0, 3)
+        print(f"⏱️  {name}: {startup_times[name]:.2f}s")
 
 app = FastAPI()
 
+# Tiempos por etapa, métricas de cada request y Server-Timing (ver metrics.py)
+app.middleware("http")(instrument)
+
+@app.exception_handler(ReaderUnavailable)
+async def reader_unavailable(request: Request, exc: ReaderUnavailable):
+    """Pool de lectura de SQLite agotado: que el cliente reintente en vez de trabar el event loop"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+@app.exception_handler(InferenceUnavailable)
+async def inference_unavailable(request: Request, exc: InferenceUnavailable):
+    """Servicio de inferencia saturado o caído: que el cliente reintente"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "2"})
+
 # CORS para desarrollo local
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Offset", "X-Search-Mode", "Server-Timing"],
 )
 
 # Crear carpeta para imágenes
 os.makedirs("../images", exist_ok=True)
 app.mount("/images", StaticFiles(directory="../images"), name="images")
 
-# Cargar modelo CLIP (se descarga una vez y queda en cache)
-print("🔄 Cargando modelo CLIP (puede tardar la primera vez)...")
-model = SentenceTransformer('clip-ViT-B-32')
-print("✅ Modelo listo!")
+class ThumbnailFiles(StaticFiles):
+    """Miniaturas: el nombre sale del hash del contenido, así que nunca cambian"""
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# Miniaturas generadas al indexar (ETag y 304 los resuelve StaticFiles)
+os.makedirs(THUMB_DIR, exist_ok=True)
+app.mount("/thumbs", ThumbnailFiles(directory=THUMB_DIR), name="thumbs")
+
+# El modelo CLIP y los embeddings se cargan en segundo plano una vez que el
+# servidor ya escucha (ver start_background_loading): mientras tanto se
+# atienden las búsquedas de texto y /health/ready responde 503
+model = None
+model_ready = threading.Event()
+vectors_ready = threading.Event()
+startup_errors = {}  # fase -> error, si alguna carga falló
+_model_lock = threading.Lock()
+
+# Toda la inferencia pasa por acá: corre en un thread aparte y no bloquea el event loop
+# (los pedidos que lleguen antes de que esté el modelo esperan en su cola).
+# Con INFERENCE_SOCKET, el mismo uso pero contra el servicio compartido
+if INFERENCE_SOCKET:
+    scheduler = InferenceClient(INFERENCE_SOCKET, timeout=INFERENCE_TIMEOUT, max_inflight=INFERENCE_MAX_INFLIGHT)
+else:
+    scheduler = InferenceScheduler(max_batch=ENCODE_BATCH_SIZE, max_wait_ms=INFERENCE_MAX_WAIT_MS)
+
+query_cache = QueryEmbeddingCache(
+    MODEL_VERSION,
+    maxsize=QUERY_CACHE_SIZE,
+    ttl=QUERY_CACHE_TTL or None,
+    path=QUERY_CACHE_PATH or None,
+)
+
+rankings = RankingCache(maxsize=RANKING_CACHE_SIZE, ttl=RANKING_CACHE_TTL or None)
+
+async def encode_query(query):
+    """Embedding de texto de la query (cacheado)"""
+    embedding = query_cache.get(query)
+    if embedding is None:
+        with span("encode"):
+            embedding = await scheduler.encode_text(query)
+        query_cache.put(query, embedding)
+    return embedding
+
+# Conexiones a SQLite (WAL, un pool de lectores y un único escritor)
+_t_sqlite = time.perf_counter()
+db = ConnectionPool(DB_PATH)
 
 # Inicializar SQLite
 def init_db():
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
+    with db.writer() as conn:
+        return _init_db(conn.cursor())
+
+def _init_db(c):
     c.execute('''
         CREATE TABLE IF NOT EXISTS imagenes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,22 +197,716 @@ def init_db():
             localidad TEXT,
             categoria TEXT,
             descripcion TEXT,
-            embedding TEXT
+            embedding BLOB,
+            content_hash TEXT,
+            model_version TEXT
         )
     ''')
+    # Bases creadas antes de que existieran estas columnas
+    columnas = {r[1] for r in c.execute("PRAGMA table_info(imagenes)")}
+    for columna in ("content_hash", "model_version"):
+        if columna not in columnas:
+            c.execute(f"ALTER TABLE imagenes ADD COLUMN {columna} TEXT")
     c.execute('CREATE INDEX IF NOT EXISTS idx_original_path ON imagenes(original_path)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_content_hash ON imagenes(content_hash)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_barrio ON imagenes(barrio)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_localidad ON imagenes(localidad)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_categoria ON imagenes(categoria)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_descripcion ON imagenes(descripcion)')
-    conn.commit()
-    conn.close()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_filename ON imagenes(filename)')
+    init_clusters(c)
+    init_neighbors(c)
+    # Identificador de esta base: si se borra cordoba.db, los checkpoints
+    # de indexación viejos dejan de valer
+    c.execute('CREATE TABLE IF NOT EXISTS config (clave TEXT PRIMARY KEY, valor TEXT)')
+    c.execute("INSERT OR IGNORE INTO config (clave, valor) VALUES ('db_id', lower(hex(randomblob(8))))")
+    c.execute("SELECT valor FROM config WHERE clave = 'db_id'")
+    return c.fetchone()[0]
+
+DB_ID = init_db()
+
+# Índice full-text (FTS5) sobre descripción/barrio/localidad/categoría, sin
+# distinguir acentos ("cordoba" encuentra "Córdoba"). Los triggers lo
+# mantienen sincronizado con cada INSERT/UPDATE/DELETE de `imagenes`.
+FTS_COLUMNS = ("descripcion", "barrio", "localidad", "categoria")
+
+def init_fts():
+    with db.writer() as conn:
+        return _init_fts(conn.cursor())
+
+def _init_fts(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'imagenes_fts'")
+    existia = c.fetchone() is not None
+    try:
+        c.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS imagenes_fts USING fts5(
+                {", ".join(FTS_COLUMNS)},
+                content='imagenes', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  SQLite sin FTS5 ({e}): la búsqueda de texto usa LIKE")
+        return False
+    
+    cols = ", ".join(FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{col}" for col in FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{col}" for col in FTS_COLUMNS)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_fts_ai AFTER INSERT ON imagenes BEGIN
+            INSERT INTO imagenes_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_fts_ad AFTER DELETE ON imagenes BEGIN
+            INSERT INTO imagenes_fts(imagenes_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_fts_au AFTER UPDATE OF {cols} ON imagenes BEGIN
+            INSERT INTO imagenes_fts(imagenes_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            INSERT INTO imagenes_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+    if not existia:
+        # Base ya existente: indexar todo lo que había
+        print("🔄 Construyendo índice full-text...")
+        c.execute("INSERT INTO imagenes_fts(imagenes_fts) VALUES ('rebuild')")
+    return True
+
+FTS_ENABLED = init_fts()
+
+# Conteos por faceta materializados (para /filters y /analytics sin recorrer
+# la tabla). Los triggers los mantienen con cada INSERT/UPDATE/DELETE y suben
+# la "generación" de escritura, que invalida las respuestas cacheadas.
+# Además de las facetas: ('imagenes', '') = total, ('revisar', '') = descripciones '[REVISAR]'.
+def init_facet_counts():
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            _init_facet_counts(c)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+def _init_facet_counts(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'facet_counts'")
+    existia = c.fetchone() is not None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            faceta TEXT,
+            valor TEXT,
+            total INTEGER,
+            PRIMARY KEY (faceta, valor)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("INSERT OR IGNORE INTO config (clave, valor) VALUES ('generacion', '0')")
+    
+    def counts(row, sign):
+        values = [f"('{facet}', COALESCE({row}.{facet}, ''), {sign})" for facet in FACETS]
+        values.append(f"('imagenes', '', {sign})")
+        values.append(f"('revisar', '', CASE WHEN {row}.descripcion = '[REVISAR]' THEN {sign} ELSE 0 END)")
+        return f"""
+            INSERT INTO facet_counts (faceta, valor, total) VALUES {", ".join(values)}
+            ON CONFLICT (faceta, valor) DO UPDATE SET total = total + excluded.total;
+        """
+    
+    bump = "UPDATE config SET valor = CAST(valor AS INTEGER) + 1 WHERE clave = 'generacion';"
+    prune = "DELETE FROM facet_counts WHERE total <= 0;"
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_facets_ai AFTER INSERT ON imagenes BEGIN
+            {counts("new", 1)} {bump}
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_facets_ad AFTER DELETE ON imagenes BEGIN
+            {counts("old", -1)} {prune} {bump}
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS imagenes_facets_au AFTER UPDATE OF {", ".join(FACETS)}, descripcion ON imagenes BEGIN
+            {counts("old", -1)} {counts("new", 1)} {prune} {bump}
+        END
+    """)
+    if not existia:
+        # Base ya existente: contar lo que había
+        for facet in FACETS:
+            c.execute(f"""
+                INSERT INTO facet_counts (faceta, valor, total)
+                SELECT '{facet}', COALESCE({facet}, ''), COUNT(*) FROM imagenes GROUP BY COALESCE({facet}, '')
+            """)
+        c.execute("INSERT INTO facet_counts (faceta, valor, total) SELECT 'imagenes', '', COUNT(*) FROM imagenes")
+        c.execute("INSERT INTO facet_counts (faceta, valor, total) SELECT 'revisar', '', COUNT(*) FROM imagenes WHERE descripcion = '[REVISAR]'")
+        c.execute(prune)
+
+init_facet_counts()
+startup_times["sqlite"] = round(time.perf_counter() - _t_sqlite, 3)
+
+_config = db.config()
+print(f"✅ SQLite {_config['sqlite']}: journal={_config['journal_mode']}, "
+      f"mmap={_config['mmap_size'] // 2**20} MiB, cache={_config['cache_size_kb'] // 1024} MiB, "
+      f"{_config['lectores']} lectores")
+if _config["journal_mode"] != "wal":
+    print("⚠️  La base no está en modo WAL: las escrituras van a bloquear las búsquedas")
+
+# Versión de indexación: un checkpoint solo vale para esta base y este modelo (y backend)
+INDEX_VERSION = f"{MODEL_VERSION}@{DB_ID}"
+
+# Embeddings en memoria e índice aproximado: se llenan en load_vectors
+store = EmbeddingStore()
+# Con el snapshot, la matriz es un archivo mapeado que comparten todos los workers
+snapshot = EmbeddingSnapshot() if EMBEDDING_SNAPSHOT else None
+ann = None
+ann_pending = 0
+_ann_lock = threading.Lock()  # ann_pending y el guardado (se agrega desde varios threads)
+neighbor_lists = NeighborLists(NEIGHBORS_K)
+neighbors_pending = set()  # ids indexados cuyas listas de vecinos hay que recalcular
+neighbors_event = threading.Event()
+_neighbors_lock = threading.Lock()
+loaded_clusters = 0  # generación de grupos de duplicados.py que tiene `store`
+
+def load_model():
+    """Carga CLIP (se descarga una vez y queda en cache) y hace el encode de calentamiento"""
+    global model
+    with _model_lock:
+        if model_ready.is_set():
+            return
+        if INFERENCE_SOCKET:
+            connect_inference_service()
+            return
+        print(f"🔄 Cargando modelo CLIP ({INFERENCE_BACKEND}, puede tardar la primera vez)...")
+        with startup_phase("modelo"):
+            model = load_clip(MODEL_NAME, INFERENCE_BACKEND, INFERENCE_THREADS)
+            scheduler.set_model(model)
+        if WARMUP_ENCODE:
+            with startup_phase("warmup"):
+                scheduler.encode("text", ["córdoba"])
+                scheduler.encode("image", [Image.new("RGB", (224, 224))])
+        model_ready.set()
+        print("✅ Modelo listo!")
+
+def connect_inference_service():
+    """Espera a que responda el servicio de inferencia (puede estar cargando el modelo)"""
+    print(f"🔄 Conectando al servicio de inferencia en {INFERENCE_SOCKET}...")
+    with startup_phase("modelo"):
+        while True:
+            try:
+                info = scheduler.ping()
+                break
+            except InferenceUnavailable:
+                time.sleep(1)
+    # Modelo y backend: los vectores se guardan con MODEL_VERSION, tienen que ser de ese backend
+    service_version = f"{info.get('model')}:{info.get('backend')}"
+    if service_version != MODEL_VERSION:
+        raise RuntimeError(f"El servicio de inferencia usa {service_version}, no {MODEL_VERSION} "
+                           f"(INFERENCE_BACKEND tiene que ser el mismo en el servicio y en el backend)")
+    model_ready.set()
+    print(f"✅ Servicio de inferencia listo ({service_version})")
+
+def load_vectors():
+    """Carga todos los embeddings a memoria (una sola vez) y el índice aproximado"""
+    global ann
+    global loaded_clusters
+    print("🔄 Cargando embeddings a memoria...")
+    with startup_phase("embeddings"):
+        with db.reader() as conn:
+            # Antes de cargar: si el job guarda mientras tanto, clusters_loop lo vuelve a aplicar
+            loaded_clusters = clusters_generation(conn.cursor())
+            if snapshot is not None:
+                snapshot.load(store, conn)
+            else:
+                store.load_from_db(conn)
+    origen = f" (snapshot, generación {snapshot.generation})" if snapshot is not None else ""
+    print(f"✅ {len(store)} embeddings en memoria{origen}")
+    
+    # Índice aproximado (opcional: se construye con `python ann_index.py build`)
+    with startup_phase("indice_aproximado"):
+        index = load_index(ANN_PATH)
+        if index is not None:
+            # Agregar lo que se indexó mientras el índice no estaba actualizado
+            faltantes = np.setdiff1d(store.ids, index.ids)
+            if len(faltantes) > 0:
+                index.add(store.rows(store.positions(faltantes)), faltantes)
+                index.save(ANN_PATH)
+            print(f"✅ Índice aproximado ({index.kind}) con {len(index)} imágenes")
+    ann = index
+    
+    with db.reader() as conn:
+        neighbor_lists.load(conn)
+    print(f"✅ Vecinos precalculados de {len(neighbor_lists)} imágenes")
+    vectors_ready.set()
+    
+    # Lo indexado sin lista (ej. con bulk_index.py) se calcula en segundo plano
+    missing = neighbor_lists.missing(store) if NEIGHBORS_K > 0 else []
+    if missing:
+        with _neighbors_lock:
+            neighbors_pending.update(missing)
+        neighbors_event.set()
+
+def _load_in_background(name, load):
+    try:
+        load()
+    except Exception as e:
+        startup_errors[name] = f"{type(e).__name__}: {e}"
+        print(f"❌ Error cargando {name}: {e}")
+
+def refresh_neighbors_loop():
+    """Recalcula los vecinos de lo que se va indexando, en lotes y fuera del event loop"""
+    while True:
+        neighbors_event.wait()
+        # Juntar lo que se siga indexando mientras tanto
+        time.sleep(NEIGHBORS_REFRESH_DELAY)
+        neighbors_event.clear()
+        with _neighbors_lock:
+            row_ids = list(neighbors_pending)
+            neighbors_pending.clear()
+        try:
+            neighbor_lists.refresh(db.writer, store, row_ids)
+        except Exception as e:
+            print(f"❌ Error recalculando vecinos: {e}")
+
+def clusters_loop():
+    """Aplica los grupos que guarde `duplicates.py` con el backend andando"""
+    global loaded_clusters
+    while True:
+        time.sleep(CLUSTERS_POLL_SECONDS)
+        if not vectors_ready.is_set():
+            continue
+        try:
+            with db.reader() as conn:
+                c = conn.cursor()
+                generation = clusters_generation(c)
+                if generation == loaded_clusters:
+                    continue
+                clusters = load_clusters(c)
+            store.set_clusters(clusters)
+            loaded_clusters = generation
+            print(f"✅ Grupos de duplicados recargados: {store.hidden} copias ocultas")
+        except Exception as e:
+            print(f"❌ Error recargando los grupos de duplicados: {e}")
+
+def snapshot_loop():
+    """Trae lo que otros workers agregaron al snapshot y lo compacta cuando el delta crece"""
+    while True:
+        time.sleep(SNAPSHOT_POLL_SECONDS)
+        if not vectors_ready.is_set():
+            continue
+        try:
+            sync_snapshot()
+            if snapshot.delta_rows() >= SNAPSHOT_COMPACT_ROWS:
+                snapshot.compact()
+        except Exception as e:
+            print(f"❌ Error sincronizando el snapshot: {e}")
+
+@app.on_event("startup")
+def start_background_loading():
+    """Arranca la carga del modelo y de los embeddings (en paralelo) sin demorar el inicio"""
+    for name, load in (("modelo", load_model), ("embeddings", load_vectors)):
+        threading.Thread(target=_load_in_background, args=(name, load), name=f"carga-{name}", daemon=True).start()
+    if NEIGHBORS_K > 0:
+        threading.Thread(target=refresh_neighbors_loop, name="vecinos", daemon=True).start()
+    if snapshot is not None:
+        threading.Thread(target=snapshot_loop, name="snapshot", daemon=True).start()
+    if CLUSTERS_POLL_SECONDS > 0:
+        threading.Thread(target=clusters_loop, name="duplicados", daemon=True).start()
+
+def is_ready():
+    """True cuando ya se pueden hacer búsquedas visuales e indexar"""
+    return model_ready.is_set() and vectors_ready.is_set()
+
+def require_ready():
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="El backend todavía está cargando el modelo y los embeddings",
+                            headers={"Retry-After": "5"})
+
+def row_to_result(row, similarity):
+    """Convierte una fila (id, filename, ..., descripcion, content_hash) al JSON de resultado"""
+    return {
+        "filename": row[1],
+        "original_path": row[2],
+        "barrio": row[3],
+        "localidad": row[4],
+        "categoria": row[5],
+        "descripcion": row[6],
+        "thumbnails": thumb_urls(row[7]),
+        "similarity": float(similarity)
+    }
+
+def fts_query(query):
+    """
+    Convierte el texto del usuario en una query FTS5: cada palabra como
+    prefijo ("tranv" encuentra "tranvía") y todas obligatorias.
+    """
+    words = re.findall(r"\w+", query.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+def text_search(c, query, filters, limit=None, collapse=False):
+    """
+    Búsqueda de texto sobre descripción/barrio/localidad/categoría.
+    
+    Con FTS5 los resultados vienen ordenados por BM25 y la similitud es el
+    score BM25 relativo al mejor resultado (el mejor vale 1.0). Sin FTS5 se
+    usa LIKE (similitud 1.0). Devuelve lista de (fila, similitud).
+    """
+    where = ""
+    params = []
+    for column, value in filters.items():
+        if value:
+            where += f" AND i.{column} = ?"
+            params.append(value)
+    if collapse:
+        # Una sola imagen por grupo de duplicados: la de menor id que cumpla los filtros
+        same = where.replace("i.", "d.")
+        where += f"""
+            AND NOT EXISTS (SELECT 1 FROM imagenes d WHERE d.cluster_id = i.cluster_id AND d.id < i.id{same})"""
+        params += params
+    
+    if FTS_ENABLED:
+        match = fts_query(query)
+        if not match:
+            return []
+        # Pesos BM25 por columna: la descripción pesa más que las facetas
+        sql = f"""
+            SELECT i.id, i.filename, i.original_path, i.barrio, i.localidad, i.categoria, i.descripcion, i.content_hash,
+                   bm25(imagenes_fts, 4.0, 1.0, 1.0, 1.0) AS score
+            FROM imagenes_fts JOIN imagenes i ON i.id = imagenes_fts.rowid
+            WHERE imagenes_fts MATCH ?{where}
+            ORDER BY score
+        """
+        params = [match] + params
+    else:
+        pattern = f"%{query.lower().strip()}%"
+        sql = f"""
+            SELECT i.id, i.filename, i.original_path, i.barrio, i.localidad, i.categoria, i.descripcion, i.content_hash, -1.0
+            FROM imagenes i
+            WHERE (LOWER(i.descripcion) LIKE ? OR LOWER(i.barrio) LIKE ? OR LOWER(i.localidad) LIKE ? OR LOWER(i.categoria) LIKE ?){where}
+        """
+        params = [pattern] * 4 + params
+    
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    
+    c.execute(sql, params)
+    rows = c.fetchall()
+    if not rows:
+        return []
+    
+    # bm25() es negativo (más negativo = mejor); el primero es el mejor
+    best = -rows[0][8]
+    if best <= 0:
+        return [(row[:8], 1.0) for row in rows]
+    return [(row[:8], max(-row[8], 0.0) / best) for row in rows]
+
+def fetch_rows(c, row_ids):
+    """Trae las filas (sin embedding) de los ids dados, en ese mismo orden"""
+    row_ids = [int(r) for r in row_ids]
+    by_id = {}
+    # De a bloques para no pasar el límite de parámetros de SQLite
+    for start in range(0, len(row_ids), 900):
+        chunk = row_ids[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        c.execute(f"SELECT id, filename, original_path, barrio, localidad, categoria, descripcion, content_hash FROM imagenes WHERE id IN ({placeholders})", chunk)
+        by_id.update((row[0], row) for row in c.fetchall())
+    return [by_id[r] for r in row_ids if r in by_id]
+
+def use_ann(scoring, filtered):
+    """Decide si una búsqueda semántica usa el índice aproximado"""
+    if ann is None or filtered or scoring == "exact":
+        return False
+    if scoring == "approx":
+        return True
+    return len(store) >= ANN_MIN_SIZE  # auto
+
+def vector_candidates(query_embedding, k, filters, scoring, collapse=False):
+    """
+    Top-k visual: con el índice aproximado si corresponde, si no con scoring
+    exacto sobre las filas que cumplen los filtros de faceta.
+    Con `collapse`, una sola imagen por grupo de duplicados.
+    Devuelve (ids, similitudes) de mayor a menor.
+    """
+    if use_ann(scoring, any(filters.values())):
+        hidden = store.hidden if collapse else 0
+        if not hidden:
+            with span("scoring"):
+                return ann.search(query_embedding, k)
+        # El índice tiene también las copias: pedir de más y descartarlas
+        extra = int(k * hidden / max(len(store) - hidden, 1)) + 16
+        with span("scoring"):
+            ids, similarities = ann.search(query_embedding, k + extra)
+            keep = store.cluster_ids(ids) == ids
+        return ids[keep][:k], similarities[keep][:k]
+    with span("filtros"):
+        positions = store.select(collapse=collapse, **filters)
+    with span("scoring"):
+        return store.top(query_embedding, k, positions)
+
+def text_stage(query, filters, k, collapse):
+    """Etapa de texto de la búsqueda híbrida (corre en un thread, con su propia conexión)"""
+    with span("sqlite_texto"), db.reader() as conn:
+        return text_search(conn.cursor(), query, filters, k, collapse)
+
+async def vector_stage(query, filters, k, scoring, collapse):
+    """Etapa visual de la búsqueda híbrida"""
+    query_embedding = await encode_query(query)
+    ids, similarities = vector_candidates(query_embedding, k, filters, scoring, collapse)
+    return query_embedding, ids, similarities
+
+async def hybrid_ranking(query, filters, scoring, text_k, vector_k, fusion, rrf_k, text_weight, collapse=False):
+    """
+    Búsqueda híbrida: las etapas de texto y visual corren en paralelo (la
+    latencia es la de la más lenta) y se fusionan los rankings.
+    
+    fusion="rrf": reciprocal rank fusion, sum(1 / (rrf_k + rank)) en cada
+        lista, normalizado para que 1.0 sea primero en las dos.
+    fusion="weighted": text_weight * score_texto + (1 - text_weight) * similitud
+        visual (la similitud visual se calcula para todos los candidatos).
+    
+    Devuelve el Ranking fusionado de todos los candidatos.
+    """
+    text_results, (query_embedding, vector_ids, vector_sims) = await asyncio.gather(
+        asyncio.to_thread(text_stage, query, filters, text_k, collapse),
+        vector_stage(query, filters, vector_k, scoring, collapse),
+    )
+    
+    with span("fusion"):
+        return fuse_rankings(query_embedding, text_results, vector_ids, vector_sims, text_k, vector_k,
+                             fusion, rrf_k, text_weight)
+
+def fuse_rankings(query_embedding, text_results, vector_ids, vector_sims, text_k, vector_k, fusion, rrf_k, text_weight):
+    """Fusión de los candidatos de texto y visuales de hybrid_ranking"""
+    text_scores = {row[0]: score for row, score in text_results}
+    vector_scores = dict(zip(vector_ids.tolist(), vector_sims.tolist()))
+    candidates = list(dict.fromkeys(list(text_scores) + list(vector_scores)))
+    
+    if fusion == "weighted":
+        # Similitud visual también para los candidatos que trajo solo el texto
+        missing = [row_id for row_id in candidates if row_id not in vector_scores]
+        vector_scores.update(zip(missing, store.scores(query_embedding, missing).tolist()))
+        fused = [
+            text_weight * text_scores.get(row_id, 0.0)
+            + (1 - text_weight) * np.nan_to_num(vector_scores[row_id])
+            for row_id in candidates
+        ]
+    else:
+        fused = dict.fromkeys(candidates, 0.0)
+        for ranking in (text_scores, vector_scores):
+            for rank, row_id in enumerate(ranking, start=1):
+                fused[row_id] += 1.0 / (rrf_k + rank)
+        best = 2.0 / (rrf_k + 1)
+        fused = [fused[row_id] / best for row_id in candidates]
+    
+    fused = np.array(fused, dtype=np.float32)
+    order = np.argsort(-fused, kind="stable")
+    # Si alguna etapa llegó a su k, puede haber más candidatos
+    complete = len(text_results) < text_k and len(vector_ids) < vector_k
+    return Ranking(np.array(candidates, dtype=np.int64)[order], fused[order], complete)
+
+def stored_name(original_path, filename):
+    """Nombre único con el que se guarda la imagen en ../images"""
+    file_hash = hashlib.md5(original_path.encode()).hexdigest()[:8]
+    return f"{file_hash}_{filename}"
+
+def save_image(original_path, filename, data):
+    """Copia la imagen a ../images con un nombre único y devuelve ese nombre"""
+    stored_filename = stored_name(original_path, filename)
+    with open(f"../images/{stored_filename}", "wb") as f:
+        f.write(data)
+    return stored_filename
+
+def add_to_memory(row_ids, embeddings, facets):
+    """Agrega filas recién insertadas a la matriz en memoria y al índice aproximado"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if snapshot is not None:
+        # Pasan por el delta compartido: así todos los workers tienen las filas en el mismo orden
+        snapshot.append(row_ids, embeddings)
+        sync_snapshot(known=dict(zip(row_ids, facets)))
+    else:
+        store.add(row_ids, embeddings, facets)
+        add_to_ann(row_ids, embeddings)
+    
+    # Las listas de vecinos se recalculan en segundo plano
+    if NEIGHBORS_K > 0:
+        with _neighbors_lock:
+            neighbors_pending.update(int(r) for r in row_ids)
+        neighbors_event.set()
+
+def add_to_ann(row_ids, embeddings):
+    global ann_pending
+    if ann is not None and len(row_ids) > 0:
+        ann.add(embeddings, row_ids)
+        with _ann_lock:
+            ann_pending += len(row_ids)
+            if ann_pending >= ANN_SAVE_EVERY:
+                ann.save(ANN_PATH)
+                ann_pending = 0
+
+def sync_snapshot(known=None):
+    """Aplica a la matriz y al índice aproximado lo nuevo del snapshot (de este u otro worker)"""
+    records = snapshot.sync(store, db.reader, known)
+    if records is not None:
+        add_to_ann(records["id"], records["vector"])
+        return
+    # Se regeneró (ej. `python snapshot.py build`): hay que mapearlo de nuevo
+    print("🔄 El snapshot cambió, recargando embeddings...")
+    with db.reader() as conn:
+        snapshot.load(store, conn)
+    if ann is not None:
+        faltantes = np.setdiff1d(store.ids, ann.ids)
+        add_to_ann(faltantes, store.rows(store.positions(faltantes)))
+
+def content_hash(data):
+    """Hash del contenido de la imagen (detecta archivos que cambiaron o repetidos)"""
+    return hashlib.sha256(data).hexdigest()
+
+def parse_item_metadata(meta):
+    """
+    Valida la metadata de un item de /index/batch.
+    Devuelve (original_path, barrio, localidad, categoria, descripcion) o
+    levanta ValueError con el motivo.
+    """
+    if not isinstance(meta, dict):
+        raise ValueError("la metadata de cada imagen debe ser un objeto")
+    for campo in ("original_path", "localidad", "categoria"):
+        if campo not in meta:
+            raise ValueError(f"falta el campo '{campo}'")
+    campos = (meta["original_path"], meta.get("barrio") or "", meta["localidad"],
+              meta["categoria"], meta.get("descripcion") or "")
+    for nombre, valor in zip(("original_path", "barrio", "localidad", "categoria", "descripcion"), campos):
+        if not isinstance(valor, str):
+            raise ValueError(f"el campo '{nombre}' debe ser texto")
+    if not campos[0]:
+        raise ValueError("original_path no puede estar vacío")
+    return campos
+
+def find_indexed(c, original_paths):
+    """
+    Filas ya indexadas para esos paths.
+    Devuelve path -> (id, filename, content_hash, model_version)
+    """
+    found = {}
+    paths = list(original_paths)
+    for start in range(0, len(paths), 900):
+        chunk = paths[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        # ORDER BY id DESC: si hay duplicados viejos, gana la fila más antigua
+        c.execute(f"SELECT original_path, id, filename, content_hash, model_version FROM imagenes WHERE original_path IN ({placeholders}) ORDER BY id DESC", chunk)
+        found.update((row[0], row[1:]) for row in c.fetchall())
+    return found
+
+def find_embeddings(c, hashes):
+    """Embeddings ya calculados con el modelo actual para esos hashes de contenido"""
+    found = {}
+    hashes = list(hashes)
+    for start in range(0, len(hashes), 900):
+        chunk = hashes[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        c.execute(f"SELECT content_hash, embedding FROM imagenes WHERE model_version = ? AND content_hash IN ({placeholders})", [MODEL_VERSION] + chunk)
+        found.update((h, decode_embedding(emb)) for h, emb in c.fetchall())
+    return found
+
+def is_unchanged(existing, file_hash):
+    """True si la fila ya indexada tiene el mismo contenido y modelo (no hay que hacer nada)"""
+    return existing is not None and existing[2] == file_hash and existing[3] == MODEL_VERSION
 
-init_db()
+def in_writer(fn, *args):
+    """
+    fn(conn, *args) con la conexión de escritura. Desde un handler async va por
+    asyncio.to_thread: esperar el lock de escritura no traba el event loop
+    """
+    with db.writer() as conn:
+        return fn(conn, *args)
+
+def update_metadata(conn, updates):
+    """
+    Actualiza solo la metadata de imágenes ya indexadas (sin tocar el embedding).
+    
+    updates: tuplas (id, barrio, localidad, categoria, descripcion)
+    """
+    if not updates:
+        return
+    # Una sola transacción; solo se escriben las filas en las que algo cambió
+    conn.execute("BEGIN")
+    try:
+        conn.executemany("""
+            UPDATE imagenes SET barrio = ?, localidad = ?, categoria = ?, descripcion = ?
+            WHERE id = ? AND (barrio IS NOT ? OR localidad IS NOT ? OR categoria IS NOT ? OR descripcion IS NOT ?)
+        """, [(b, l, cat, d, row_id, b, l, cat, d) for row_id, b, l, cat, d in updates])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for row_id, b, l, cat, _ in updates:
+        store.set_facets(row_id, (b, l, cat))
+
+def upsert_images(conn, rows):
+    """
+    Inserta o actualiza (según original_path) muchas imágenes en una sola transacción.
+    
+    rows: tuplas (filename, original_path, barrio, localidad, categoria, descripcion, embedding, content_hash)
+    Devuelve los ids de cada fila, en el mismo orden.
+    """
+    c = conn.cursor()
+    # BEGIN IMMEDIATE toma el lock de escritura: los ids nuevos son consecutivos
+    # a partir del máximo actual y nadie más puede insertar en el medio
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        existing = find_indexed(c, [row[1] for row in rows])
+        row_ids = [existing[row[1]][0] if row[1] in existing else None for row in rows]
+        
+        values = lambda row: row[:6] + (encode_embedding(row[6], EMBEDDING_DTYPE), row[7], MODEL_VERSION)
+        c.executemany("""
+            UPDATE imagenes SET filename = ?, original_path = ?, barrio = ?, localidad = ?, categoria = ?,
+                descripcion = ?, embedding = ?, content_hash = ?, model_version = ?
+            WHERE id = ?
+        """, [values(row) + (row_id,) for row, row_id in zip(rows, row_ids) if row_id is not None])
+        
+        nuevas = [row for row, row_id in zip(rows, row_ids) if row_id is None]
+        if nuevas:
+            c.execute("SELECT COALESCE(MAX(id), 0) FROM imagenes")
+            last_id = c.fetchone()[0]
+            c.executemany("""
+                INSERT INTO imagenes (filename, original_path, barrio, localidad, categoria, descripcion,
+                    embedding, content_hash, model_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [values(row) for row in nuevas])
+            c.execute("SELECT id FROM imagenes WHERE id > ? ORDER BY id", (last_id,))
+            new_ids = iter(r[0] for r in c.fetchall())
+            row_ids = [row_id if row_id is not None else next(new_ids) for row_id in row_ids]
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    return row_ids
 
 @app.get("/")
 async def root():
-    return {"message": "API Córdoba de Antaño funcionando! 🏛️"}
+    return {"message": "API Córdoba de Antaño funcionando! 🏛️", "model": MODEL_NAME, "index_version": INDEX_VERSION,
+            "ready": is_ready()}
+
+@app.get("/health/live")
+async def health_live():
+    """El proceso está levantado y atiende requests (aunque todavía esté cargando)"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def health_ready(response: Response):
+    """Listo para búsquedas visuales e indexación (503 mientras carga), con los tiempos de arranque"""
+    ready = is_ready()
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "ok" if ready else "cargando",
+        "busqueda_texto": True,
+        "modelo": model_ready.is_set(),
+        "embeddings": vectors_ready.is_set(),
+        "errores": startup_errors,
+        "arranque": startup_times,
+    }
+
+INDEXED = REGISTRY.counter("cordoba_indexed_total", "Imágenes recibidas para indexar, por resultado", ("status",))
 
 @app.post("/index")
 async def index_image(
@@ -67,233 +917,428 @@ async def index_image(
     categoria: str = Form(...),
     descripcion: str = Form("")
 ):
+    require_ready()
+    with span("leer"):
+        data = await file.read()
+        file_hash = content_hash(data)
+    
+    with span("sqlite_lectura"), db.reader() as conn:
+        c = conn.cursor()
+        existing = find_indexed(c, [original_path]).get(original_path)
+        # Embedding de otra copia idéntica ya indexada (si hay)
+        embedding = find_embeddings(c, [file_hash]).get(file_hash)
+    
+    # Misma imagen y mismo modelo: no hay que recalcular nada
+    if is_unchanged(existing, file_hash):
+        await timed("sqlite_escritura", asyncio.to_thread(
+            in_writer, update_metadata, [(existing[0], barrio, localidad, categoria, descripcion)]))
+        INDEXED.inc(status="unchanged")
+        return {"status": "unchanged", "filename": existing[1]}
+    
+    # Decodificar antes de guardar: una imagen corrupta es un 400 y no deja
+    # un archivo huérfano en ../images (aunque el embedding se reuse)
+    with span("decodificar"):
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"No se pudo leer la imagen: {e}")
+    
     # Guardar imagen con nombre único
-    import hashlib
-    file_hash = hashlib.md5(original_path.encode()).hexdigest()[:8]
-    extension = os.path.splitext(file.filename)[1]
-    stored_filename = f"{file_hash}_{file.filename}"
-    image_path = f"../images/{stored_filename}"
+    with span("guardar_archivo"):
+        stored_filename = save_image(original_path, file.filename, data)
     
-    with open(image_path, "wb") as f:
-        f.write(await file.read())
+    # Generar embedding (si no se reusa) y las miniaturas, con la misma imagen decodificada
+    if embedding is None or not has_thumbnails(file_hash):
+        thumbs = timed("miniaturas", asyncio.to_thread(make_thumbnails, image, file_hash))
+        if embedding is None:
+            embedding, _ = await asyncio.gather(timed("encode", scheduler.encode_image(image)), thumbs)
+        else:
+            await thumbs
     
-    # Generar embedding
-    image = Image.open(image_path)
-    embedding = model.encode(image).tolist()
+    # Guardar en DB (actualiza la fila si el path ya estaba indexado)
+    row_ids = await timed("sqlite_escritura", asyncio.to_thread(
+        in_writer, upsert_images, [(stored_filename, original_path, barrio, localidad, categoria, descripcion, embedding, file_hash)]))
     
-    # Guardar en DB
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO imagenes (filename, original_path, barrio, localidad, categoria, descripcion, embedding)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (stored_filename, original_path, barrio, localidad, categoria, descripcion, json.dumps(embedding)))
-    conn.commit()
-    conn.close()
+    # Actualizar la matriz en memoria (y el índice aproximado, si hay)
+    with span("memoria"):
+        add_to_memory(row_ids, [embedding], [(barrio, localidad, categoria)])
     
+    INDEXED.inc(status="ok")
     return {"status": "ok", "filename": stored_filename}
 
-@app.get("/search")
-async def search(
-    query: str = Query(...),
-    barrio: str = Query(None),
-    localidad: str = Query(None),
-    categoria: str = Query(None),
-    limit: int = Query(100),
-    mode: str = Query("hybrid")  # hybrid, semantic, text
+@app.post("/index/batch")
+async def index_batch(
+    files: List[UploadFile] = File(...),
+    metadata: str = Form(...)
 ):
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
+    """
+    Indexa varias imágenes de una: un solo model.encode para todo el batch
+    y un solo executemany en una transacción.
     
-    # Construir filtros SQL base
-    sql_base = "SELECT * FROM imagenes WHERE 1=1"
-    params_base = []
+    metadata: JSON con una lista (mismo orden que `files`) de objetos con
+    original_path, localidad, categoria y opcionalmente barrio y descripcion.
+    Devuelve el estado de cada imagen: si una falla, las demás se indexan igual.
+    """
+    require_ready()
+    try:
+        items_metadata = json.loads(metadata)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="metadata no es JSON válido")
+    if not isinstance(items_metadata, list) or len(items_metadata) != len(files):
+        raise HTTPException(status_code=400, detail="metadata debe ser una lista con un elemento por archivo")
     
-    if barrio:
-        sql_base += " AND barrio = ?"
-        params_base.append(barrio)
-    if localidad:
-        sql_base += " AND localidad = ?"
-        params_base.append(localidad)
-    if categoria:
-        sql_base += " AND categoria = ?"
-        params_base.append(categoria)
+    items = [None] * len(files)
+    pending = []  # (índice, imagen o None si se reusa embedding, fila sin embedding)
     
-    results = []
+    # Validar cada item por separado: uno mal armado (o un path repetido en el
+    # mismo batch, que terminaría en dos filas) falla solo, no todo el request
+    validos = []  # (índice, archivo, campos)
+    vistos = set()
+    for i, (file, meta) in enumerate(zip(files, items_metadata)):
+        try:
+            campos = parse_item_metadata(meta)
+        except ValueError as e:
+            items[i] = {"status": "error", "error": str(e)}
+            continue
+        if campos[0] in vistos:
+            items[i] = {"status": "error", "error": f"original_path repetido en el batch: {campos[0]}"}
+            continue
+        vistos.add(campos[0])
+        validos.append((i, file, campos))
     
-    if mode == "text":
-        # Solo búsqueda de texto
-        query_normalized = query.lower().strip()
-        sql = sql_base + " AND (LOWER(descripcion) LIKE ? OR LOWER(barrio) LIKE ? OR LOWER(localidad) LIKE ? OR LOWER(categoria) LIKE ?)"
-        search_pattern = f"%{query_normalized}%"
-        params = params_base + [search_pattern, search_pattern, search_pattern, search_pattern]
-        
-        c.execute(sql, params)
-        rows = c.fetchall()
-        
-        for row in rows:
-            results.append({
-                "filename": row[1],
-                "original_path": row[2],
-                "barrio": row[3],
-                "localidad": row[4],
-                "categoria": row[5],
-                "descripcion": row[6],
-                "similarity": 1.0
-            })
-    
-    elif mode == "semantic":
-        # Solo búsqueda visual
-        c.execute(sql_base, params_base)
-        rows = c.fetchall()
-        
-        query_embedding = model.encode(query)
-        
-        for row in rows:
-            img_embedding = np.array(json.loads(row[7]))
-            similarity = np.dot(query_embedding, img_embedding) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(img_embedding)
-            )
-            
-            results.append({
-                "filename": row[1],
-                "original_path": row[2],
-                "barrio": row[3],
-                "localidad": row[4],
-                "categoria": row[5],
-                "descripcion": row[6],
-                "similarity": float(similarity)
-            })
-    
-    elif mode == "hybrid":
-        # Búsqueda híbrida con fallback
-        query_normalized = query.lower().strip()
-        sql_text = sql_base + " AND (LOWER(descripcion) LIKE ? OR LOWER(barrio) LIKE ? OR LOWER(localidad) LIKE ? OR LOWER(categoria) LIKE ?)"
-        search_pattern = f"%{query_normalized}%"
-        params_text = params_base + [search_pattern, search_pattern, search_pattern, search_pattern]
-        
-        c.execute(sql_text, params_text)
-        rows_text = c.fetchall()
-        
-        if len(rows_text) > 0:
-            # Hay matches de texto → calcular similitud visual + boost
-            query_embedding = model.encode(query)
+    with span("sqlite_lectura"), db.reader() as conn:
+        existing = find_indexed(conn.cursor(), vistos)
+    
+    for i, file, (original_path, barrio, localidad, categoria, descripcion) in validos:
+        try:
+            with span("leer"):
+                data = await file.read()
+                file_hash = content_hash(data)
             
-            for row in rows_text:
-                img_embedding = np.array(json.loads(row[7]))
-                similarity = np.dot(query_embedding, img_embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(img_embedding)
-                )
-                
-                # Boost para match de texto exacto
-                text_boost = 0.3 if query_normalized in row[6].lower() else 0.15
-                
-                results.append({
-                    "filename": row[1],
-                    "original_path": row[2],
-                    "barrio": row[3],
-                    "localidad": row[4],
-                    "categoria": row[5],
-                    "descripcion": row[6],
-                    "similarity": float(min(similarity + text_boost, 1.0))
-                })
-        else:
-            # NO hay matches de texto → fallback a búsqueda visual pura
-            print(f"No text matches for '{query}', falling back to semantic search")
-            c.execute(sql_base, params_base)
-            rows_all = c.fetchall()
+            previous = existing.get(original_path)
+            if is_unchanged(previous, file_hash):
+                await timed("sqlite_escritura", asyncio.to_thread(
+                    in_writer, update_metadata, [(previous[0], barrio, localidad, categoria, descripcion)]))
+                items[i] = {"status": "unchanged", "filename": previous[1]}
+                continue
             
-            query_embedding = model.encode(query)
+            with span("decodificar"):
+                image = Image.open(io.BytesIO(data))
+                image.load()  # detectar imágenes corruptas acá y no en el batch
             
-            for row in rows_all:
-                img_embedding = np.array(json.loads(row[7]))
-                similarity = np.dot(query_embedding, img_embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(img_embedding)
-                )
-                
-                results.append({
-                    "filename": row[1],
-                    "original_path": row[2],
-                    "barrio": row[3],
-                    "localidad": row[4],
-                    "categoria": row[5],
-                    "descripcion": row[6],
-                    "similarity": float(similarity)
-                })
-    
-    conn.close()
-    
-    # Ordenar por similitud
-    results.sort(key=lambda x: x['similarity'], reverse=True)
-    
-    return results[:limit]
-
-@app.get("/filters")
-async def get_filters():
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT DISTINCT barrio FROM imagenes WHERE barrio != ''")
-    barrios = [r[0] for r in c.fetchall()]
+            with span("guardar_archivo"):
+                stored_filename = save_image(original_path, file.filename, data)
+            pending.append((i, image, (stored_filename, original_path, barrio, localidad, categoria, descripcion), file_hash))
+        except Exception as e:
+            items[i] = {"status": "error", "error": str(e)}
     
-    c.execute("SELECT DISTINCT localidad FROM imagenes")
-    localidades = [r[0] for r in c.fetchall()]
-    
-    c.execute("SELECT DISTINCT categoria FROM imagenes")
-    categorias = [r[0] for r in c.fetchall()]
+    if pending:
+        try:
+            # Reusar embeddings de copias idénticas; el resto en una sola pasada de CLIP
+            with span("sqlite_lectura"), db.reader() as conn:
+                embeddings = find_embeddings(conn.cursor(), [p[3] for p in pending])
+            to_encode = [p for p in pending if p[3] not in embeddings]
+            # Miniaturas en un thread, mientras tanto corre CLIP
+            thumbs = asyncio.to_thread(lambda: [make_thumbnails(image, file_hash) for _, image, _, file_hash in pending])
+            encoded, _ = await asyncio.gather(
+                timed("encode", scheduler.encode_images([image for _, image, _, _ in to_encode])),
+                timed("miniaturas", thumbs))
+            for (_, _, _, file_hash), emb in zip(to_encode, encoded):
+                embeddings[file_hash] = emb
+            
+            rows = [row + (embeddings[file_hash], file_hash) for _, _, row, file_hash in pending]
+            row_ids = await timed("sqlite_escritura", asyncio.to_thread(in_writer, upsert_images, rows))
+            
+            with span("memoria"):
+                add_to_memory(row_ids, [row[6] for row in rows], [(row[2], row[3], row[4]) for row in rows])
+            for i, _, row, _ in pending:
+                items[i] = {"status": "ok", "filename": row[0]}
+        except Exception as e:
+            for i, _, _, _ in pending:
+                items[i] = {"status": "error", "error": str(e)}
     
-    conn.close()
+    for item in items:
+        INDEXED.inc(status=item["status"])
+    indexed = sum(1 for item in items if item["status"] in ("ok", "unchanged"))
+    if indexed == len(items):
+        status = "ok"
+    elif indexed == 0:
+        status = "error"
+    else:
+        status = "partial"
     
     return {
-        "barrios": sorted(barrios),
-        "localidades": sorted(localidades),
-        "categorias": sorted(categorias)
+        "status": status,
+        "indexed": indexed,
+        "errors": len(items) - indexed,
+        "items": items
     }
 
-@app.get("/stats")
-async def stats():
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM imagenes")
-    total = c.fetchone()[0]
-    conn.close()
-    return {"total_imagenes": total}
+SEARCHES = REGISTRY.counter("cordoba_search_total", "Búsquedas por modo (el que se usó, después del fallback)", ("mode",))
+SEARCH_FALLBACKS = REGISTRY.counter("cordoba_search_fallback_total", "Búsquedas híbridas resueltas solo con texto (modelo cargando)")
+SEARCH_RESULTS = REGISTRY.histogram("cordoba_search_results", "Resultados devueltos por búsqueda", ("mode",),
+                                    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000))
 
-@app.get("/analytics")
-async def analytics():
-    """Endpoint para ver estadísticas detalladas"""
-    conn = sqlite3.connect('../cordoba.db')
-    c = conn.cursor()
+@app.get("/search")
+async def search(
+    response: Response,
+    query: str = Query(...),
+    barrio: str = Query(None),
+    localidad: str = Query(None),
+    categoria: str = Query(None),
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    offset: int = Query(0, ge=0),  # paginación: el header X-Next-Offset dice desde dónde seguir
+    mode: Literal["hybrid", "semantic", "text"] = Query("hybrid"),
+    scoring: Literal["auto", "exact", "approx"] = Query("auto"),  # approx: índice aproximado
+    fusion: Literal["rrf", "weighted"] = Query("rrf"),  # híbrida
+    text_k: int = Query(200, ge=1),  # híbrida: candidatos de la etapa de texto
+    vector_k: int = Query(200, ge=1),  # híbrida: candidatos de la etapa visual
+    rrf_k: int = Query(60, ge=1),
+    text_weight: float = Query(0.5, ge=0, le=1),  # híbrida con fusion=weighted
+    collapse: bool = Query(True)  # una sola imagen por grupo de duplicados (ver duplicates.py)
+):
+    filters = {"barrio": barrio, "localidad": localidad, "categoria": categoria}
+    end = offset + limit
+    results = []
+    has_more = False
     
-    # Categorías
-    c.execute("SELECT categoria, COUNT(*) as total FROM imagenes GROUP BY categoria ORDER BY total DESC")
-    categorias = [{"categoria": r[0], "total": r[1]} for r in c.fetchall()]
+    # Mientras carga el modelo: la híbrida se resuelve solo con texto, la visual espera
+    if not is_ready():
+        if mode == "semantic":
+            require_ready()
+        if mode == "hybrid":
+            mode = "text"
+            response.headers["X-Search-Mode"] = "text"
+            SEARCH_FALLBACKS.inc()
+    SEARCHES.inc(mode=mode)
     
-    # Barrios
-    c.execute("SELECT barrio, COUNT(*) as total FROM imagenes WHERE barrio != '' GROUP BY barrio ORDER BY total DESC")
-    barrios = [{"barrio": r[0], "total": r[1]} for r in c.fetchall()]
+    if mode == "text":
+        # Solo búsqueda de texto (índice full-text, ordenado por BM25);
+        # una fila de más para saber si hay otra página
+        with span("sqlite_texto"), db.reader() as conn:
+            matches = text_search(conn.cursor(), query, filters, end + 1, collapse)
+        with span("resultados"):
+            results = [row_to_result(row, similarity) for row, similarity in matches[offset:end]]
+        has_more = len(matches) > end
+    
+    elif mode in ("semantic", "hybrid"):
+        # El ranking ordenado se guarda para que las páginas siguientes no lo recalculen
+        key = (mode, normalize_query(query), barrio, localidad, categoria, scoring,
+               fusion, text_k, vector_k, rrf_k, text_weight, collapse, store.version)
+        ranking = rankings.get(key)
+        if ranking is None or not ranking.covers(end):
+            depth = max(end, 2 * len(ranking) if ranking is not None else 0)
+            if mode == "semantic":
+                # Solo búsqueda visual (los filtros se resuelven en memoria)
+                depth = max(depth, RANKING_DEPTH)
+                ids, similarities = vector_candidates(await encode_query(query), depth, filters, scoring, collapse)
+                ranking = Ranking(ids, similarities, complete=len(ids) < depth)
+            else:
+                # Búsqueda híbrida: texto y visual en paralelo, rankings fusionados
+                ranking = await hybrid_ranking(query, filters, scoring, max(text_k, depth),
+                                               max(vector_k, depth), fusion, rrf_k, text_weight, collapse)
+            rankings.put(key, ranking)
+        
+        # Metadata solo de la página pedida
+        ids, similarities = ranking.page(offset, limit)
+        sim_by_id = dict(zip(ids.tolist(), similarities.tolist()))
+        with span("sqlite_filas"), db.reader() as conn:
+            rows = fetch_rows(conn.cursor(), ids)
+        with span("resultados"):
+            results = [row_to_result(row, sim_by_id[row[0]]) for row in rows]
+        has_more = ranking.has_more(end)
     
-    # Localidades
-    c.execute("SELECT localidad, COUNT(*) as total FROM imagenes GROUP BY localidad ORDER BY total DESC")
-    localidades = [{"localidad": r[0], "total": r[1]} for r in c.fetchall()]
+    SEARCH_RESULTS.observe(len(results), mode=mode)
+    if has_more:
+        response.headers["X-Next-Offset"] = str(end)
+    return results
+
+# Respuestas de /filters y /analytics precalculadas: se regeneran solo cuando
+# cambia la generación de escritura (la suben los triggers de facet_counts,
+# también cuando escribe otro proceso como bulk_index.py)
+_response_cache = {}  # endpoint -> (generación, ETag, JSON)
+
+def cached_json(request, name, build):
+    """
+    Devuelve el JSON de `build(cursor)`, recalculándolo solo si hubo escrituras.
+    Con If-None-Match igual al ETag actual responde 304 sin cuerpo.
+    """
+    with db.reader() as conn:
+        c = conn.cursor()
+        # Mismo snapshot para la generación y los conteos
+        c.execute("BEGIN")
+        c.execute("SELECT valor FROM config WHERE clave = 'generacion'")
+        generation = c.fetchone()[0]
+        entry = _response_cache.get(name)
+        if entry is None or entry[0] != generation:
+            body = json.dumps(build(c), ensure_ascii=False).encode()
+            entry = (generation, f'"{DB_ID}-{generation}"', body)
+            _response_cache[name] = entry
     
-    # Estadísticas generales
-    c.execute("SELECT COUNT(*) FROM imagenes")
-    total = c.fetchone()[0]
+    _, etag, body = entry
+    # no-cache: el navegador guarda la respuesta pero revalida siempre (304 si no cambió)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def facet_counts(c, facet):
+    """(valor, total) de una faceta, de mayor a menor total"""
+    c.execute("SELECT valor, total FROM facet_counts WHERE faceta = ? ORDER BY total DESC, valor", (facet,))
+    return c.fetchall()
+
+def facet_total(c, facet):
+    c.execute("SELECT total FROM facet_counts WHERE faceta = ? AND valor = ''", (facet,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def build_filters(c):
+    return {
+        "barrios": sorted(value for value, _ in facet_counts(c, "barrio") if value != ""),
+        "localidades": sorted(value for value, _ in facet_counts(c, "localidad")),
+        "categorias": sorted(value for value, _ in facet_counts(c, "categoria"))
+    }
+
+def build_analytics(c):
+    return {
+        "total_imagenes": facet_total(c, "imagenes"),
+        "pendientes_revisar": facet_total(c, "revisar"),
+        "categorias": [{"categoria": v, "total": t} for v, t in facet_counts(c, "categoria")],
+        "barrios": [{"barrio": v, "total": t} for v, t in facet_counts(c, "barrio") if v != ""],
+        "localidades": [{"localidad": v, "total": t} for v, t in facet_counts(c, "localidad")]
+    }
+
+@app.get("/similar/{ref}")
+async def similar(
+    response: Response,
+    ref: str,  # filename de la imagen (como en los resultados) o su id
+    barrio: str = Query(None),
+    localidad: str = Query(None),
+    categoria: str = Query(None),
+    limit: int = Query(50, ge=1, le=MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    scoring: Literal["auto", "exact", "approx"] = Query("auto"),
+    collapse: bool = Query(True)  # sin copias de la imagen ni entre los resultados
+):
+    """
+    "Más como esta": usa el embedding ya guardado de la imagen como query
+    (no pasa por CLIP). Sin filtros usa los vecinos precalculados.
+    """
+    if not vectors_ready.is_set():
+        raise HTTPException(status_code=503, detail="El backend todavía está cargando los embeddings",
+                            headers={"Retry-After": "5"})
     
-    c.execute("SELECT COUNT(*) FROM imagenes WHERE descripcion = '[REVISAR]'")
-    revisar = c.fetchone()[0]
+    filters = {"barrio": barrio, "localidad": localidad, "categoria": categoria}
+    end = offset + limit
     
-    conn.close()
+    with db.reader() as conn:
+        c = conn.cursor()
+        if ref.isdigit():
+            row_id = int(ref)
+        else:
+            c.execute("SELECT id FROM imagenes WHERE filename = ? ORDER BY id LIMIT 1", (ref,))
+            row = c.fetchone()
+            row_id = row[0] if row else None
+        query_embedding = store.vector(row_id) if row_id is not None else None
+        if query_embedding is None:
+            raise HTTPException(status_code=404, detail=f"No existe la imagen {ref}")
+        
+        key = ("similar", row_id, barrio, localidad, categoria, scoring, collapse, store.version)
+        ranking = rankings.get(key)
+        if ranking is None or not ranking.covers(end):
+            # La imagen misma no es un resultado (ni sus copias, si se colapsan)
+            own = store.cluster_ids([row_id])[0] if collapse else row_id
+            precomputed = None if any(filters.values()) else neighbor_lists.get(c, row_id)
+            if precomputed is not None:
+                ids, similarities = precomputed
+                complete = len(ids) < neighbor_lists.k
+                if collapse:
+                    clusters = store.cluster_ids(ids)
+                    keep = (clusters == ids) & (clusters != own)
+                    ids, similarities = ids[keep], similarities[keep]
+            if precomputed is not None and (complete or len(ids) >= end):
+                ranking = Ranking(ids, similarities, complete)
+            else:
+                depth = max(end, RANKING_DEPTH) + 1
+                ids, similarities = vector_candidates(query_embedding, depth, filters, scoring, collapse)
+                keep = (store.cluster_ids(ids) if collapse else ids) != own
+                ranking = Ranking(ids[keep], similarities[keep], complete=len(ids) < depth)
+            rankings.put(key, ranking)
+        
+        ids, similarities = ranking.page(offset, limit)
+        rows = fetch_rows(c, ids)
     
+    sim_by_id = dict(zip(ids.tolist(), similarities.tolist()))
+    if ranking.has_more(end):
+        response.headers["X-Next-Offset"] = str(end)
+    return [row_to_result(row, sim_by_id[row[0]]) for row in rows]
+
+@app.get("/filters")
+async def get_filters(request: Request):
+    return cached_json(request, "filters", build_filters)
+
+@app.get("/stats")
+async def stats():
+    with db.reader() as conn:
+        total = facet_total(conn.cursor(), "imagenes")
     return {
         "total_imagenes": total,
-        "pendientes_revisar": revisar,
-        "categorias": categorias,
-        "barrios": barrios,
-        "localidades": localidades
+        "duplicados_colapsados": store.hidden,
+        "cache_queries": query_cache.stats(),
+        "cache_rankings": rankings.stats(),
+        "inferencia": {"backend": "servicio" if INFERENCE_SOCKET else INFERENCE_BACKEND, **scheduler.stats()},
+        # Leída al iniciar: db.config() espera al lock de escritura
+        "sqlite": _config,
+        "snapshot": snapshot.stats() if snapshot is not None else None,
     }
 
+# Lo que ya cuentan los caches, el scheduler y el store se lee al pedir /metrics
+_caches = {"queries": query_cache, "rankings": rankings}
+REGISTRY.callback("cordoba_cache_hits_total", "Hits de los caches", kind="counter", labels=("cache",),
+                  read=lambda: {name: cache.hits for name, cache in _caches.items()})
+REGISTRY.callback("cordoba_cache_misses_total", "Misses de los caches", kind="counter", labels=("cache",),
+                  read=lambda: {name: cache.misses for name, cache in _caches.items()})
+REGISTRY.callback("cordoba_cache_entries", "Entradas en cada cache", labels=("cache",),
+                  read=lambda: {name: len(cache) for name, cache in _caches.items()})
+REGISTRY.callback("cordoba_inference_batches_total", "Pasadas de CLIP", kind="counter", read=lambda: scheduler.batches)
+REGISTRY.callback("cordoba_inference_items_total", "Textos e imágenes codificados", kind="counter", read=lambda: scheduler.items)
+REGISTRY.callback("cordoba_inference_queue", "Pedidos esperando al modelo", read=lambda: scheduler.stats()["en_cola"])
+if INFERENCE_SOCKET:
+    REGISTRY.callback("cordoba_inference_service_errors_total", "Pedidos al servicio de inferencia que fallaron",
+                      kind="counter", labels=("motivo",),
+                      read=lambda: {"saturado": scheduler.rejected, "timeout": scheduler.timeouts,
+                                    "conexion": scheduler.errors})
+REGISTRY.callback("cordoba_embeddings", "Embeddings en memoria", read=lambda: len(store))
+REGISTRY.callback("cordoba_snapshot_delta_rows", "Filas en el delta del snapshot (sin compactar)",
+                  read=lambda: snapshot.delta_rows() if snapshot is not None else 0)
+REGISTRY.callback("cordoba_ready", "1 si el modelo y los embeddings están cargados", read=lambda: int(is_ready()))
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/analytics")
+async def analytics(request: Request):
+    """Endpoint para ver estadísticas detalladas"""
+    return cached_json(request, "analytics", build_analytics)
+
+@app.on_event("shutdown")
+def save_ann_index():
+    """Guarda el índice aproximado con las imágenes agregadas desde el último guardado"""
+    with _ann_lock:
+        if ann is not None and ann_pending > 0:
+            ann.save(ANN_PATH)
+
+@app.on_event("shutdown")
+def save_query_cache():
+    query_cache.save()
+
+@app.on_event("shutdown")
+def close_db():
+    db.close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
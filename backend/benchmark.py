@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Benchmark de búsqueda e indexación a escala, reproducible y offline.
+
+Genera bases `imagenes` sintéticas (10k, 100k y 1M filas por default) con
+embeddings aleatorios y metadata sacada de metadata_cordoba.csv, levanta el
+backend sobre cada una con un encoder falso (StubCLIP, acá mismo: no
+descarga ni corre CLIP) y mide:
+
+- latencia p50/p95/p99 de /search por modo (text, semantic, hybrid) y
+  combinación de filtros, sin caches de queries ni de rankings
+- imágenes/s de /index (de a una), /index/batch y bulk_index.py
+- tiempos de arranque por fase
+
+El resultado es un JSON para comparar entre commits. Como el encoder es un
+stub, las latencias no incluyen CLIP: miden todo lo demás (SQLite, scoring,
+filtros, fusión, serialización). Para el costo de CLIP ver `clip_backends.py check`.
+
+Cada tamaño corre en su propio directorio (../bench/<filas>/), con la misma
+estructura que el proyecto: la base generada se reusa entre corridas.
+
+Uso:
+    cd backend
+    python benchmark.py run                               # 10k, 100k y 1M
+    python benchmark.py run --filas 10000 --salida bench.json
+    python benchmark.py run --filas 100000 --ann          # con índice aproximado
+    python benchmark.py comparar antes.json despues.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = "../bench"
+MODES = ("text", "semantic", "hybrid")
+# Combinaciones de filtros medidas (los valores salen de la base generada)
+FILTER_SETS = {
+    "sin_filtros": (),
+    "categoria": ("categoria",),
+    "localidad": ("localidad",),
+    "barrio": ("barrio",),
+    "categoria+localidad": ("categoria", "localidad"),
+}
+GENERATE_CHUNK = 50_000
+
+
+def _percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "n": len(samples),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "media_ms": round(float(samples.mean()), 3),
+    }
+
+
+def read_metadata(csv_path: str):
+    """(barrio, localidad, categoria, descripcion) de cada fila del CSV."""
+    import pandas as pd
+
+    df = pd.read_csv(csv_path).fillna("")
+    return list(df[["barrio", "localidad", "categoria", "descripcion"]].itertuples(index=False, name=None))
+
+
+def generate_db(db_path: str, rows: int, metadata, seed: int = 0):
+    """
+    Crea una base con `rows` imágenes sintéticas: embeddings normales
+    aleatorios y metadata de filas del CSV elegidas al azar.
+
+    Solo se escribe la tabla `imagenes`: el índice full-text y los conteos
+    por faceta los construye el backend al arrancar, como con una base vieja.
+    """
+    from vector_store import EMBEDDING_DIM
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute('''
+        CREATE TABLE imagenes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            original_path TEXT,
+            barrio TEXT,
+            localidad TEXT,
+            categoria TEXT,
+            descripcion TEXT,
+            embedding BLOB,
+            content_hash TEXT,
+            model_version TEXT
+        )
+    ''')
+    # Sin model_version: los embeddings sintéticos no se reusan al indexar
+    for start in range(0, rows, GENERATE_CHUNK):
+        n = min(GENERATE_CHUNK, rows - start)
+        embeddings = rng.standard_normal((n, EMBEDDING_DIM), dtype=np.float32)
+        picks = rng.integers(0, len(metadata), n)
+        hashes = rng.integers(0, 2 ** 63, (n, 4))
+        batch = []
+        for i in range(n):
+            barrio, localidad, categoria, descripcion = metadata[picks[i]]
+            row_id = start + i + 1
+            batch.append((
+                f"bench_{row_id}.jpg", f"/bench/{row_id}.jpg", barrio, localidad, categoria, descripcion,
+                embeddings[i].astype("<f4").tobytes(), "".join(f"{h:016x}" for h in hashes[i]),
+            ))
+        conn.executemany('''
+            INSERT INTO imagenes (filename, original_path, barrio, localidad, categoria, descripcion,
+                                  embedding, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+        print(f"   {start + n}/{rows}")
+    conn.close()
+
+
+def make_queries(metadata, count: int, seed: int = 0):
+    """Queries realistas: las primeras palabras de descripciones del CSV."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in rng.permutation(len(metadata)):
+        words = [w for w in str(metadata[i][3]).split() if len(w) >= 3 and not any(ch.isdigit() for ch in w)]
+        if words:
+            queries.append(" ".join(words[:rng.integers(1, 3, endpoint=True)]).lower())
+        if len(set(queries)) >= count:
+            break
+    return list(dict.fromkeys(queries))
+
+
+def synthetic_jpegs(count: int, seed: int = 0, size=(1024, 768)):
+    """JPEGs distintos (gradiente + ruido) para medir indexación."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, size[0], dtype=np.float32)[None, :, None]
+    images = []
+    for _ in range(count):
+        noise = rng.normal(0, 24, (size[1], size[0], 3)).astype(np.float32)
+        pixels = np.clip(gradient * rng.uniform(0.3, 1.0, 3) + noise, 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+# --- Medición (corre en un proceso por tamaño, dentro de ../bench/<filas>/backend) ---
+
+class StubCLIP:
+    """
+    Reemplazo de CLIP sin modelo: mismo `encode`, vectores pseudoaleatorios
+    deterministas (el mismo texto o la misma imagen dan siempre el mismo vector).
+
+    Solo existe acá: no es un INFERENCE_BACKEND, así que el backend de verdad
+    no puede terminar guardando estos vectores por una variable mal puesta.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _vector(self, item):
+        if isinstance(item, str):
+            data = item.encode()
+        else:
+            # Una miniatura de la imagen: copias con distinto tamaño dan el mismo vector
+            data = item.convert("L").resize((8, 8)).tobytes()
+        seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def encode(self, items, batch_size: int = 32, **kwargs):
+        if isinstance(items, str):
+            return self._vector(items)
+        return np.stack([self._vector(item) for item in items])
+
+
+def _use_stub_encoder(app):
+    """Le pone StubCLIP al backend en vez de cargar CLIP (load_model ya no hace nada)."""
+    app.model = StubCLIP()
+    app.scheduler.set_model(app.model)
+    # Las filas que se indexan al medir quedan marcadas como del stub
+    app.MODEL_VERSION = f"{app.MODEL_NAME}:stub"
+    app.model_ready.set()
+
+
+def _filter_values(app, filters):
+    """El valor más frecuente de cada faceta (y el par más frecuente para combinaciones)."""
+    with app.db.reader() as conn:
+        c = conn.cursor()
+        if len(filters) == 1:
+            c.execute(f"SELECT {filters[0]} FROM imagenes WHERE {filters[0]} != '' "
+                      f"GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1")
+        else:
+            columns = ", ".join(filters)
+            c.execute(f"SELECT {columns} FROM imagenes GROUP BY {columns} ORDER BY COUNT(*) DESC LIMIT 1")
+        row = c.fetchone()
+    return dict(zip(filters, row)) if row else {}
+
+
+async def _measure_search(client, queries, params, warmup: int):
+    times = []
+    for i, query in enumerate(queries):
+        t0 = time.perf_counter()
+        response = await client.get("/search", params={"query": query, **params})
+        elapsed = time.perf_counter() - t0
+        response.raise_for_status()
+        if i >= warmup:
+            times.append(elapsed)
+    return times
+
+
+async def _measure_index(client, images, batch_size: int):
+    """(imágenes/s de /index de a una, imágenes/s de /index/batch)."""
+    half = len(images) // 2
+    t0 = time.perf_counter()
+    for i, data in enumerate(images[:half]):
+        response = await client.post("/index", files={"file": (f"idx_{i}.jpg", data, "image/jpeg")},
+                                     data={"original_path": f"/bench/index/{i}.jpg", "localidad": "Córdoba Capital",
+                                           "categoria": "Benchmark", "descripcion": f"Benchmark {i}"})
+        response.raise_for_status()
+    single = half / (time.perf_counter() - t0)
+
+    rest = images[half:]
+    t0 = time.perf_counter()
+    for start in range(0, len(rest), batch_size):
+        chunk = rest[start:start + batch_size]
+        files = [("files", (f"batch_{start + i}.jpg", data, "image/jpeg")) for i, data in enumerate(chunk)]
+        metadata = [{"original_path": f"/bench/batch/{start + i}.jpg", "localidad": "Córdoba Capital",
+                     "categoria": "Benchmark"} for i in range(len(chunk))]
+        response = await client.post("/index/batch", files=files, data={"metadata": json.dumps(metadata)})
+        response.raise_for_status()
+    batched = len(rest) / (time.perf_counter() - t0)
+    return single, batched
+
+
+def measure(rows: int, queries, args):
+    """Mide búsqueda e indexación sobre la base de este directorio."""
+    import httpx
+
+    t0 = time.perf_counter()
+    import app
+    _use_stub_encoder(app)
+    app.start_background_loading()
+    app.model_ready.wait()
+    app.vectors_ready.wait()
+    result = {"filas": rows, "arranque_s": round(time.perf_counter() - t0, 3), "arranque": dict(app.startup_times)}
+    result["indice_aproximado"] = app.ann.kind if app.ann is not None else None
+
+    async def run():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            search = {}
+            values = {name: _filter_values(app, facets) for name, facets in FILTER_SETS.items() if facets}
+            for mode in MODES:
+                search[mode] = {}
+                for name, facets in FILTER_SETS.items():
+                    params = {"mode": mode, "limit": args.limit, **values.get(name, {})}
+                    if facets and len(params) == 2:
+                        continue  # la base no tiene valores para esta faceta
+                    times = await _measure_search(client, queries, params, args.warmup)
+                    search[mode][name] = {"filtros": {k: v for k, v in params.items() if k in facets},
+                                          **_percentiles(times)}
+                    print(f"   {mode:8} {name:20} p50 {search[mode][name]['p50_ms']:8.2f} ms"
+                          f"  p99 {search[mode][name]['p99_ms']:8.2f} ms")
+            result["busqueda"] = search
+
+            if args.imagenes:
+                images = synthetic_jpegs(args.imagenes, seed=rows)
+                single, batched = await _measure_index(client, images, args.batch)
+                result["index"] = {"imagenes": len(images), "imagenes_por_s": round(single, 2),
+                                   "batch_imagenes_por_s": round(batched, 2), "batch": args.batch}
+                print(f"   /index {single:.1f} img/s, /index/batch {batched:.1f} img/s")
+
+    asyncio.run(run())
+
+    if args.imagenes:
+        result["bulk_index"] = measure_bulk_index(rows, args)
+
+    # Dejar la base como se generó para la próxima corrida
+    with app.db.writer() as conn:
+        conn.execute("DELETE FROM imagenes WHERE id > ?", (rows,))
+    return result
+
+
+def measure_bulk_index(rows: int, args):
+    import bulk_index
+
+    source = os.path.abspath("../fuente")
+    os.makedirs(source, exist_ok=True)
+    filas = []
+    for i, data in enumerate(synthetic_jpegs(args.imagenes, seed=rows + 1)):
+        path = os.path.join(source, f"bulk_{i}.jpg")
+        with open(path, "wb") as f:
+            f.write(data)
+        filas.append((path, "", "Córdoba Capital", "Benchmark", f"Bulk {i}"))
+    checkpoint = "../bench_checkpoint.json"
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    t0 = time.perf_counter()
+    indexed, _, errors = bulk_index.indexar(filas, args.workers, args.batch, 1024, checkpoint)
+    elapsed = time.perf_counter() - t0
+    result = {"imagenes": indexed, "errores": errors, "imagenes_por_s": round(indexed / elapsed, 2),
+              "workers": args.workers}
+    print(f"   bulk_index {result['imagenes_por_s']:.1f} img/s")
+    return result
+
+
+# --- Orquestación ---
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    backend = os.path.dirname(os.path.abspath(__file__))
+    metadata = read_metadata(args.csv)
+    report = {
+        "commit": _git_commit(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "maquina": {"cpus": os.cpu_count(), "plataforma": platform.platform(), "python": platform.python_version(),
+                    "numpy": np.__version__, "sqlite": sqlite3.sqlite_version},
+        "config": {"queries": args.queries, "limit": args.limit, "ann": args.ann, "imagenes": args.imagenes},
+        "resultados": [],
+    }
+
+    for rows in args.filas:
+        base = os.path.abspath(os.path.join(BENCH_DIR, str(rows)))
+        workdir = os.path.join(base, "backend")
+        os.makedirs(workdir, exist_ok=True)
+        db_path = os.path.join(base, "cordoba.db")
+
+        print(f"\n📊 {rows} filas ({base})")
+        existing = 0
+        if os.path.exists(db_path) and not args.regenerar:
+            with sqlite3.connect(db_path) as conn:
+                existing = conn.execute("SELECT COUNT(*) FROM imagenes").fetchone()[0]
+        generation = None
+        if existing != rows:
+            print("🔄 Generando base sintética...")
+            for leftover in ("cordoba.db-wal", "cordoba.db-shm", "cordoba.ann.npz"):
+                if os.path.exists(os.path.join(base, leftover)):
+                    os.remove(os.path.join(base, leftover))
+            shutil.rmtree(os.path.join(base, "embeddings"), ignore_errors=True)
+            t0 = time.perf_counter()
+            generate_db(db_path, rows, metadata)
+            generation = round(time.perf_counter() - t0, 2)
+        if args.ann and not any(name.startswith("cordoba.ann") for name in os.listdir(base)):
+            subprocess.run([sys.executable, os.path.join(backend, "ann_index.py"), "build"], cwd=workdir, check=True)
+
+        # Un proceso por tamaño: el backend lee ../cordoba.db, ../images, etc. relativos al cwd
+        output = os.path.join(base, "resultado.json")
+        env = {**os.environ, "INFERENCE_SOCKET": "", "QUERY_CACHE_SIZE": "0", "RANKING_CACHE_SIZE": "0",
+               "QUERY_CACHE_PATH": "", "NEIGHBORS_K": "0"}
+        command = [sys.executable, os.path.abspath(__file__), "medir", "--filas", str(rows), "--salida", output,
+                   "--queries-json", json.dumps(make_queries(metadata, args.queries)),
+                   "--limit", str(args.limit), "--warmup", str(args.warmup), "--imagenes", str(args.imagenes),
+                   "--batch", str(args.batch), "--workers", str(args.workers)]
+        subprocess.run(command, cwd=workdir, env=env, check=True)
+        with open(output) as f:
+            result = json.load(f)
+        result["generacion_s"] = generation
+        report["resultados"].append(result)
+        # Lo que se copió al medir la indexación, y el snapshot de embeddings (al
+        # borrar las filas agregadas ya no coincide con la base)
+        for generated in ("images", "thumbs", "fuente", "embeddings"):
+            shutil.rmtree(os.path.join(base, generated), ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as f:
+            f.write(text)
+        print(f"\n✅ Resultados en {args.salida}")
+    else:
+        print(text)
+
+
+def compare(before_path: str, after_path: str):
+    """Diferencias de p50/p95/p99 entre dos corridas (por tamaño, modo y filtros)."""
+    with open(before_path) as f:
+        before = {r["filas"]: r for r in json.load(f)["resultados"]}
+    with open(after_path) as f:
+        after_report = json.load(f)
+    for result in after_report["resultados"]:
+        previous = before.get(result["filas"])
+        if previous is None:
+            continue
+        print(f"\n📊 {result['filas']} filas")
+        for mode, by_filter in result.get("busqueda", {}).items():
+            for name, stats in by_filter.items():
+                old = previous.get("busqueda", {}).get(mode, {}).get(name)
+                if old is None:
+                    continue
+                deltas = "  ".join(
+                    f"{p} {old[f'{p}_ms']:8.2f} → {stats[f'{p}_ms']:8.2f} ms ({100 * (stats[f'{p}_ms'] / max(old[f'{p}_ms'], 1e-9) - 1):+.0f}%)"
+                    for p in ("p50", "p95", "p99")
+                )
+                print(f"   {mode:8} {name:20} {deltas}")
+        for key in ("index", "bulk_index"):
+            if key in result and key in previous:
+                print(f"   {key:29} {previous[key]['imagenes_por_s']:.1f} → {result[key]['imagenes_por_s']:.1f} img/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de búsqueda e indexación")
+    sub = parser.add_subparsers(dest="accion", required=True)
+
+    run_parser = sub.add_parser("run", help="Generar las bases y medir")
+    run_parser.add_argument("--filas", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    run_parser.add_argument("--csv", default="../metadata_cordoba.csv")
+    run_parser.add_argument("--queries", type=int, default=200, help="Queries por modo y filtro")
+    run_parser.add_argument("--salida", default=None, help="Archivo JSON (default: imprimir)")
+    run_parser.add_argument("--regenerar", action="store_true", help="Regenerar las bases aunque existan")
+    run_parser.add_argument("--ann", action="store_true", help="Construir el índice aproximado (se usa desde ANN_MIN_SIZE)")
+
+    measure_parser = sub.add_parser("medir", help=argparse.SUPPRESS)
+    measure_parser.add_argument("--filas", type=int, required=True)
+    measure_parser.add_argument("--salida", required=True)
+    measure_parser.add_argument("--queries-json", required=True)
+
+    for p in (run_parser, measure_parser):
+        p.add_argument("--limit", type=int, default=100, help="Resultados por búsqueda")
+        p.add_argument("--warmup", type=int, default=5, help="Búsquedas iniciales que no se cuentan")
+        p.add_argument("--imagenes", type=int, default=200, help="Imágenes para medir indexación (0 = no medir)")
+        p.add_argument("--batch", type=int, default=32, help="Imágenes por /index/batch y por pasada de bulk_index")
+        p.add_argument("--workers", type=int, default=os.cpu_count(), help="Procesos de bulk_index")
+
+    compare_parser = sub.add_parser("comparar", help="Comparar dos JSON de resultados")
+    compare_parser.add_argument("antes")
+    compare_parser.add_argument("despues")
+    args = parser.parse_args()
+
+    if args.accion == "run":
+        run(args)
+    elif args.accion == "medir":
+        result = measure(args.filas, json.loads(args.queries_json), args)
+        with open(args.salida, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    else:
+        compare(args.antes, args.despues)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Indexador masivo offline: indexa metadata_cordoba.csv sin pasar por HTTP.
+
+En vez de subir cada imagen a /index, usa directamente la lógica de app.py:
+- un pool de procesos lee, decodifica y achica las imágenes en paralelo
+  (las copia a ../images y genera sus miniaturas). Se achican con la misma
+  función que usa /index antes de CLIP, así que dan el mismo embedding
+- CLIP las procesa en batches
+- las filas se escriben en cordoba.db en transacciones grandes
+
+Es idempotente: las imágenes cuyo contenido (hash) y modelo no cambiaron
+se saltean sin pasar por CLIP, y un checkpoint permite retomar una corrida
+interrumpida sin volver a leer lo que ya se indexó.
+
+Puede correr con el backend levantado (la base está en modo WAL: las búsquedas
+no se bloquean), pero carga su propia copia del modelo. Los embeddings nuevos
+se agregan también al snapshot compartido (snapshot.py): el backend los toma
+sin reiniciar. Con EMBEDDING_SNAPSHOT=0 hay que reiniciarlo al terminar.
+
+Uso:
+    cd backend
+    python bulk_index.py
+    python bulk_index.py --workers 8 --batch 64 --limit 500
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+import neighbors
+from db import DB_PATH
+from inference import prepare_image
+from thumbnails import has_thumbnails, make_thumbnails
+
+
+def preparar_imagen(path: str, destino: str, hash_previo: str = None):
+    """
+    Decodifica y achica la imagen, la copia a ../images y genera las miniaturas.
+
+    Corre en los procesos del pool. Devuelve (hash, modo, tamaño, bytes)
+    para que viaje barato entre procesos, (hash,) si el contenido es igual
+    a `hash_previo` (no hay nada que hacer), o un string con el error.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        file_hash = hashlib.sha256(data).hexdigest()
+        if file_hash == hash_previo:
+            return (file_hash,)
+
+        with Image.open(io.BytesIO(data)) as img:
+            # Decodificación completa (sin draft): CLIP tiene que ver los mismos
+            # píxeles que con /index, si no el mismo archivo daría otro embedding
+            img.load()
+            if not has_thumbnails(file_hash):
+                make_thumbnails(img, file_hash)
+            img = prepare_image(img)
+        # Se copia solo si se pudo decodificar
+        with open(destino, "wb") as f:
+            f.write(data)
+        return file_hash, img.mode, img.size, img.tobytes()
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def preparar_lote(tareas):
+    """Prepara un lote entero de imágenes (una tarea del pool por lote)."""
+    return [preparar_imagen(path, destino, hash_previo) for path, destino, hash_previo in tareas]
+
+
+def leer_csv(csv_path: str, limit: int = None):
+    """Filas del CSV como tuplas (path, barrio, localidad, categoria, descripcion)."""
+    df = pd.read_csv(csv_path)
+    if limit:
+        df = df.head(limit)
+    filas = []
+    for row in df.itertuples(index=False):
+        filas.append((
+            row.path,
+            row.barrio if pd.notna(row.barrio) else '',
+            row.localidad,
+            row.categoria,
+            row.descripcion if pd.notna(row.descripcion) else '',
+        ))
+    return filas
+
+
+def indexar(filas, workers: int, batch: int, commit_every: int, checkpoint_path: str):
+    # Se importa acá (y no arriba) para que los procesos del pool no carguen el modelo
+    import app
+    from checkpoint import Checkpoint
+    from db import connect
+
+    app.load_model()
+    checkpoint = Checkpoint(checkpoint_path, app.INDEX_VERSION, save_every=commit_every)
+    # En WAL el backend puede seguir respondiendo búsquedas mientras esto escribe
+    conn = connect(app.DB_PATH)
+    c = conn.cursor()
+
+    indexed = 0
+    skipped = 0
+    errors = 0
+    pendientes = []  # filas listas para escribir (con embedding y hash)
+    sin_cambios = []  # (id, barrio, localidad, categoria, descripcion, path)
+
+    def escribir():
+        nonlocal pendientes, sin_cambios
+        if pendientes:
+            row_ids = app.upsert_images(conn, pendientes)
+            if app.snapshot is not None:
+                app.snapshot.append(row_ids, [f[6] for f in pendientes])
+        # Sin cambios de imagen: solo refrescar la metadata por si cambió en el CSV
+        app.update_metadata(conn, [u[:5] for u in sin_cambios])
+        # Con la metadata: si después cambia en el CSV, la fila se vuelve a procesar
+        for fila in pendientes:
+            checkpoint.mark_done(fila[1], fila[2:6])
+        for u in sin_cambios:
+            checkpoint.mark_done(u[5], u[1:5])
+        checkpoint.save()
+        pendientes, sin_cambios = [], []
+
+    existentes = []
+    for fila in filas:
+        if not os.path.exists(fila[0]):
+            tqdm.write(f"❌ No existe: {fila[0]}")
+            errors += 1
+        elif checkpoint.is_done(fila[0], fila[1:]):
+            skipped += 1
+        else:
+            existentes.append(fila)
+    if skipped:
+        print(f"⏭️  {skipped} imágenes ya indexadas según el checkpoint")
+
+    lotes = [existentes[i:i + batch] for i in range(0, len(existentes), batch)]
+    progreso = tqdm(total=len(existentes), unit="img", desc="Indexando")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        en_vuelo = deque()
+        siguiente = 0
+
+        while siguiente < len(lotes) or en_vuelo:
+            # Mantener unos pocos lotes decodificándose por adelantado (memoria acotada)
+            while siguiente < len(lotes) and len(en_vuelo) < workers * 2:
+                lote = lotes[siguiente]
+                previas = app.find_indexed(c, [f[0] for f in lote])
+                destinos = [app.stored_name(f[0], os.path.basename(f[0])) for f in lote]
+                tareas = []
+                for fila, destino in zip(lote, destinos):
+                    previa = previas.get(fila[0])
+                    # Solo se puede saltear si además se indexó con el modelo actual
+                    hash_previo = previa[2] if previa and previa[3] == app.MODEL_VERSION else None
+                    tareas.append((fila[0], f"../images/{destino}", hash_previo))
+                en_vuelo.append((lote, destinos, previas, pool.submit(preparar_lote, tareas)))
+                siguiente += 1
+
+            lote, destinos, previas, futuro = en_vuelo.popleft()
+            imagenes, filas_ok = [], []
+            for fila, destino, resultado in zip(lote, destinos, futuro.result()):
+                if isinstance(resultado, str):
+                    tqdm.write(f"❌ Error en {fila[0]}: {resultado}")
+                    errors += 1
+                elif len(resultado) == 1:
+                    sin_cambios.append((previas[fila[0]][0],) + fila[1:] + (fila[0],))
+                    skipped += 1
+                else:
+                    file_hash, modo, tamano, data = resultado
+                    imagenes.append(Image.frombytes(modo, tamano, data))
+                    filas_ok.append(((destino,) + fila, file_hash))
+
+            if imagenes:
+                # Copias idénticas de imágenes ya indexadas reusan su embedding
+                conocidos = app.find_embeddings(c, [h for _, h in filas_ok])
+                a_calcular = [i for i, (_, h) in enumerate(filas_ok) if h not in conocidos]
+                calculados = app.scheduler.encode("image", [imagenes[i] for i in a_calcular])
+                for i, emb in zip(a_calcular, calculados):
+                    conocidos[filas_ok[i][1]] = emb
+                pendientes.extend(fila + (conocidos[h], h) for fila, h in filas_ok)
+                indexed += len(imagenes)
+
+            if len(pendientes) + len(sin_cambios) >= commit_every:
+                escribir()
+            progreso.update(len(lote))
+
+    escribir()
+    checkpoint.save()
+    progreso.close()
+    conn.close()
+    return indexed, skipped, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexación masiva offline desde el CSV")
+    parser.add_argument("--csv", default="../metadata_cordoba.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Procesos para decodificar imágenes")
+    parser.add_argument("--batch", type=int, default=64, help="Imágenes por pasada de CLIP")
+    parser.add_argument("--commit-every", type=int, default=1024,
+                        help="Filas por transacción de SQLite")
+    parser.add_argument("--limit", type=int, default=None, help="Indexar solo las primeras N filas")
+    parser.add_argument("--checkpoint", default="../indexado_checkpoint.json",
+                        help="Archivo de checkpoint (para retomar corridas interrumpidas)")
+    args = parser.parse_args()
+
+    filas = leer_csv(args.csv, args.limit)
+    print(f"📁 Encontradas {len(filas)} imágenes en el CSV\n")
+
+    t0 = time.perf_counter()
+    indexed, skipped, errors = indexar(filas, args.workers, args.batch, args.commit_every, args.checkpoint)
+    elapsed = time.perf_counter() - t0
+
+    print(f"\n🎉 Indexación completa en {elapsed / 60:.1f} min ({indexed / max(elapsed, 1e-9):.1f} img/s)")
+    print(f"✅ Éxitos: {indexed}")
+    print(f"⏭️  Sin cambios: {skipped}")
+    print(f"❌ Errores: {errors}")
+
+    if indexed and neighbors.NEIGHBORS_K > 0:
+        # Listas de vecinos de /similar para lo que se acaba de indexar
+        print("\n🔄 Calculando vecinos...")
+        neighbors.build(DB_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Checkpoint de indexación: qué archivos ya se indexaron (y con qué tamaño,
+fecha de modificación y metadata), para que una corrida interrumpida se pueda
+retomar y una re-corrida sobre un archivo sin cambios no vuelva a leer las
+imágenes. Si cambia la metadata (ej. una fila editada en el CSV) el archivo
+ya no cuenta como hecho y el indexador la actualiza.
+
+Lo usan index_from_csv.py, additional_index.py y bulk_index.py.
+"""
+
+import hashlib
+import json
+import os
+
+
+class Checkpoint:
+    def __init__(self, path: str, version: str, save_every: int = 50):
+        """
+        Args:
+            path: Archivo JSON del checkpoint
+            version: Modelo con el que se indexó; si cambia, se descarta
+                el checkpoint y se re-indexa todo
+            save_every: Cada cuántas marcas se guarda a disco
+        """
+        self.path = path
+        self.version = version
+        self.save_every = save_every
+        self._done = {}  # path -> [tamaño, mtime_ns, hash de la metadata]
+        self._unsaved = 0
+
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                if data.get("version") == version:
+                    self._done = data.get("archivos", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️  Checkpoint ilegible ({e}), se arranca de cero")
+
+    def __len__(self):
+        return len(self._done)
+
+    @staticmethod
+    def _firma(path: str, metadata):
+        st = os.stat(path)
+        data = json.dumps(list(metadata), ensure_ascii=False, default=str).encode()
+        return [st.st_size, st.st_mtime_ns, hashlib.sha1(data).hexdigest()]
+
+    def is_done(self, path: str, metadata=()) -> bool:
+        """
+        True si el archivo ya se indexó con esta metadata y no cambió desde entonces.
+
+        Args:
+            path: Archivo de la imagen
+            metadata: Los campos que se mandan al indexar (barrio, localidad, ...)
+        """
+        firma = self._done.get(str(path))
+        if firma is None:
+            return False
+        try:
+            return firma == self._firma(path, metadata)
+        except OSError:
+            return False
+
+    def mark_done(self, path: str, metadata=()):
+        try:
+            self._done[str(path)] = self._firma(path, metadata)
+        except OSError:
+            return
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        """Guarda el checkpoint (escritura atómica)."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": self.version, "archivos": self._done}, f)
+        os.replace(tmp, self.path)
+        self._unsaved = 0
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Backends de inferencia de CLIP en CPU.
+
+- "torch" (default): el SentenceTransformer en float32, tal cual.
+- "int8": el mismo modelo con cuantización dinámica a int8 de las capas
+  lineales (los pesos se guardan en int8 y las activaciones se cuantizan al
+  vuelo). En CPU el encoder de texto y el de imagen corren varias veces más
+  rápido, con una pérdida de calidad chica que se mide con `check`.
+
+Los embeddings de los dos backends están en el mismo espacio, pero no son
+iguales: cada imagen guarda con qué backend se calculó (`model_version`) y
+al cambiar de backend los indexadores la vuelven a calcular. `check` mide
+cuánto cambian los resultados.
+
+Uso:
+    cd backend
+    python clip_backends.py check                       # int8 vs torch sobre 200 imágenes
+    python clip_backends.py check --muestra 500 --k 20 --salida check.json
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+
+import numpy as np
+from PIL import Image
+
+INFERENCE_BACKENDS = ("torch", "int8")
+
+
+def load_clip(model_name: str, backend: str = "torch", threads: int = 0):
+    """
+    Carga CLIP con el backend pedido.
+
+    Args:
+        model_name: Modelo de sentence-transformers (ej. 'clip-ViT-B-32')
+        backend: "torch" o "int8"
+        threads: Threads de torch para la inferencia (0 = default de torch)
+
+    Returns:
+        Un SentenceTransformer, con `encode`
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Backend de inferencia desconocido: {backend} (opciones: {', '.join(INFERENCE_BACKENDS)})")
+
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    model = SentenceTransformer(model_name, device="cpu")
+    if backend == "int8":
+        import torch
+        from torch.ao.quantization import quantize_dynamic
+        quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def _timed_encode(model, items, batch_size):
+    t0 = time.perf_counter()
+    embeddings = model.encode(items, batch_size=batch_size)
+    return _normalize(embeddings), time.perf_counter() - t0
+
+
+def _overlap(reference, candidate, k):
+    """Promedio de |top-k referencia ∩ top-k candidato| / k por query."""
+    ref_top = np.argsort(-reference, axis=1)[:, :k]
+    cand_top = np.argsort(-candidate, axis=1)[:, :k]
+    return float(np.mean([len(set(r) & set(c)) / k for r, c in zip(ref_top, cand_top)]))
+
+
+def accuracy_check(model_name: str, backend: str, db_path: str, sample: int, k: int, batch_size: int = 32):
+    """
+    Compara un backend contra el modelo de referencia (torch float32) sobre
+    una muestra del archivo.
+
+    Mide:
+    - similitud coseno entre el embedding de referencia y el del backend,
+      para imágenes y para textos (las descripciones de la muestra)
+    - overlap@k del ranking texto→imagen: todo con el backend, y queries del
+      backend contra embeddings de referencia (lo que pasa al cambiar de
+      backend sin re-indexar)
+    - imágenes/s y latencia por query de cada uno
+    """
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        "SELECT filename, descripcion FROM imagenes ORDER BY RANDOM() LIMIT ?", (sample,)
+    ).fetchall()
+    conn.close()
+
+    images, queries = [], []
+    for filename, descripcion in rows:
+        try:
+            with Image.open(f"../images/{filename}") as img:
+                images.append(img.convert("RGB"))
+        except OSError:
+            continue
+        if descripcion and descripcion != "[REVISAR]":
+            queries.append(descripcion)
+    queries = list(dict.fromkeys(queries))[:100] or ["plaza", "iglesia", "tranvía", "calle empedrada", "río"]
+    if len(images) < k:
+        raise ValueError(f"Hacen falta al menos {k} imágenes en ../images para medir top-{k}")
+
+    print(f"🔄 Modelo de referencia (torch) y backend {backend}...")
+    reference = load_clip(model_name, "torch")
+    candidate = load_clip(model_name, backend)
+
+    results = {"backend": backend, "imagenes": len(images), "queries": len(queries), "k": k}
+    encoded = {}
+    for name, model in (("torch", reference), (backend, candidate)):
+        model.encode(queries[:1])  # calentar
+        image_emb, image_time = _timed_encode(model, images, batch_size)
+        # Latencia de query: de a una, como llegan a /search
+        t0 = time.perf_counter()
+        text_emb = _normalize(np.stack([model.encode(q) for q in queries]))
+        text_time = time.perf_counter() - t0
+        encoded[name] = (image_emb, text_emb)
+        results[f"velocidad_{name}"] = {
+            "imagenes_por_s": len(images) / image_time,
+            "ms_por_query": 1000 * text_time / len(queries),
+        }
+
+    ref_images, ref_texts = encoded["torch"]
+    cand_images, cand_texts = encoded[backend]
+    image_cos = np.sum(ref_images * cand_images, axis=1)
+    text_cos = np.sum(ref_texts * cand_texts, axis=1)
+    reference_scores = ref_texts @ ref_images.T
+
+    results["coseno_imagenes"] = {"media": float(image_cos.mean()), "minimo": float(image_cos.min())}
+    results["coseno_textos"] = {"media": float(text_cos.mean()), "minimo": float(text_cos.min())}
+    results[f"overlap@{k}"] = _overlap(reference_scores, cand_texts @ cand_images.T, k)
+    results[f"overlap@{k}_sin_reindexar"] = _overlap(reference_scores, cand_texts @ ref_images.T, k)
+    results["aceleracion"] = {
+        "imagenes": results[f"velocidad_{backend}"]["imagenes_por_s"] / results["velocidad_torch"]["imagenes_por_s"],
+        "queries": results["velocidad_torch"]["ms_por_query"] / results[f"velocidad_{backend}"]["ms_por_query"],
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backends de inferencia de CLIP")
+    sub = parser.add_subparsers(dest="accion", required=True)
+    check = sub.add_parser("check", help="Comparar un backend contra el modelo de referencia")
+    check.add_argument("--backend", default="int8", choices=[b for b in INFERENCE_BACKENDS if b != "torch"])
+    check.add_argument("--muestra", type=int, default=200, help="Imágenes de la muestra")
+    check.add_argument("--k", type=int, default=10)
+    check.add_argument("--db", default="../cordoba.db")
+    check.add_argument("--modelo", default="clip-ViT-B-32")
+    check.add_argument("--salida", default=None, help="Guardar el resultado en un JSON")
+    args = parser.parse_args()
+
+    results = accuracy_check(args.modelo, args.backend, args.db, args.muestra, args.k)
+    k = args.k
+    print(f"\n📊 {args.backend} vs torch ({results['imagenes']} imágenes, {results['queries']} queries)")
+    print(f"   coseno imágenes: media {results['coseno_imagenes']['media']:.4f}, mínimo {results['coseno_imagenes']['minimo']:.4f}")
+    print(f"   coseno textos:   media {results['coseno_textos']['media']:.4f}, mínimo {results['coseno_textos']['minimo']:.4f}")
+    print(f"   overlap@{k}: {results[f'overlap@{k}']:.3f} (sin re-indexar: {results[f'overlap@{k}_sin_reindexar']:.3f})")
+    for name in ("torch", args.backend):
+        speed = results[f"velocidad_{name}"]
+        print(f"   {name}: {speed['imagenes_por_s']:.1f} img/s, {speed['ms_por_query']:.1f} ms/query")
+    print(f"   aceleración: x{results['aceleracion']['imagenes']:.1f} imágenes, x{results['aceleracion']['queries']:.1f} queries")
+
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Conexiones a SQLite compartidas por todos los endpoints.
+
+Antes cada request abría y cerraba su propia conexión (y con ella perdía el
+cache de páginas y de sentencias preparadas), y las escrituras con el journal
+por defecto bloqueaban las búsquedas mientras duraba una indexación. Acá hay
+un pool de conexiones de solo lectura más una única conexión de escritura,
+con la base en modo WAL: los lectores no esperan al escritor (ni a otro
+proceso que esté indexando, como bulk_index.py).
+
+Regla: una conexión del pool no se retiene a través de un `await`; se pide,
+se usa y se devuelve en código sincrónico.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = "../cordoba.db"
+
+# Conexiones de solo lectura en el pool
+SQLITE_READERS = int(os.environ.get("SQLITE_READERS", "4"))
+# Bytes de la base mapeados en memoria (lecturas sin copiar al cache de SQLite)
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Cache de páginas por conexión, en KiB
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", str(64 * 1024)))
+# Cuánto espera una escritura si otro proceso tiene el lock (ms)
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+# Cuánto espera un request por una conexión de lectura si están todas en uso
+# (segundos; se espera en el event loop, así que tiene que ser corto)
+SQLITE_READER_TIMEOUT = float(os.environ.get("SQLITE_READER_TIMEOUT", "1"))
+# Sentencias preparadas que guarda cada conexión (se reusan por texto de la query)
+SQLITE_CACHED_STATEMENTS = 256
+
+
+class ReaderUnavailable(RuntimeError):
+    """Todas las conexiones de lectura siguen en uso después de SQLITE_READER_TIMEOUT."""
+
+
+def connect(path: str = DB_PATH, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Abre una conexión con los pragmas de rendimiento.
+
+    Las conexiones de escritura quedan en autocommit (isolation_level=None):
+    las transacciones se abren explícitamente con BEGIN / BEGIN IMMEDIATE.
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                               cached_statements=SQLITE_CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                               cached_statements=SQLITE_CACHED_STATEMENTS)
+        # WAL queda guardado en el archivo: alcanza con pedirlo al escribir
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path: str = DB_PATH, readers: int = SQLITE_READERS,
+                 reader_timeout: float = SQLITE_READER_TIMEOUT):
+        """
+        Args:
+            path: Archivo de la base (se crea si no existe)
+            readers: Máximo de conexiones de solo lectura (se abren a demanda)
+            reader_timeout: Segundos de espera por una conexión de lectura libre
+        """
+        self.path = path
+        self.max_readers = max(readers, 1)
+        self.reader_timeout = reader_timeout
+        # La de escritura se abre primero: crea el archivo y lo pasa a WAL
+        self._writer = connect(path)
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._opened = 0
+        self._open_lock = threading.Lock()
+        self._closed = False
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._open_lock:
+            if self._opened < self.max_readers:
+                self._opened += 1
+                return connect(self.path, readonly=True)
+        # Sin espera indefinida: puede estar corriendo en el event loop
+        try:
+            return self._readers.get(timeout=self.reader_timeout)
+        except queue.Empty:
+            raise ReaderUnavailable(f"Las {self.max_readers} conexiones de lectura están en uso") from None
+
+    @contextmanager
+    def reader(self):
+        """
+        Conexión de solo lectura del pool.
+
+        Si están todas en uso espera hasta `reader_timeout` segundos y después
+        levanta ReaderUnavailable (el backend responde 503).
+        """
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """La única conexión de escritura (una escritura a la vez en este proceso)."""
+        with self._writer_lock:
+            yield self._writer
+
+    def config(self) -> dict:
+        """
+        Configuración efectiva de la base (para el reporte al iniciar).
+
+        Usa la conexión de escritura (synchronous es de esa conexión), así que
+        espera a cualquier escritura en curso: se lee una vez al iniciar y no
+        desde un request.
+        """
+        with self.writer() as conn:
+            pragma = lambda name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+            return {
+                "path": os.path.abspath(self.path),
+                "sqlite": sqlite3.sqlite_version,
+                "journal_mode": pragma("journal_mode"),
+                "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA")[pragma("synchronous")],
+                "mmap_size": pragma("mmap_size"),
+                "cache_size_kb": -pragma("cache_size") if pragma("cache_size") < 0
+                                 else pragma("cache_size") * pragma("page_size") // 1024,
+                "page_size": pragma("page_size"),
+                "lectores": self.max_readers,
+            }
+
+    def close(self):
+        self._closed = True
+        with self._writer_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
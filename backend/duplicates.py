@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Detección de casi-duplicados en todo el archivo.
+
+Las mismas fotos están en varias carpetas (igallery/original, comparativas,
+favoritas, cordobazo...) y se indexan una vez por cada ruta, así que las
+búsquedas se llenan de copias. Este job agrupa las imágenes cuyos embeddings
+son casi iguales y guarda en `imagenes.cluster_id` el id de la primera
+imagen de cada grupo; /search muestra una sola por grupo sin costo extra por
+query (el backend lo resuelve en memoria al cargar los embeddings).
+
+La comparación de todos contra todos se hace con productos de matrices por
+bloques: la memoria queda acotada aunque el archivo tenga 100k+ imágenes.
+Con --phash, los pares en la zona gris (similitud entre PHASH_THRESHOLD y
+DUPLICATE_THRESHOLD) se desempatan con un hash perceptual (dHash) de las
+miniaturas.
+
+Uso:
+    cd backend
+    python duplicates.py                   # agrupar y guardar en la DB
+    python duplicates.py --phash           # desempatar la zona gris con dHash
+    python duplicates.py --umbral 0.97 --prueba   # solo mostrar qué agruparía
+
+El backend toma los grupos nuevos solo (revisa cada CLUSTERS_POLL_SECONDS si
+el job volvió a guardar), sin reiniciarlo.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from neighbors import BLOCK_FLOATS
+from thumbnails import THUMB_DIR, THUMB_SIZES, thumb_name
+
+# Similitud coseno a partir de la cual dos imágenes son la misma foto
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", "0.96"))
+# Con --phash: desde acá hasta DUPLICATE_THRESHOLD decide el hash perceptual
+PHASH_THRESHOLD = float(os.environ.get("PHASH_THRESHOLD", "0.92"))
+# Bits distintos (de 64) para que el dHash considere iguales dos imágenes
+PHASH_MAX_DISTANCE = 10
+
+
+def init_clusters(c):
+    """Agrega `cluster_id` a bases creadas antes de que existiera."""
+    columnas = {r[1] for r in c.execute("PRAGMA table_info(imagenes)")}
+    if "cluster_id" not in columnas:
+        c.execute("ALTER TABLE imagenes ADD COLUMN cluster_id INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cluster_id ON imagenes(cluster_id, id)")
+
+
+def clusters_generation(c) -> int:
+    """Cuántas veces se guardaron grupos (cambia con cada write_clusters)."""
+    row = c.execute("SELECT valor FROM config WHERE clave = 'clusters'").fetchone()
+    return int(row[0]) if row is not None else 0
+
+
+def load_clusters(c) -> dict:
+    """Los grupos guardados: id -> id del grupo, solo de las imágenes con copias."""
+    return dict(c.execute("SELECT id, cluster_id FROM imagenes WHERE cluster_id IS NOT NULL"))
+
+
+def similar_pairs(matrix: np.ndarray, threshold: float):
+    """
+    Todos los pares (i, j), i < j, con similitud >= threshold.
+
+    Recorre el triángulo superior de matrix @ matrix.T por bloques de filas
+    de a lo sumo BLOCK_FLOATS similitudes.
+
+    Returns:
+        (filas_i, filas_j, similitudes)
+    """
+    n = len(matrix)
+    found_i, found_j, found_sims = [], [], []
+    start = 0
+    while start < n:
+        # Cada bloque solo compara contra las filas siguientes: los bloques son cada vez más baratos
+        block = max(1, BLOCK_FLOATS // max(n - start, 1))
+        rows = matrix[start:start + block]
+        scores = rows @ matrix[start:].T
+        i, j = np.nonzero(scores >= threshold)
+        upper = j > i
+        i, j = i[upper], j[upper]
+        found_i.append(i + start)
+        found_j.append(j + start)
+        found_sims.append(scores[i, j])
+        start += len(rows)
+    if not found_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_sims)
+
+
+def dhash(path: str, size: int = 8) -> int:
+    """Hash perceptual (diferencia de brillo entre píxeles vecinos), 64 bits."""
+    with Image.open(path) as img:
+        img.draft("L", (size * 4, size * 4))
+        small = np.asarray(img.convert("L").resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def _image_path(filename: str, content_hash: str) -> str:
+    """La miniatura chica si existe (decodifica mucho más rápido), si no el original."""
+    if content_hash:
+        thumb = os.path.join(THUMB_DIR, thumb_name(content_hash, min(THUMB_SIZES)))
+        if os.path.exists(thumb):
+            return thumb
+    return f"../images/{filename}"
+
+
+def group(n: int, pairs_i: np.ndarray, pairs_j: np.ndarray) -> np.ndarray:
+    """
+    Componentes conexas de los pares (union-find).
+
+    Returns:
+        Por cada fila, la menor fila de su grupo
+    """
+    parent = np.arange(n)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for i, j in zip(pairs_i.tolist(), pairs_j.tolist()):
+        a, b = find(i), find(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    return np.array([find(x) for x in range(n)], dtype=np.int64)
+
+
+def find_clusters(conn, threshold: float = DUPLICATE_THRESHOLD, use_phash: bool = False,
+                  phash_threshold: float = PHASH_THRESHOLD, max_distance: int = PHASH_MAX_DISTANCE):
+    """
+    Agrupa las imágenes casi duplicadas de la DB.
+
+    Returns:
+        (clusters, stats): clusters es id -> id del grupo (la menor del grupo),
+        solo para las imágenes que tienen al menos una copia
+    """
+    from vector_store import EmbeddingStore
+
+    store = EmbeddingStore()
+    store.load_from_db(conn)
+    ids = store.ids
+    stats = {"imagenes": len(store)}
+
+    t0 = time.perf_counter()
+    low = min(phash_threshold, threshold) if use_phash else threshold
+    pairs_i, pairs_j, sims = similar_pairs(store.matrix, low)
+    stats["pares"] = int(np.count_nonzero(sims >= threshold))
+    stats["segundos_similitud"] = round(time.perf_counter() - t0, 2)
+
+    if use_phash:
+        # Zona gris: solo si el hash perceptual también dice que son la misma foto
+        gray = sims < threshold
+        paths = {}
+        for row_id, filename, content_hash in conn.execute("SELECT id, filename, content_hash FROM imagenes"):
+            paths[row_id] = (filename, content_hash)
+        hashes = {}
+
+        def phash(pos):
+            if pos not in hashes:
+                try:
+                    hashes[pos] = dhash(_image_path(*paths[int(ids[pos])]))
+                except (OSError, KeyError):
+                    hashes[pos] = None
+            return hashes[pos]
+
+        accepted = np.ones(len(sims), dtype=bool)
+        for k in np.nonzero(gray)[0]:
+            a, b = phash(pairs_i[k]), phash(pairs_j[k])
+            accepted[k] = a is not None and b is not None and bin(a ^ b).count("1") <= max_distance
+        stats["pares_zona_gris"] = int(np.count_nonzero(gray))
+        stats["pares_por_phash"] = int(np.count_nonzero(gray & accepted))
+        pairs_i, pairs_j = pairs_i[accepted], pairs_j[accepted]
+
+    roots = group(len(ids), pairs_i, pairs_j)
+    grouped = np.nonzero(roots != np.arange(len(ids)))[0]
+    members = np.union1d(grouped, roots[grouped])
+    clusters = {int(ids[pos]): int(ids[roots[pos]]) for pos in members}
+    stats["grupos"] = len(np.unique(roots[grouped]))
+    stats["ocultas"] = len(grouped)
+    return clusters, stats
+
+
+def write_clusters(conn, clusters: dict):
+    """
+    Reemplaza los `cluster_id` guardados (las imágenes sin copias quedan en NULL)
+    y sube la generación de grupos, para que el backend los recargue.
+    """
+    conn.execute("BEGIN")
+    try:
+        conn.execute("UPDATE imagenes SET cluster_id = NULL WHERE cluster_id IS NOT NULL")
+        conn.executemany("UPDATE imagenes SET cluster_id = ? WHERE id = ?",
+                         [(cluster, row_id) for row_id, cluster in clusters.items()])
+        conn.execute("""
+            INSERT INTO config (clave, valor) VALUES ('clusters', '1')
+            ON CONFLICT (clave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1
+        """)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agrupar imágenes casi duplicadas")
+    parser.add_argument("--db", default="../cordoba.db")
+    parser.add_argument("--umbral", type=float, default=DUPLICATE_THRESHOLD,
+                        help="Similitud coseno mínima para considerar dos imágenes la misma foto")
+    parser.add_argument("--phash", action="store_true", help="Desempatar la zona gris con un hash perceptual")
+    parser.add_argument("--umbral-phash", type=float, default=PHASH_THRESHOLD,
+                        help="Desde qué similitud se consulta el hash perceptual (con --phash)")
+    parser.add_argument("--distancia", type=int, default=PHASH_MAX_DISTANCE,
+                        help="Bits distintos del dHash (de 64) que se aceptan")
+    parser.add_argument("--prueba", action="store_true", help="No guardar, solo mostrar los grupos")
+    args = parser.parse_args()
+
+    from db import connect
+
+    conn = connect(args.db)
+    init_clusters(conn.cursor())
+    t0 = time.perf_counter()
+    clusters, stats = find_clusters(conn, args.umbral, args.phash, args.umbral_phash, args.distancia)
+    print(f"📁 {stats['imagenes']} imágenes, {stats['pares']} pares sobre {args.umbral}"
+          f" ({stats['segundos_similitud']}s)")
+    if args.phash:
+        print(f"   zona gris: {stats['pares_zona_gris']} pares, {stats['pares_por_phash']} aceptados por dHash")
+    print(f"🔗 {stats['grupos']} grupos, {stats['ocultas']} copias se colapsan en las búsquedas")
+
+    # Algunos ejemplos de los grupos más grandes
+    by_cluster = {}
+    for row_id, cluster in clusters.items():
+        by_cluster.setdefault(cluster, []).append(row_id)
+    for members in sorted(by_cluster.values(), key=len, reverse=True)[:5]:
+        sample = sorted(members)[:3]
+        placeholders = ",".join("?" * len(sample))
+        paths = [p for (p,) in conn.execute(f"SELECT original_path FROM imagenes WHERE id IN ({placeholders}) ORDER BY id", sample)]
+        print(f"   {len(members)}: " + ", ".join(paths))
+
+    if not args.prueba:
+        write_clusters(conn, clusters)
+        print(f"✅ Guardado en {time.perf_counter() - t0:.1f}s (el backend lo aplica en unos segundos, sin reiniciar)")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
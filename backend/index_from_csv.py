@@ -3,6 +3,20 @@ import pandas as pd
 import os
 from pathlib import Path
 import shutil
+import time
+
+from checkpoint import Checkpoint
+
+API_URL = 'http://localhost:8000'
+
+# El backend responde apenas arranca, pero para indexar necesita tener el modelo cargado
+while requests.get(f'{API_URL}/health/ready').status_code != 200:
+    print("⏳ Esperando que el backend termine de cargar el modelo...")
+    time.sleep(5)
+
+# Archivos ya indexados (para retomar una corrida interrumpida y no volver
+# a subir imágenes que no cambiaron)
+checkpoint = Checkpoint('../indexado_checkpoint.json', requests.get(f'{API_URL}/').json()['index_version'])
 
 # Leer CSV
 df = pd.read_csv('../metadata_cordoba.csv')
@@ -13,6 +27,7 @@ print(f"📁 Encontradas {len(df)} imágenes en el CSV\n")
 # df = df.head(100)  # Descomentá esto para probar con pocas imágenes primero
 
 indexed = 0
+skipped = 0
 errors = 0
 
 for idx, row in df.iterrows():
@@ -24,20 +39,30 @@ for idx, row in df.iterrows():
         continue
     
     # Preparar datos
+    data = {
+        'original_path': path,
+        'barrio': row['barrio'] if pd.notna(row['barrio']) else '',
+        'localidad': row['localidad'],
+        'categoria': row['categoria'],
+        'descripcion': row['descripcion'] if pd.notna(row['descripcion']) else ''
+    }
+    metadata = (data['barrio'], data['localidad'], data['categoria'], data['descripcion'])
+    
+    # Si cambió la metadata en el CSV no se saltea: /index la actualiza
+    if checkpoint.is_done(path, metadata):
+        skipped += 1
+        continue
+    
     try:
         with open(path, 'rb') as f:
             files = {'file': (os.path.basename(path), f, 'image/jpeg')}
-            data = {
-                'original_path': path,
-                'barrio': row['barrio'] if pd.notna(row['barrio']) else '',
-                'localidad': row['localidad'],
-                'categoria': row['categoria'],
-                'descripcion': row['descripcion'] if pd.notna(row['descripcion']) else ''
-            }
-            
-            response = requests.post('http://localhost:8000/index', files=files, data=data)
+            response = requests.post(f'{API_URL}/index', files=files, data=data)
             response.raise_for_status()
-            indexed += 1
+            checkpoint.mark_done(path, metadata)
+            if response.json()['status'] == 'unchanged':
+                skipped += 1
+            else:
+                indexed += 1
             
             if indexed % 50 == 0:
                 print(f"✅ Indexadas: {indexed}/{len(df)}")
@@ -46,6 +71,9 @@ for idx, row in df.iterrows():
         print(f"❌ Error en {path}: {e}")
         errors += 1
 
+checkpoint.save()
+
 print(f"\n🎉 Indexación completa!")
 print(f"✅ Éxitos: {indexed}")
+print(f"⏭️  Sin cambios: {skipped}")
 print(f"❌ Errores: {errors}")
@@ -0,0 +1,174 @@
+"""
+Scheduler de inferencia CLIP: corre model.encode en un thread aparte y
+junta en micro-batches los pedidos que llegan casi al mismo tiempo.
+
+Así los handlers async no bloquean el event loop de uvicorn mientras se
+calcula un embedding, y varias búsquedas concurrentes comparten una sola
+pasada del modelo en lugar de hacer fila.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+# Lado menor con el que CLIP (ViT-B/32) ve las imágenes
+CLIP_IMAGE_SIZE = 224
+
+
+def prepare_image(image):
+    """
+    Pasa la imagen a RGB y la achica a lado menor CLIP_IMAGE_SIZE (bicúbico).
+
+    Es lo primero que hace el preprocesamiento de CLIP; haciéndolo acá, igual
+    para /index, /index/batch, bulk_index.py y el servicio de inferencia, el
+    mismo archivo da el mismo embedding venga por donde venga. Sobre una
+    imagen ya preparada no cambia nada.
+    """
+    image = image.convert("RGB")
+    scale = CLIP_IMAGE_SIZE / min(image.size)
+    if scale < 1:
+        image = image.resize((max(CLIP_IMAGE_SIZE, round(image.width * scale)),
+                              max(CLIP_IMAGE_SIZE, round(image.height * scale))), Image.BICUBIC)
+    return image
+
+
+class InferenceScheduler:
+    def __init__(self, model=None, max_batch: int = 32, max_wait_ms: float = 5.0):
+        """
+        Args:
+            model: SentenceTransformer (o algo con el mismo `encode`). Puede
+                llegar después con `set_model`: hasta entonces los pedidos esperan en la cola
+            max_batch: Máxima cantidad de textos/imágenes por pasada del modelo
+            max_wait_ms: Cuánto se espera a que lleguen más pedidos antes de
+                arrancar un batch (0 = no esperar)
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0  # pasadas del modelo
+        self.items = 0    # textos/imágenes codificados
+        self._queue = queue.Queue()
+        self._model_ready = threading.Event()
+        if model is not None:
+            self._model_ready.set()
+        self._thread = threading.Thread(target=self._run, name="clip-inference", daemon=True)
+        self._thread.start()
+
+    def set_model(self, model):
+        """Define el modelo (si se cargó después de crear el scheduler)."""
+        self.model = model
+        self._model_ready.set()
+
+    def submit(self, kind: str, items: list) -> Future:
+        """
+        Encola textos o imágenes para codificar.
+
+        Args:
+            kind: "text" o "image" (no se mezclan en un mismo batch)
+            items: Lista de strings o de PIL.Image
+
+        Returns:
+            Future que se resuelve con la matriz (len(items), dim)
+        """
+        future = Future()
+        items = list(items)
+        if not items:
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+        else:
+            self._queue.put((kind, items, future))
+        return future
+
+    def encode(self, kind: str, items: list) -> np.ndarray:
+        """Versión bloqueante de `submit` (para scripts, fuera del event loop)."""
+        return self.submit(kind, items).result()
+
+    async def encode_text(self, text: str) -> np.ndarray:
+        return (await asyncio.wrap_future(self.submit("text", [text])))[0]
+
+    async def encode_image(self, image) -> np.ndarray:
+        return (await asyncio.wrap_future(self.submit("image", [image])))[0]
+
+    async def encode_images(self, images: list) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit("image", images))
+
+    def _collect(self, first):
+        """Junta pedidos del mismo tipo hasta llenar el batch o agotar la espera."""
+        kind = first[0]
+        batch = [first]
+        leftovers = []
+        size = len(first[1])
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request[0] == kind:
+                batch.append(request)
+                size += len(request[1])
+            else:
+                leftovers.append(request)
+
+        # Los pedidos del otro tipo van en el próximo batch
+        for request in leftovers:
+            self._queue.put(request)
+        return kind, batch
+
+    def _run(self):
+        self._model_ready.wait()
+        while True:
+            kind, batch = self._collect(self._queue.get())
+            requests = [r for r in batch if r[2].set_running_or_notify_cancel()]
+            if not requests:
+                continue
+
+            if kind == "image":
+                # Las imágenes se preparan todas igual, vengan de donde vengan; de
+                # a un pedido, para que una imagen rota haga fallar solo el suyo
+                prepared = []
+                for request in requests:
+                    try:
+                        prepared.append((request, [prepare_image(i) for i in request[1]]))
+                    except Exception as e:
+                        request[2].set_exception(e)
+                requests = [request for request, _ in prepared]
+                if not requests:
+                    continue
+                items = unique = [image for _, images in prepared for image in images]
+            else:
+                items = [item for _, request_items, _ in requests for item in request_items]
+                # Textos repetidos dentro del batch se codifican una sola vez
+                unique = list(dict.fromkeys(items))
+
+            try:
+                embeddings = np.asarray(self.model.encode(unique, batch_size=self.max_batch), dtype=np.float32)
+                if kind == "text":
+                    by_text = dict(zip(unique, embeddings))
+                    embeddings = np.stack([by_text[t] for t in items])
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(unique)
+
+            start = 0
+            for _, request_items, future in requests:
+                future.set_result(embeddings[start:start + len(request_items)])
+                start += len(request_items)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "items_por_batch": self.items / self.batches if self.batches else 0.0,
+            "en_cola": self._queue.qsize(),
+        }
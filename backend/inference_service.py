@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Servicio de inferencia local: un solo proceso con CLIP, compartido por todos
+los workers del backend a través de un socket Unix.
+
+Sin esto cada proceso que importa app.py carga su propia copia del modelo
+(cientos de MB y varios segundos por worker), y varios torch en paralelo se
+pelean por los mismos núcleos. Con INFERENCE_SOCKET, los workers no cargan
+el modelo: mandan los textos e imágenes al servicio, que los junta en
+micro-batches con el mismo InferenceScheduler que usa el backend solo.
+
+Backpressure: el servicio rechaza pedidos si ya tiene INFERENCE_MAX_QUEUE
+textos/imágenes esperando, y cada worker tiene a lo sumo
+INFERENCE_MAX_INFLIGHT pedidos en vuelo y espera INFERENCE_TIMEOUT segundos
+por respuesta. En esos casos el backend responde 503 con Retry-After.
+
+Protocolo: cada mensaje es (largo del header, largo del payload) como dos
+uint32 little-endian, un header JSON y un payload binario (las imágenes en
+RGB crudo, ya achicadas; los embeddings en float32).
+
+Uso:
+    cd backend
+    python inference_service.py                     # o INFERENCE_BACKEND=int8 python inference_service.py
+    INFERENCE_SOCKET=../inference.sock uvicorn app:app --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from clip_backends import INFERENCE_BACKENDS
+from inference import InferenceScheduler, prepare_image
+
+INFERENCE_SOCKET_PATH = "../inference.sock"
+# Textos/imágenes esperando en el servicio a partir de los cuales rechaza pedidos
+INFERENCE_MAX_QUEUE = int(os.environ.get("INFERENCE_MAX_QUEUE", "256"))
+
+# Tamaño máximo de un mensaje (header + payload)
+MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+
+_FRAME = struct.Struct("<II")
+
+
+class InferenceUnavailable(RuntimeError):
+    """El servicio de inferencia no respondió a tiempo, está saturado o no está levantado."""
+
+
+def _pack(header: dict, payload: bytes = b"") -> bytes:
+    data = json.dumps(header).encode()
+    return _FRAME.pack(len(data), len(payload)) + data + payload
+
+
+def _unpack_header(frame: bytes):
+    header_len, payload_len = _FRAME.unpack(frame)
+    if header_len + payload_len > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Mensaje demasiado grande ({header_len + payload_len} bytes)")
+    return header_len, payload_len
+
+
+def _recv_exact(sock, n: int) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(min(n - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("El servicio de inferencia cerró la conexión")
+        data += chunk
+    return bytes(data)
+
+
+def _recv(sock):
+    header_len, payload_len = _unpack_header(_recv_exact(sock, _FRAME.size))
+    header = json.loads(_recv_exact(sock, header_len))
+    return header, _recv_exact(sock, payload_len)
+
+
+async def _read(reader):
+    header_len, payload_len = _unpack_header(await reader.readexactly(_FRAME.size))
+    header = json.loads(await reader.readexactly(header_len))
+    return header, await reader.readexactly(payload_len)
+
+
+def encode_request(kind: str, items: list):
+    """
+    Header y payload de un pedido de encode.
+
+    Las imágenes se achican acá con prepare_image (~150 KB cada una en vez
+    de la imagen entera); el scheduler del servicio ya no les cambia nada.
+    """
+    if kind == "text":
+        return {"op": "encode", "kind": "text", "items": list(items)}, b""
+    sizes, chunks = [], []
+    for image in items:
+        # Lo mismo que hace el scheduler: en el servicio ya no cambia nada
+        image = prepare_image(image)
+        sizes.append(image.size)
+        chunks.append(image.tobytes())
+    return {"op": "encode", "kind": "image", "sizes": sizes}, b"".join(chunks)
+
+
+def decode_request(header: dict, payload: bytes):
+    """(kind, items) de un pedido de encode."""
+    if header["kind"] == "text":
+        return "text", header["items"]
+    images, start = [], 0
+    for width, height in header["sizes"]:
+        end = start + width * height * 3
+        images.append(Image.frombytes("RGB", (width, height), payload[start:end]))
+        start = end
+    return "image", images
+
+
+class InferenceServer:
+    def __init__(self, scheduler: InferenceScheduler, path: str = INFERENCE_SOCKET_PATH,
+                 max_queue: int = INFERENCE_MAX_QUEUE, model_name: str = None, backend: str = None):
+        """
+        Args:
+            scheduler: Scheduler con el modelo ya cargado
+            path: Socket Unix en el que escucha
+            max_queue: Textos/imágenes en espera a partir de los cuales se rechazan pedidos
+            model_name: Se informa a los clientes (para que no mezclen modelos)
+            backend: Backend de CLIP ("torch", "int8"), también se informa
+        """
+        self.scheduler = scheduler
+        self.path = path
+        self.max_queue = max_queue
+        self.model_name = model_name
+        self.backend = backend
+        self.pending = 0   # textos/imágenes esperando respuesta
+        self.rejected = 0  # pedidos rechazados por cola llena
+        self.clients = 0   # conexiones abiertas
+
+    async def _handle(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    header, payload = await _read(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                response, data = await self._process(header, payload)
+                writer.write(_pack(response, data))
+                await writer.drain()
+        except (ValueError, ConnectionError) as e:
+            print(f"⚠️  Conexión descartada: {e}")
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _process(self, header: dict, payload: bytes):
+        if header.get("op") == "ping":
+            return {"ok": True, "model": self.model_name, "backend": self.backend, **self.stats()}, b""
+        try:
+            kind, items = decode_request(header, payload)
+        except (KeyError, ValueError, TypeError) as e:
+            return {"ok": False, "error": f"Pedido inválido: {e}"}, b""
+        # Backpressure: mejor rechazar rápido que acumular pedidos que van a vencer
+        if self.pending > 0 and self.pending + len(items) > self.max_queue:
+            self.rejected += 1
+            return {"ok": False, "busy": True, "error": f"Cola de inferencia llena ({self.pending} en espera)"}, b""
+        self.pending += len(items)
+        try:
+            embeddings = await asyncio.wrap_future(self.scheduler.submit(kind, items))
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}, b""
+        finally:
+            self.pending -= len(items)
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        return {"ok": True, "shape": list(embeddings.shape)}, embeddings.tobytes()
+
+    def stats(self) -> dict:
+        return {**self.scheduler.stats(), "pendientes": self.pending, "rechazados": self.rejected,
+                "clientes": self.clients}
+
+    async def _serve(self):
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o660)
+        print(f"✅ Servicio de inferencia escuchando en {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            # Si el socket responde es que ya hay otro servicio; si no, quedó de una corrida anterior
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.path)
+                raise RuntimeError(f"Ya hay un servicio de inferencia en {self.path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.path)
+        try:
+            asyncio.run(self._serve())
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class InferenceClient:
+    def __init__(self, path: str = INFERENCE_SOCKET_PATH, timeout: float = 30.0, max_inflight: int = 16):
+        """
+        Cliente del servicio de inferencia, con la misma interfaz que
+        InferenceScheduler (submit / encode / encode_text / encode_images).
+
+        Args:
+            path: Socket Unix del servicio
+            timeout: Segundos de espera por respuesta
+            max_inflight: Pedidos simultáneos de este proceso; los que
+                superen el límite fallan enseguida con InferenceUnavailable
+        """
+        self.path = path
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.batches = 0   # pedidos respondidos
+        self.items = 0     # textos/imágenes codificados
+        self.rejected = 0  # por límite local o cola llena en el servicio
+        self.timeouts = 0
+        self.errors = 0    # conexión caída o servicio sin levantar
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._inflight = 0
+        self._lock = threading.Lock()
+        # Un thread (y una conexión) por pedido en vuelo
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="inferencia")
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, header: dict, payload: bytes = b""):
+        message = _pack(header, payload)
+        for attempt in range(2):
+            reused = getattr(self._local, "sock", None) is not None
+            try:
+                sock = self._socket()
+                sock.sendall(message)
+                return _recv(sock)
+            except socket.timeout:
+                self._close()
+                self.timeouts += 1
+                raise InferenceUnavailable(f"El servicio de inferencia no respondió en {self.timeout:.0f}s")
+            except (ConnectionError, OSError) as e:
+                self._close()
+                # Una conexión vieja (ej. el servicio se reinició): se reintenta una vez con una nueva
+                if reused and attempt == 0:
+                    continue
+                self.errors += 1
+                raise InferenceUnavailable(f"Servicio de inferencia no disponible en {self.path}: {e}")
+
+    def ping(self) -> dict:
+        """Estado del servicio (modelo, batches, cola). Lanza InferenceUnavailable si no responde."""
+        response, _ = self._request({"op": "ping"})
+        return response
+
+    def _encode(self, kind: str, items: list) -> np.ndarray:
+        try:
+            response, data = self._request(*encode_request(kind, items))
+            if not response["ok"]:
+                if response.get("busy"):
+                    self.rejected += 1
+                    raise InferenceUnavailable(response["error"])
+                raise RuntimeError(response["error"])
+            self.batches += 1
+            self.items += len(items)
+            return np.frombuffer(data, dtype="<f4").reshape(response["shape"]).copy()
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._slots.release()
+
+    def set_model(self, model):
+        """El modelo lo tiene el servicio (interfaz de InferenceScheduler)."""
+
+    def submit(self, kind: str, items: list) -> Future:
+        items = list(items)
+        if not items:
+            future = Future()
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+            return future
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            future = Future()
+            future.set_exception(InferenceUnavailable(f"Hay {self.max_inflight} pedidos de inferencia en vuelo"))
+            return future
+        with self._lock:
+            self._inflight += 1
+        return self._pool.submit(self._encode, kind, items)
+
+    def encode(self, kind: str, items: list) -> np.ndarray:
+        return self.submit(kind, items).result()
+
+    async def encode_text(self, text: str) -> np.ndarray:
+        return (await asyncio.wrap_future(self.submit("text", [text])))[0]
+
+    async def encode_image(self, image) -> np.ndarray:
+        return (await asyncio.wrap_future(self.submit("image", [image])))[0]
+
+    async def encode_images(self, images: list) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit("image", images))
+
+    def stats(self) -> dict:
+        return {
+            "servicio": self.path,
+            "batches": self.batches,
+            "items": self.items,
+            "items_por_batch": self.items / self.batches if self.batches else 0.0,
+            "en_cola": self._inflight,
+            "rechazados": self.rejected,
+            "timeouts": self.timeouts,
+            "errores": self.errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio local de inferencia CLIP (socket Unix)")
+    parser.add_argument("--socket", default=os.environ.get("INFERENCE_SOCKET") or INFERENCE_SOCKET_PATH)
+    parser.add_argument("--modelo", default="clip-ViT-B-32")
+    parser.add_argument("--backend", default=os.environ.get("INFERENCE_BACKEND", "torch"),
+                        choices=INFERENCE_BACKENDS, help="Ver clip_backends.py")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("INFERENCE_THREADS", "0")),
+                        help="Threads de torch (0 = default de torch)")
+    parser.add_argument("--batch", type=int, default=int(os.environ.get("ENCODE_BATCH_SIZE", "32")),
+                        help="Máximo de textos/imágenes por pasada del modelo")
+    parser.add_argument("--espera-ms", type=float, default=float(os.environ.get("INFERENCE_MAX_WAIT_MS", "5")),
+                        help="Cuánto esperar a que lleguen más pedidos antes de arrancar un batch")
+    parser.add_argument("--cola", type=int, default=INFERENCE_MAX_QUEUE,
+                        help="Textos/imágenes en espera a partir de los cuales se rechazan pedidos")
+    args = parser.parse_args()
+
+    from clip_backends import load_clip
+
+    print(f"🔄 Cargando modelo CLIP ({args.backend})...")
+    model = load_clip(args.modelo, args.backend, args.threads)
+    scheduler = InferenceScheduler(model, max_batch=args.batch, max_wait_ms=args.espera_ms)
+    scheduler.encode("text", ["córdoba"])
+    scheduler.encode("image", [Image.new("RGB", (224, 224))])
+    print("✅ Modelo listo!")
+    InferenceServer(scheduler, args.socket, args.cola, args.modelo, args.backend).serve()
+
+
+if __name__ == "__main__":
+    main()
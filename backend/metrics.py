@@ -0,0 +1,327 @@
+"""
+Métricas del backend en formato de texto de Prometheus (GET /metrics).
+
+Cada request lleva un contexto de tiempos: `span("etapa")` mide una etapa
+(SQLite, encode, scoring, fusión...) y la suma al histograma
+`cordoba_stage_seconds{endpoint, stage}`. Los spans funcionan también dentro
+de `asyncio.to_thread` (el contexto se copia al thread).
+
+Opcionales (variables de entorno):
+- SERVER_TIMING=1: agrega el header `Server-Timing` con el desglose por
+  etapa (lo muestran las devtools del navegador, en Network → Timing)
+- PROFILE_SLOW_MS=500: muestrea los stacks de una fracción de los requests
+  (PROFILE_SAMPLE_RATE) y guarda en ../profiles los que tarden más que eso,
+  en formato "collapsed" (flamegraph.pl, speedscope)
+"""
+
+import contextvars
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+# Profiler de requests lentos: umbral en ms (0 = apagado), fracción de
+# requests muestreados y cada cuánto se toma una muestra de los stacks
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = "../profiles"
+
+# Segundos
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels -> [conteos por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        names = self.labels + ("le",)
+        for key, entry in values:
+            for bound, count in zip(self.buckets + (float("inf"),), entry[:len(self.buckets)] + [entry[-1]]):
+                yield f"{self.name}_bucket{_format_labels(names, key + (_format_value(float(bound)),))} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(entry[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {entry[-1]}"
+
+
+class Callback:
+    """Métrica que se lee al renderizar (ej. hits de un cache que ya los cuenta)."""
+
+    def __init__(self, name: str, help: str, kind: str, read, labels=()):
+        """
+        Args:
+            kind: "counter" o "gauge"
+            read: Función que devuelve un número, o un dict {valores de labels: número}
+        """
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.labels = tuple(labels)
+
+    def render(self):
+        value = self.read()
+        values = value if isinstance(value, dict) else {(): value}
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, number in sorted(values.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(number)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, read, kind="gauge", labels=()) -> Callback:
+        return self._add(Callback(name, help, kind, read, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:  # una métrica rota no tiene que tirar /metrics
+                lines.append(f"# {metric.name}: {type(e).__name__}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("cordoba_requests_total", "Requests HTTP atendidos", ("endpoint", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("cordoba_request_seconds", "Duración de los requests", ("endpoint", "method"))
+STAGE_SECONDS = REGISTRY.histogram("cordoba_stage_seconds", "Duración de cada etapa de un request", ("endpoint", "stage"))
+SLOW_REQUESTS = REGISTRY.counter("cordoba_slow_requests_total", "Requests perfilados que superaron PROFILE_SLOW_MS", ("endpoint",))
+
+
+# --- Tiempos por request ---
+
+class RequestTimings:
+    def __init__(self, scope):
+        self.scope = scope
+        self.stages = {}  # etapa -> segundos (sumados si se repite)
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        """Ruta con parámetros (ej. /similar/{ref}) para que las labels no exploten."""
+        route = self.scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            return route.path
+        path = self.scope.get("path", "")
+        # Archivos estáticos: solo el mount
+        for mount in ("/thumbs", "/images"):
+            if path.startswith(mount + "/"):
+                return mount
+        return "otro"
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        with self._lock:
+            stages = list(self.stages.items())
+        parts = [f"{re.sub(r'[^A-Za-z0-9_-]', '_', stage)};dur={seconds * 1000:.2f}" for stage, seconds in stages]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Mide una etapa del request actual (fuera de un request no hace nada)."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        timings.add(stage, elapsed)
+        STAGE_SECONDS.observe(elapsed, endpoint=timings.endpoint, stage=stage)
+
+
+async def timed(stage: str, awaitable):
+    """`await` de una corrutina midiéndola como etapa (para usar dentro de gather)."""
+    with span(stage):
+        return await awaitable
+
+
+# --- Profiler de requests lentos ---
+
+def _collapsed_stack(frame, thread_name: str) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join([thread_name] + names[::-1])
+
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms: float, sample_rate: float, interval_ms: float, out_dir: str = PROFILE_DIR):
+        """
+        Mientras haya requests muestreados en curso, un thread toma los
+        stacks de todos los threads cada `interval_ms`. Los requests que
+        tardan más que `threshold_ms` guardan sus muestras en `out_dir`.
+        """
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+        self.out_dir = out_dir
+        self._active = {}  # token -> StackCounter
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Empieza a muestrear un request (según sample_rate). Devuelve un token o None."""
+        if random.random() >= self.sample_rate:
+            return None
+        token = object()
+        with self._lock:
+            self._active[token] = StackCounter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return token
+
+    def stop(self, token, seconds: float, endpoint: str):
+        """Termina el muestreo; si el request fue lento guarda el perfil y devuelve su ruta."""
+        with self._lock:
+            samples = self._active.pop(token, None)
+        if not samples or seconds < self.threshold:
+            return None
+        SLOW_REQUESTS.inc(endpoint=endpoint)
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_") or "raiz"
+        path = os.path.join(self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}_{seconds * 1000:.0f}ms.txt")
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                if not self._active:
+                    self._wakeup.clear()
+                    continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [_collapsed_stack(frame, names.get(ident, str(ident)))
+                      for ident, frame in sys._current_frames().items() if ident != own]
+            with self._lock:
+                for samples in self._active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
+
+
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS) if PROFILE_SLOW_MS > 0 else None
+
+
+async def instrument(request, call_next):
+    """Middleware HTTP: contexto de tiempos, métricas del request, Server-Timing y profiler."""
+    timings = RequestTimings(request.scope)
+    context = _current.set(timings)
+    token = profiler.start() if profiler is not None else None
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - t0
+        _current.reset(context)
+        endpoint = timings.endpoint
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+        if token is not None:
+            path = profiler.stop(token, elapsed, endpoint)
+            if path:
+                print(f"🐢 {request.method} {request.url.path} tardó {elapsed * 1000:.0f} ms → {path}")
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = timings.server_timing(elapsed)
+        response.headers["Timing-Allow-Origin"] = "*"
+    return response
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Migra la columna `embedding` de cordoba.db de JSON (TEXT) a BLOB binario.
+
+Convierte la base en el lugar (en una sola transacción) y después hace
+VACUUM para recuperar el espacio. Se puede volver a correr sin problema:
+las filas que ya están en binario se saltean (o se re-codifican si se
+pide otro dtype con --recodificar).
+
+Uso:
+    cd backend
+    python migrate_embeddings.py                    # float32
+    python migrate_embeddings.py --dtype float16    # la mitad de tamaño
+"""
+
+import argparse
+import os
+import sqlite3
+
+from vector_store import EMBEDDING_DTYPES, decode_embedding, encode_embedding
+
+
+def migrar(db_path: str, dtype: str, recodificar: bool = False, lote: int = 1000):
+    """Convierte los embeddings de `db_path` al formato binario `dtype`."""
+    if not os.path.exists(db_path):
+        print(f"❌ No existe la base: {db_path}")
+        return
+
+    tamano_antes = os.path.getsize(db_path)
+
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+
+    if recodificar:
+        c.execute("SELECT COUNT(*) FROM imagenes")
+    else:
+        c.execute("SELECT COUNT(*) FROM imagenes WHERE typeof(embedding) = 'text'")
+    total = c.fetchone()[0]
+    print(f"📁 Filas a convertir: {total}")
+
+    if total == 0:
+        print("✅ Nada para migrar")
+        conn.close()
+        return
+
+    where = "" if recodificar else "AND typeof(embedding) = 'text'"
+
+    convertidas = 0
+    ultimo_id = 0
+    with conn:  # una sola transacción: si algo falla, la base queda como estaba
+        while True:
+            # De a lotes por rango de id, leyendo el lote entero antes de escribir:
+            # no se actualiza la tabla con un SELECT sobre ella todavía abierto
+            c.execute(f"SELECT id, embedding FROM imagenes WHERE id > ? {where} ORDER BY id LIMIT ?",
+                      (ultimo_id, lote))
+            rows = c.fetchall()
+            if not rows:
+                break
+            c.executemany(
+                "UPDATE imagenes SET embedding = ? WHERE id = ?",
+                [(encode_embedding(decode_embedding(emb), dtype), row_id) for row_id, emb in rows]
+            )
+            ultimo_id = rows[-1][0]
+            convertidas += len(rows)
+            print(f"✅ Convertidas: {convertidas}/{total}")
+
+    print("🔄 VACUUM (compactando la base)...")
+    conn.execute("VACUUM")
+    conn.close()
+
+    tamano_despues = os.path.getsize(db_path)
+    print(f"\n🎉 Migración completa!")
+    print(f"   Antes:   {tamano_antes / 1e6:.1f} MB")
+    print(f"   Después: {tamano_despues / 1e6:.1f} MB ({tamano_antes / max(tamano_despues, 1):.1f}x más chica)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra embeddings JSON → BLOB binario")
+    parser.add_argument("--db", default="../cordoba.db", help="Ruta a la base SQLite")
+    parser.add_argument("--dtype", default="float32", choices=sorted(EMBEDDING_DTYPES))
+    parser.add_argument("--recodificar", action="store_true",
+                        help="Re-codificar también las filas que ya son BLOB (ej: pasar a float16)")
+    args = parser.parse_args()
+
+    migrar(args.db, args.dtype, args.recodificar)
+
+
+if __name__ == "__main__":
+    main()
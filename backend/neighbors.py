@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Vecinos precalculados para "más como esta" (/similar).
+
+Para cada imagen se guardan en la tabla `vecinos` las NEIGHBORS_K imágenes
+más parecidas (ids y similitudes como BLOB), así /similar sin filtros es una
+lectura por clave primaria en vez de recorrer la matriz.
+
+Las listas se calculan con productos de matrices por bloques (memoria
+acotada) y se refrescan después de indexar: las imágenes nuevas reciben su
+lista y se recalculan las de las imágenes viejas a las que una nueva les
+entra en el top-k.
+
+Uso:
+    cd backend
+    python neighbors.py                # calcular las listas que faltan
+    python neighbors.py --todas        # recalcular todas
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+# Vecinos guardados por imagen (0 = no precalcular)
+NEIGHBORS_K = int(os.environ.get("NEIGHBORS_K", "50"))
+# Floats por bloque de similitudes (acota la memoria: 2**24 floats = 64 MiB)
+BLOCK_FLOATS = 2 ** 24
+
+
+def init_neighbors(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS vecinos (
+            id INTEGER PRIMARY KEY,
+            vecinos BLOB,
+            similitudes BLOB
+        )
+    ''')
+
+
+def _block_rows(n_columns: int) -> int:
+    return max(1, BLOCK_FLOATS // max(n_columns, 1))
+
+
+def compute_neighbors(store, row_ids, k: int):
+    """
+    Top-k vecinos (sin contarse a sí misma) de las filas pedidas, por bloques.
+
+    Returns:
+        (ids, vecinos, similitudes): ids que estaban en el store, y matrices
+        (len(ids), k') de vecinos y similitudes de mayor a menor (k' <= k)
+    """
+    store_ids = store.ids
+    pos = store.positions(row_ids)
+    pos = pos[pos >= 0]
+    k = min(k, len(store_ids) - 1)
+    if len(pos) == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+
+    all_neighbors = np.zeros((len(pos), k), dtype=np.int64)
+    all_sims = np.zeros((len(pos), k), dtype=np.float32)
+    block = _block_rows(len(store_ids))
+    for start in range(0, len(pos), block):
+        rows = pos[start:start + block]
+        scores = store.dot(store.rows(rows).T)[:len(store_ids)].T
+        scores[np.arange(len(rows)), rows] = -np.inf  # no es vecina de sí misma
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        all_neighbors[start:start + len(rows)] = store_ids[np.take_along_axis(top, order, axis=1)]
+        all_sims[start:start + len(rows)] = np.take_along_axis(top_scores, order, axis=1)
+    return store_ids[pos], all_neighbors, all_sims
+
+
+class NeighborLists:
+    def __init__(self, k: int = NEIGHBORS_K):
+        """
+        Args:
+            k: Vecinos por imagen
+        """
+        self.k = k
+        self._lock = threading.Lock()
+        # id -> similitud del último vecino guardado (para saber a quién
+        # le cambia la lista cuando llega una imagen nueva)
+        self._threshold = {}
+
+    def __len__(self):
+        return len(self._threshold)
+
+    def load(self, conn):
+        """Lee de la DB qué imágenes ya tienen lista (y su umbral)."""
+        threshold = {}
+        for row_id, sims in conn.execute("SELECT id, similitudes FROM vecinos"):
+            threshold[row_id] = self._limit(np.frombuffer(sims, dtype="<f4"))
+        with self._lock:
+            self._threshold = threshold
+
+    def _limit(self, sims) -> float:
+        """Similitud que tiene que superar una imagen nueva para entrar en la lista."""
+        # Una lista incompleta (había menos de k imágenes) acepta a cualquiera
+        return float(sims[-1]) if len(sims) >= self.k else -np.inf
+
+    def get(self, c, row_id: int):
+        """(ids, similitudes) precalculados de una imagen, o None si no tiene lista."""
+        c.execute("SELECT vecinos, similitudes FROM vecinos WHERE id = ?", (int(row_id),))
+        row = c.fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype="<i8"), np.frombuffer(row[1], dtype="<f4")
+
+    def missing(self, store):
+        """Ids del store que todavía no tienen lista."""
+        with self._lock:
+            return [int(r) for r in store.ids if int(r) not in self._threshold]
+
+    def affected(self, store, row_ids):
+        """
+        Imágenes con lista a las que alguna de `row_ids` les entra en el top-k
+        (su similitud supera la del último vecino guardado).
+        """
+        pos = store.positions(row_ids)
+        vectors = store.rows(pos[pos >= 0])
+        with self._lock:
+            threshold = self._threshold.copy()
+        if not threshold or len(vectors) == 0:
+            return []
+        store_ids = store.ids
+        limits = np.array([threshold.get(int(r), np.inf) for r in store_ids], dtype=np.float32)
+        new = set(int(r) for r in row_ids)
+        best = np.full(len(store_ids), -np.inf, dtype=np.float32)
+        block = _block_rows(len(store_ids))
+        for start in range(0, len(vectors), block):
+            scores = store.dot(vectors[start:start + block].T)[:len(store_ids)]
+            best = np.maximum(best, scores.max(axis=1))
+        hits = np.nonzero(best > limits)[0]
+        return [int(r) for r in store_ids[hits] if int(r) not in new]
+
+    def refresh(self, writer, store, row_ids, update_affected: bool = True):
+        """
+        Calcula las listas de `row_ids` y (con `update_affected`) recalcula
+        las que cambian por ellas.
+
+        El cálculo se hace sin tomar la conexión; `writer` es un context
+        manager que la devuelve solo para guardar (ej. `db.writer`).
+
+        Returns:
+            Cantidad de listas escritas
+        """
+        if self.k <= 0 or not row_ids:
+            return 0
+        targets = [int(r) for r in row_ids]
+        if update_affected:
+            targets = list(dict.fromkeys(targets + self.affected(store, row_ids)))
+        ids, neighbors, sims = compute_neighbors(store, targets, self.k)
+        if len(ids) == 0:
+            return 0
+        rows = [
+            (int(row_id), nbrs.astype("<i8").tobytes(), s.astype("<f4").tobytes())
+            for row_id, nbrs, s in zip(ids, neighbors, sims)
+        ]
+        with writer() as conn:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO vecinos (id, vecinos, similitudes) VALUES (?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        with self._lock:
+            self._threshold.update((int(row_id), self._limit(s)) for row_id, s in zip(ids, sims))
+        return len(rows)
+
+
+def build(db_path: str, everything: bool = False, batch: int = 4096):
+    """
+    Calcula las listas de vecinos que faltan (por ejemplo, después de
+    bulk_index.py) y actualiza las que cambian por ellas. Con `everything`
+    recalcula todas.
+    """
+    from contextlib import contextmanager
+    from db import connect
+    from vector_store import EmbeddingStore
+
+    conn = connect(db_path)
+
+    @contextmanager
+    def writer():
+        yield conn
+
+    init_neighbors(conn.cursor())
+    store = EmbeddingStore()
+    store.load_from_db(conn)
+    lists = NeighborLists()
+    lists.load(conn)
+    pending = [int(r) for r in store.ids] if everything else lists.missing(store)
+    print(f"📁 {len(store)} imágenes, {len(pending)} listas para calcular (k={lists.k})")
+
+    written = 0
+    for start in range(0, len(pending), batch):
+        # Si se recalcula todo, no hace falta buscar a quién afecta cada lote
+        written += lists.refresh(writer, store, pending[start:start + batch], update_affected=not everything)
+        print(f"   {min(start + batch, len(pending))}/{len(pending)}")
+    conn.close()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precalcular vecinos para /similar")
+    parser.add_argument("--db", default="../cordoba.db")
+    parser.add_argument("--todas", action="store_true", help="Recalcular también las que ya tienen lista")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    written = build(args.db, args.todas)
+    print(f"✅ {written} listas de vecinos en {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
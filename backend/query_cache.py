@@ -0,0 +1,119 @@
+"""
+Cache LRU de embeddings de texto (queries) para no volver a pasar por CLIP.
+
+El frontend busca mientras se escribe, así que las mismas queries vuelven
+una y otra vez; el forward de texto de CLIP en CPU es lo más caro de una
+búsqueda repetida.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    """Normaliza la query (el tokenizer de CLIP ya ignora mayúsculas y espacios)."""
+    return " ".join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    def __init__(self, model_version: str, maxsize: int = 1024, ttl: float = None, path: str = None):
+        """
+        Args:
+            model_version: Modelo y backend que generaron los embeddings (parte de
+                la clave; un archivo guardado con otro backend se ignora)
+            maxsize: Cantidad máxima de queries guardadas
+            ttl: Segundos de validez de cada entrada (None = sin vencimiento)
+            path: Archivo .npz para persistir el cache entre reinicios (opcional)
+        """
+        self.model_version = model_version
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (modelo:backend, query) -> (timestamp, embedding)
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, query: str):
+        return (self.model_version, normalize_query(query))
+
+    def get(self, query: str):
+        """Embedding cacheado de la query, o None si no está (o venció)."""
+        key = self._key(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query: str, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding.setflags(write=False)  # se comparte entre requests
+        key = self._key(query)
+        with self._lock:
+            self._entries[key] = (time.time(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self):
+        """Guarda el cache en `path` (escritura atómica)."""
+        if not self.path:
+            return
+        with self._lock:
+            entries = [(k, v) for k, v in self._entries.items() if k[0] == self.model_version]
+        if not entries:
+            return
+        tmp = self.path + ".tmp.npz"
+        np.savez(
+            tmp,
+            queries=np.array([k[1] for k, _ in entries]),
+            timestamps=np.array([v[0] for _, v in entries]),
+            embeddings=np.stack([v[1] for _, v in entries]),
+            model=np.array(self.model_version),
+        )
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """Carga el cache desde `path` (se ignora si es de otro modelo o backend)."""
+        try:
+            data = np.load(self.path)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  No se pudo leer el cache de queries {self.path}: {e}")
+            return
+        if str(data["model"]) != self.model_version:
+            return
+        now = time.time()
+        with self._lock:
+            for query, ts, embedding in zip(data["queries"], data["timestamps"], data["embeddings"]):
+                if self.ttl is not None and now - ts > self.ttl:
+                    continue
+                embedding.setflags(write=False)
+                self._entries[(self.model_version, str(query))] = (float(ts), embedding)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,93 @@
+"""
+Cache de rankings para paginar búsquedas sin recalcularlas.
+
+El frontend pide los resultados de a páginas ("Cargar más"); en vez de
+volver a codificar la query y recorrer toda la matriz en cada página, se
+guarda el prefijo ordenado del ranking (ids y similitudes) y las páginas
+siguientes solo lo cortan.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Ranking:
+    def __init__(self, ids, scores, complete: bool):
+        """
+        Args:
+            ids: Ids de la tabla `imagenes`, de mayor a menor similitud
+            scores: Similitud de cada id
+            complete: True si no hay más resultados después de estos
+                (si es False, el ranking es solo un prefijo)
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.complete = complete
+
+    def __len__(self):
+        return len(self.ids)
+
+    def covers(self, end: int) -> bool:
+        """True si alcanza para servir los resultados hasta `end` (exclusive)."""
+        return self.complete or len(self.ids) >= end
+
+    def has_more(self, end: int) -> bool:
+        """True si puede haber resultados después de `end`."""
+        return end < len(self.ids) or not self.complete
+
+    def page(self, offset: int, limit: int):
+        """(ids, similitudes) de la página pedida."""
+        return self.ids[offset:offset + limit], self.scores[offset:offset + limit]
+
+
+class RankingCache:
+    def __init__(self, maxsize: int = 256, ttl: float = None):
+        """
+        Args:
+            maxsize: Cantidad máxima de rankings guardados
+            ttl: Segundos de validez de cada ranking (None = sin vencimiento)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # clave -> (timestamp, Ranking)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Ranking cacheado para la clave, o None si no está (o venció)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, ranking: Ranking):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), ranking)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Snapshot de los embeddings en disco, mapeado en memoria y compartido entre
+los procesos del backend (varios workers de uvicorn).
+
+Sin esto cada worker decodifica todos los embeddings de la DB y guarda su
+propia copia de la matriz: con N workers la memoria se multiplica por N.
+Con el snapshot, la matriz ya normalizada está en un archivo que todos los
+workers mapean (np.load con mmap_mode): las páginas quedan una sola vez en
+el page cache del sistema.
+
+Archivos en SNAPSHOT_DIR:
+- manifest.json: generación actual y de qué base de datos sale
+- base-<gen>.npy: matriz (n, dim) float32 normalizada. Al construirla desde
+  la DB queda ordenada por id; lo que se compacta después va al final, en
+  el orden en que llegó
+- base-<gen>.ids.npy: id de cada fila de la base
+- delta-<gen>.bin: registros de tamaño fijo (id, embedding normalizado) que
+  se agregan al final con cada /index (append-only, con lock de archivo)
+
+Cada worker lee el delta cada SNAPSHOT_POLL_SECONDS y agrega esas filas a
+su buffer propio (que es chico). Cuando el delta pasa SNAPSHOT_COMPACT_ROWS
+filas, un worker lo compacta: escribe la base de la generación siguiente
+(base + delta) y los demás la mapean sin recargar nada, porque las filas
+quedan en las mismas posiciones que ya tenían en memoria.
+
+La DB sigue siendo la fuente de verdad: si el snapshot no existe, es de otra
+base o le faltan filas (ej. indexadas con una versión vieja del backend), se
+completa o se regenera desde cordoba.db al arrancar.
+
+Uso:
+    cd backend
+    uvicorn app:app --host 0.0.0.0 --port 8000 --workers 4
+    python snapshot.py info
+    python snapshot.py build      # regenerar desde la DB (ej. después de migrate_embeddings.py)
+    python snapshot.py compact    # compactar el delta ahora
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from vector_store import EMBEDDING_DIM, EmbeddingStore, decode_embeddings, normalize
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin locks de archivo no se puede compartir el delta
+    fcntl = None
+
+SNAPSHOT_DIR = "../embeddings"
+
+# Snapshot compartido (1) o cada proceso con su copia cargada desde la DB (0)
+EMBEDDING_SNAPSHOT = os.environ.get("EMBEDDING_SNAPSHOT", "1") == "1" and fcntl is not None
+# Cada cuánto lee cada worker lo que los demás agregaron al delta
+SNAPSHOT_POLL_SECONDS = float(os.environ.get("SNAPSHOT_POLL_SECONDS", "2"))
+# Filas en el delta a partir de las cuales se compacta
+SNAPSHOT_COMPACT_ROWS = int(os.environ.get("SNAPSHOT_COMPACT_ROWS", "10000"))
+
+
+def record_dtype(dim: int = EMBEDDING_DIM) -> np.dtype:
+    """Un registro del delta: id y embedding normalizado, little-endian."""
+    return np.dtype([("id", "<i8"), ("vector", "<f4", (dim,))])
+
+
+def db_id(conn) -> str:
+    """Identificador de la base (tabla `config`, ver app.py)."""
+    try:
+        row = conn.execute("SELECT valor FROM config WHERE clave = 'db_id'").fetchone()
+    except Exception:
+        return None
+    return row[0] if row else None
+
+
+def _facets(conn, row_ids):
+    """id -> (barrio, localidad, categoria) de la DB."""
+    found = {}
+    row_ids = [int(r) for r in row_ids]
+    for start in range(0, len(row_ids), 900):
+        chunk = row_ids[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT id, barrio, localidad, categoria FROM imagenes WHERE id IN ({placeholders})", chunk)
+        found.update((r[0], r[1:]) for r in rows)
+    return found
+
+
+class EmbeddingSnapshot:
+    def __init__(self, directory: str = SNAPSHOT_DIR, dim: int = EMBEDDING_DIM):
+        """
+        Args:
+            directory: Carpeta de los archivos del snapshot
+            dim: Dimensión de los embeddings
+        """
+        self.directory = directory
+        self.dim = dim
+        self.record = record_dtype(dim)
+        self.generation = None  # generación mapeada por este proceso
+        # El delta se deja abierto: sigue legible aunque otro proceso compacte y lo borre
+        self._delta = None
+        self._applied = 0  # registros del delta ya aplicados al store
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _file_lock(self, name: str, blocking: bool = True):
+        """Lock exclusivo entre procesos. Sin `blocking` devuelve False si está tomado."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(name), "a+b") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def manifest(self):
+        try:
+            with open(self._path("manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self._path(f"manifest.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._path("manifest.json"))
+
+    def _map(self, generation: int):
+        """(ids, matriz) de la base de una generación, mapeada copy-on-write."""
+        ids = np.load(self._path(f"base-{generation}.ids.npy"))
+        matrix = np.load(self._path(f"base-{generation}.npy"), mmap_mode="c")
+        if matrix.shape != (len(ids), self.dim):
+            raise ValueError(f"Base {generation} con forma {matrix.shape}")
+        return ids, matrix
+
+    def delta_rows(self) -> int:
+        """Registros en el delta de la generación actual."""
+        manifest = self.manifest()
+        if manifest is None:
+            return 0
+        try:
+            return os.path.getsize(self._path(f"delta-{manifest['generation']}.bin")) // self.record.itemsize
+        except OSError:
+            return 0
+
+    def stats(self) -> dict:
+        return {"generacion": self.generation, "filas_delta": self.delta_rows()}
+
+    def _read_records(self, f, start: int = 0, stop: int = None):
+        """Registros completos de un delta desde `start` (un registro a medio escribir se ignora)."""
+        total = os.fstat(f.fileno()).st_size // self.record.itemsize
+        stop = total if stop is None else min(stop, total)
+        if stop <= start:
+            return np.zeros(0, dtype=self.record)
+        f.seek(start * self.record.itemsize)
+        return np.fromfile(f, dtype=self.record, count=stop - start)
+
+    def _write_base(self, generation: int, ids: np.ndarray, fill):
+        """Escribe base-<gen> (primero a un temporal). `fill(matriz)` completa las filas."""
+        tmp = self._path(f"base-{generation}.{os.getpid()}.tmp.npy")
+        matrix = np.lib.format.open_memmap(tmp, mode="w+", dtype="<f4", shape=(len(ids), self.dim))
+        fill(matrix)
+        matrix.flush()
+        del matrix
+        np.save(self._path(f"base-{generation}.ids.npy"), np.asarray(ids, dtype="<i8"))
+        os.replace(tmp, self._path(f"base-{generation}.npy"))
+
+    def _switch(self, generation: int, rows: int, tail, meta: dict):
+        """
+        Publica una generación nueva (su base ya está escrita). Con el lock
+        del delta tomado: los registros que llegaron mientras se escribía la
+        base (`tail()`) pasan al delta nuevo y se cambia el manifest.
+        """
+        with self._file_lock("delta.lock"):
+            records = tail()
+            with open(self._path(f"delta-{generation}.bin"), "wb") as f:
+                records.tofile(f)
+            self._write_manifest(dict(meta, generation=generation, dim=self.dim, rows=rows,
+                                      creado=time.strftime("%Y-%m-%d %H:%M:%S")))
+        # Los procesos que todavía mapean la generación anterior la siguen viendo (POSIX)
+        for path in glob.glob(self._path("base-*")) + glob.glob(self._path("delta-*")):
+            name = os.path.basename(path)
+            try:
+                if int(name.split("-")[1].split(".")[0]) < generation:
+                    os.remove(path)
+            except (ValueError, OSError):
+                pass
+
+    def _open_delta(self):
+        manifest = self.manifest()
+        current = manifest["generation"] if manifest else None
+        if current is None:
+            return None, None
+        f = open(self._path(f"delta-{current}.bin"), "rb")
+        return manifest, f
+
+    def build(self, conn, force: bool = False) -> bool:
+        """
+        Genera el snapshot desde la DB si no existe o es de otra base (o
+        siempre, con `force`). Si varios workers arrancan a la vez, lo
+        construye uno y los demás esperan.
+
+        Returns:
+            True si se escribió una generación nueva
+        """
+        meta = {"db_id": db_id(conn)}
+        with self._file_lock("compact.lock"):
+            current = self.manifest()
+            if not force and current is not None and current.get("db_id") == meta["db_id"] \
+                    and current.get("dim") == self.dim:
+                return False
+            generation = current["generation"] + 1 if current else 1
+            # Lo que se agregue al delta mientras se lee la DB se pasa a la generación nueva
+            old = open(self._path(f"delta-{current['generation']}.bin"), "rb") if current else None
+            start = self._read_records(old).size if old else 0
+
+            store = EmbeddingStore(self.dim)
+            store.load_from_db(conn)
+            ids = store.ids.copy()
+
+            def fill(matrix):
+                matrix[:] = store.matrix
+
+            self._write_base(generation, ids, fill)
+            del store
+            self._switch(generation, len(ids), lambda: self._read_records(old, start) if old else np.zeros(0, self.record),
+                         meta)
+            if old:
+                old.close()
+        return True
+
+    def compact(self, min_rows: int = SNAPSHOT_COMPACT_ROWS) -> bool:
+        """
+        Junta la base con el delta en una generación nueva, si el delta tiene
+        al menos `min_rows` registros y ningún otro proceso está compactando.
+
+        Las filas quedan en las posiciones que ya tienen en memoria los
+        workers (los ids nuevos al final, en el orden del delta), así pueden
+        cambiar de base sin recargar.
+        """
+        with self._file_lock("compact.lock", blocking=False) as locked:
+            if not locked:
+                return False
+            manifest = self.manifest()
+            if manifest is None:
+                return False
+            generation = manifest["generation"]
+            with open(self._path(f"delta-{generation}.bin"), "rb") as delta:
+                records = self._read_records(delta)
+                if len(records) == 0 or len(records) < min_rows:
+                    return False
+                base_ids, base = self._map(generation)
+
+                # Posición de cada registro, igual que EmbeddingStore.add al aplicarlos en orden
+                positions = {int(r): pos for pos, r in enumerate(base_ids)}
+                new_ids = []
+                record_pos = np.empty(len(records), dtype=np.int64)
+                for i, row_id in enumerate(records["id"].tolist()):
+                    pos = positions.get(row_id)
+                    if pos is None:
+                        pos = positions[row_id] = len(base_ids) + len(new_ids)
+                        new_ids.append(row_id)
+                    record_pos[i] = pos
+                ids = np.concatenate([base_ids, np.array(new_ids, dtype=np.int64)])
+                # Si un id aparece varias veces gana el último registro
+                _, last = np.unique(record_pos[::-1], return_index=True)
+                last = len(records) - 1 - last
+
+                def fill(matrix):
+                    for start in range(0, len(base), 65536):
+                        matrix[start:start + 65536] = base[start:start + 65536]
+                    matrix[record_pos[last]] = records["vector"][last]
+
+                self._write_base(generation + 1, ids, fill)
+                del base
+                self._switch(generation + 1, len(ids), lambda: self._read_records(delta, len(records)),
+                             {"db_id": manifest.get("db_id")})
+        print(f"🗜️  Snapshot compactado: generación {generation + 1}, {len(ids)} filas")
+        return True
+
+    def append(self, row_ids, embeddings):
+        """Agrega embeddings (se normalizan acá) al delta de la generación actual."""
+        if len(row_ids) == 0:
+            return
+        records = np.zeros(len(row_ids), dtype=self.record)
+        records["id"] = np.asarray(row_ids, dtype=np.int64)
+        records["vector"] = normalize(np.atleast_2d(embeddings))
+        with self._file_lock("delta.lock"):
+            # El manifest se lee con el lock tomado: nadie cambia de generación en el medio
+            manifest = self.manifest()
+            if manifest is None:
+                return  # todavía no hay snapshot: se genera desde la DB al levantar el backend
+            with open(self._path(f"delta-{manifest['generation']}.bin"), "r+b") as f:
+                # Un registro a medio escribir (proceso que se cortó) se descarta
+                size = os.fstat(f.fileno()).st_size
+                f.truncate(size - size % self.record.itemsize)
+                f.seek(0, os.SEEK_END)
+                records.tofile(f)
+
+    def _apply(self, store, records, facets):
+        if len(records) == 0:
+            return
+        ids = records["id"]
+        store.add(ids, records["vector"], [facets.get(int(r), ("", "", "")) for r in ids.tolist()])
+
+    def load(self, store, conn):
+        """
+        Mapea la generación actual en `store` (facetas y grupos desde la DB)
+        y le aplica el delta. Lo que está en la DB y falta en el snapshot se
+        agrega al delta; si el snapshot tiene filas que ya no están en la
+        DB, se regenera.
+        """
+        self.build(conn)
+        with self._lock:
+            for _ in range(2):
+                manifest, delta = self._open_delta()
+                ids, base = self._map(manifest["generation"])
+                store.load_base(conn, ids, base)
+                if self._delta is not None:
+                    self._delta.close()
+                self._delta, self.generation = delta, manifest["generation"]
+                records = self._read_records(delta)
+                self._applied = len(records)
+                self._apply(store, records, _facets(conn, records["id"]))
+
+                db_ids = np.array([r[0] for r in conn.execute("SELECT id FROM imagenes")], dtype=np.int64)
+                if len(np.setdiff1d(store.ids, db_ids)) == 0:
+                    break
+                print("⚠️  El snapshot tiene imágenes que ya no están en la DB, se regenera")
+                self.build(conn, force=True)
+
+            missing = np.setdiff1d(db_ids, store.ids)
+            if len(missing) > 0:
+                print(f"🔄 Agregando al snapshot {len(missing)} embeddings que faltaban")
+                for start in range(0, len(missing), 4096):
+                    chunk = missing[start:start + 4096].tolist()
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = conn.execute(f"SELECT id, embedding FROM imagenes WHERE id IN ({placeholders}) ORDER BY id",
+                                        chunk).fetchall()
+                    self.append([r[0] for r in rows], decode_embeddings([r[1] for r in rows], self.dim))
+                records = self._read_records(self._delta, self._applied)
+                self._applied += len(records)
+                self._apply(store, records, _facets(conn, records["id"]))
+
+    def sync(self, store, reader, known: dict = None):
+        """
+        Aplica al store lo que se agregó al delta desde la última vez (de
+        cualquier proceso) y, si otro proceso compactó, pasa a la base nueva.
+
+        Args:
+            reader: Context manager que devuelve una conexión (ej. db.reader),
+                para las facetas de las filas que indexaron otros procesos
+            known: id -> facetas de las filas que ya se conocen
+
+        Returns:
+            Registros aplicados (campos "id" y "vector"), o None si el
+            snapshot cambió de una forma que obliga a recargarlo (`load`)
+        """
+        known = known or {}
+
+        def apply(records):
+            unknown = [r for r in records["id"].tolist() if r not in known]
+            facets = dict(known)
+            if unknown:
+                with reader() as conn:
+                    facets.update(_facets(conn, unknown))
+            self._apply(store, records, facets)
+            return records
+
+        with self._lock:
+            if self._delta is None:
+                return None
+            manifest = self.manifest()
+            if manifest is None:
+                return None
+            # Si cambió la generación, el delta anterior ya no crece: se termina de aplicar
+            applied = [apply(self._read_records(self._delta, self._applied))]
+            self._applied += len(applied[0])
+            if manifest["generation"] != self.generation:
+                try:
+                    manifest, delta = self._open_delta()
+                    ids, base = self._map(manifest["generation"])
+                except (OSError, ValueError, TypeError):
+                    return None
+                if not np.array_equal(ids, store.ids[:len(ids)]):
+                    delta.close()
+                    return None
+                store.rebase(base)
+                self._delta.close()
+                self._delta, self.generation, self._applied = delta, manifest["generation"], 0
+                # Lo que llegó durante la compactación: ya se aplicó, pero sobre la base anterior
+                applied.append(apply(self._read_records(self._delta)))
+                self._applied = len(applied[-1])
+            return np.concatenate(applied)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot de embeddings compartido entre workers")
+    parser.add_argument("accion", choices=["info", "build", "compact"])
+    parser.add_argument("--db", default="../cordoba.db")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    from db import connect
+
+    snapshot = EmbeddingSnapshot(args.dir)
+    if args.accion == "build":
+        conn = connect(args.db, readonly=True)
+        t0 = time.perf_counter()
+        snapshot.build(conn, force=True)
+        conn.close()
+        print(f"✅ Snapshot regenerado en {time.perf_counter() - t0:.1f}s")
+    elif args.accion == "compact":
+        if not snapshot.compact(min_rows=1):
+            print("Nada para compactar (o hay otro proceso compactando)")
+
+    manifest = snapshot.manifest()
+    if manifest is None:
+        print("No hay snapshot (se genera al levantar el backend)")
+        return
+    size = os.path.getsize(snapshot._path(f"base-{manifest['generation']}.npy"))
+    print(f"📁 Generación {manifest['generation']} ({manifest.get('creado', '?')}): "
+          f"{manifest['rows']} filas en la base ({size / 2**20:.0f} MB), {snapshot.delta_rows()} en el delta")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+# Los módulos del backend se importan por nombre (como al correr desde backend/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """
+    app.py sobre una base vacía en un directorio temporal, con StubCLIP.
+
+    El backend usa rutas relativas al cwd (../cordoba.db, ../images), así que
+    los tests corren dentro de <tmp>/backend como si fuera el proyecto.
+    """
+    backend = tmp_path_factory.mktemp("proyecto") / "backend"
+    backend.mkdir()
+    os.chdir(backend)
+    os.environ.update({"EMBEDDING_SNAPSHOT": "0", "NEIGHBORS_K": "0", "INFERENCE_SOCKET": "",
+                       "QUERY_CACHE_PATH": "", "WARMUP_ENCODE": "0", "CLUSTERS_POLL_SECONDS": "0.1"})
+    import app
+    from benchmark import _use_stub_encoder
+
+    _use_stub_encoder(app)
+    app.start_background_loading()
+    assert app.vectors_ready.wait(30)
+    return app
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    from fastapi.testclient import TestClient
+
+    return TestClient(app_module.app)
+
+
+def jpeg(color=(120, 80, 40), size=(64, 48)):
+    """Bytes de una imagen JPEG chica de un color"""
+    import io
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="JPEG")
+    return buf.getvalue()
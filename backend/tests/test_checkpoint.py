@@ -0,0 +1,71 @@
+import sqlite3
+
+from PIL import Image
+
+from checkpoint import Checkpoint
+
+
+def _jpeg(path, color):
+    Image.new("RGB", (320, 240), color).save(path, format="JPEG")
+    return str(path)
+
+
+def test_resume_and_metadata_change(tmp_path):
+    image = _jpeg(tmp_path / "a.jpg", (200, 10, 10))
+    metadata = ("Centro", "Córdoba Capital", "Plazas", "Plaza San Martín")
+    path = str(tmp_path / "checkpoint.json")
+
+    checkpoint = Checkpoint(path, "v1")
+    assert not checkpoint.is_done(image, metadata)
+    checkpoint.mark_done(image, metadata)
+    checkpoint.save()
+
+    # Otra corrida retoma desde el archivo
+    resumed = Checkpoint(path, "v1")
+    assert resumed.is_done(image, metadata)
+    # Metadata editada: hay que volver a procesarla
+    assert not resumed.is_done(image, metadata[:3] + ("Plaza San Martín, 1920",))
+    # Otro modelo: el checkpoint no vale
+    assert not Checkpoint(path, "v2").is_done(image, metadata)
+
+
+def test_content_change_invalidates(tmp_path):
+    image = _jpeg(tmp_path / "a.jpg", (200, 10, 10))
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), "v1")
+    checkpoint.mark_done(image)
+    _jpeg(tmp_path / "a.jpg", (10, 10, 200))
+    with open(image, "ab") as f:
+        f.write(b"\0")  # mismo mtime posible: que cambie el tamaño
+    assert not checkpoint.is_done(image)
+
+
+def test_bulk_index_rerun_is_idempotent_and_refreshes_metadata(app_module, tmp_path):
+    import bulk_index
+
+    source = tmp_path / "fuente"
+    source.mkdir()
+    filas = [
+        (_jpeg(source / f"{i}.jpg", (40 * i, 90, 160)), "", "Córdoba Capital", "Tranvías", f"Tranvía {i}")
+        for i in range(3)
+    ]
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    indexed, skipped, errors = bulk_index.indexar(filas, 1, 2, 10, checkpoint)
+    assert (indexed, skipped, errors) == (3, 0, 0)
+
+    # Segunda corrida sin cambios: todo salteado por el checkpoint
+    indexed, skipped, errors = bulk_index.indexar(filas, 1, 2, 10, checkpoint)
+    assert (indexed, skipped, errors) == (0, 3, 0)
+
+    # Una descripción editada en el CSV: se actualiza sin re-calcular el embedding
+    filas[1] = filas[1][:4] + ("Tranvía en la Cañada",)
+    indexed, skipped, errors = bulk_index.indexar(filas, 1, 2, 10, checkpoint)
+    assert (indexed, errors) == (0, 0)
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    rows = dict(conn.execute(
+        "SELECT original_path, descripcion FROM imagenes WHERE original_path LIKE ?", (f"{source}%",)
+    ).fetchall())
+    conn.close()
+    assert len(rows) == 3
+    assert rows[filas[1][0]] == "Tranvía en la Cañada"
@@ -0,0 +1,28 @@
+import time
+
+from conftest import jpeg
+from duplicates import find_clusters, write_clusters
+
+
+def index(client, path, data):
+    fields = {"original_path": path, "localidad": "Córdoba Capital", "categoria": "Comparativas"}
+    response = client.post("/index", files={"file": ("foto.jpg", data, "image/jpeg")}, data=fields)
+    assert response.status_code == 200
+
+
+def test_new_clusters_apply_without_restart(client, app_module):
+    data = jpeg((15, 150, 15))
+    index(client, "/dups/original/foto.jpg", data)
+    index(client, "/dups/favoritas/foto.jpg", data)
+    with app_module.db.reader() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM imagenes WHERE original_path LIKE '/dups/%' ORDER BY id")]
+    assert list(app_module.store.cluster_ids(ids)) == ids
+
+    with app_module.db.writer() as conn:
+        clusters, _ = find_clusters(conn)
+        write_clusters(conn, clusters)
+
+    deadline = time.monotonic() + 5
+    while list(app_module.store.cluster_ids(ids)) == ids and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert list(app_module.store.cluster_ids(ids)) == [ids[0], ids[0]]
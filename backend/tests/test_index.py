@@ -0,0 +1,79 @@
+import os
+
+from conftest import jpeg
+
+
+def index(client, path, data, **extra):
+    fields = {"original_path": path, "localidad": "Córdoba Capital", "categoria": "Plazas", **extra}
+    return client.post("/index", files={"file": (os.path.basename(path), data, "image/jpeg")}, data=fields)
+
+
+def test_corrupt_upload_is_400_without_orphan_file(client):
+    antes = set(os.listdir("../images"))
+    response = index(client, "/index/roto.jpg", b"\xff\xd8 no es un jpeg")
+    assert response.status_code == 400
+    assert set(os.listdir("../images")) == antes
+
+
+def test_reindex_same_path_is_idempotent(client, app_module):
+    data = jpeg((30, 60, 90))
+    first = index(client, "/index/plaza.jpg", data)
+    assert first.json()["status"] == "ok"
+    again = index(client, "/index/plaza.jpg", data, descripcion="Plaza San Martín")
+    assert again.json() == {"status": "unchanged", "filename": first.json()["filename"]}
+
+    with app_module.db.reader() as conn:
+        rows = conn.execute("SELECT descripcion FROM imagenes WHERE original_path = '/index/plaza.jpg'").fetchall()
+    assert rows == [("Plaza San Martín",)]
+
+
+def test_copy_reuses_embedding_and_is_stored(client, app_module):
+    data = jpeg((90, 60, 30))
+    assert index(client, "/index/original.jpg", data).status_code == 200
+    copia = index(client, "/index/copia.jpg", data)
+    assert copia.json()["status"] == "ok"
+    assert os.path.exists(f"../images/{copia.json()['filename']}")
+
+    with app_module.db.reader() as conn:
+        embeddings = conn.execute("SELECT embedding FROM imagenes WHERE original_path IN ('/index/original.jpg', '/index/copia.jpg')").fetchall()
+    assert len(embeddings) == 2 and embeddings[0] == embeddings[1]
+
+
+def test_waiting_for_the_writer_does_not_block_the_event_loop(app_module):
+    import asyncio
+    import threading
+    import time
+
+    import httpx
+
+    liberar = threading.Event()
+    tomado = threading.Event()
+
+    def escritor_ocupado():
+        with app_module.db.writer():
+            tomado.set()
+            liberar.wait(5)
+
+    async def main():
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            fields = {"original_path": "/index/lock.jpg", "localidad": "Córdoba Capital", "categoria": "Plazas"}
+            subida = asyncio.create_task(ac.post("/index", files={"file": ("lock.jpg", jpeg((5, 5, 5)), "image/jpeg")}, data=fields))
+            await asyncio.sleep(0.2)  # la subida queda esperando el lock de escritura
+            t0 = time.perf_counter()
+            live = await asyncio.wait_for(ac.get("/health/live"), 2)
+            elapsed = time.perf_counter() - t0
+            assert not subida.done()
+            liberar.set()
+            return live, elapsed, await subida
+
+    hilo = threading.Thread(target=escritor_ocupado)
+    hilo.start()
+    assert tomado.wait(5)
+    try:
+        live, elapsed, subida = asyncio.run(main())
+    finally:
+        liberar.set()
+        hilo.join()
+    assert live.status_code == 200 and elapsed < 1
+    assert subida.json()["status"] == "ok"
@@ -0,0 +1,56 @@
+import json
+
+from conftest import jpeg
+
+
+def post_batch(client, items):
+    files = [("files", (name, data, "image/jpeg")) for name, data, _ in items]
+    metadata = json.dumps([meta for _, _, meta in items])
+    response = client.post("/index/batch", files=files, data={"metadata": metadata})
+    assert response.status_code == 200
+    return response.json()
+
+
+def meta(path, **extra):
+    return {"original_path": path, "localidad": "Córdoba Capital", "categoria": "Calles", **extra}
+
+
+def test_partial_failure_indexes_the_rest(client, app_module):
+    body = post_batch(client, [
+        ("ok.jpg", jpeg((10, 20, 30)), meta("/batch/ok.jpg")),
+        ("roto.jpg", b"esto no es una imagen", meta("/batch/roto.jpg")),
+        ("numero.jpg", jpeg((40, 50, 60)), meta(123)),
+        ("sin_campos.jpg", jpeg((70, 80, 90)), {"original_path": "/batch/sin_campos.jpg"}),
+        ("otro.jpg", jpeg((100, 110, 120)), meta("/batch/otro.jpg")),
+    ])
+    statuses = [item["status"] for item in body["items"]]
+    assert statuses == ["ok", "error", "error", "error", "ok"]
+    assert body["status"] == "partial"
+    assert (body["indexed"], body["errors"]) == (2, 3)
+    assert "original_path" in body["items"][2]["error"]
+    assert "localidad" in body["items"][3]["error"]
+
+    with app_module.db.reader() as conn:
+        paths = {row[0] for row in conn.execute("SELECT original_path FROM imagenes WHERE original_path LIKE '/batch/%'")}
+    assert paths == {"/batch/ok.jpg", "/batch/otro.jpg"}
+
+
+def test_duplicate_path_in_batch_is_rejected(client, app_module):
+    body = post_batch(client, [
+        ("a.jpg", jpeg((1, 2, 3)), meta("/dup/a.jpg")),
+        ("a.jpg", jpeg((4, 5, 6)), meta("/dup/a.jpg")),
+    ])
+    assert [item["status"] for item in body["items"]] == ["ok", "error"]
+    assert "repetido" in body["items"][1]["error"]
+
+    with app_module.db.reader() as conn:
+        (count,) = conn.execute("SELECT COUNT(*) FROM imagenes WHERE original_path = '/dup/a.jpg'").fetchone()
+    assert count == 1
+
+
+def test_reindex_is_unchanged(client):
+    items = [("igual.jpg", jpeg((200, 10, 10)), meta("/batch/igual.jpg"))]
+    assert post_batch(client, items)["items"][0]["status"] == "ok"
+    again = post_batch(client, items)
+    assert again["status"] == "ok"
+    assert again["items"][0]["status"] == "unchanged"
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmark import StubCLIP
+from inference import CLIP_IMAGE_SIZE, InferenceScheduler, prepare_image
+
+
+class CountingCLIP(StubCLIP):
+    """StubCLIP que anota qué le llegó en cada pasada (y puede fallar)."""
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.calls = []
+        self.fail = fail
+
+    def encode(self, items, batch_size=32, **kwargs):
+        self.calls.append(list(items))
+        if self.fail:
+            raise RuntimeError("CLIP se cayó")
+        return super().encode(items, batch_size, **kwargs)
+
+
+class BrokenImage:
+    """Algo que llega como imagen pero no se puede convertir."""
+
+    def convert(self, mode):
+        raise OSError("imagen rota")
+
+
+def test_bad_image_fails_only_its_request():
+    scheduler = InferenceScheduler(StubCLIP(), max_wait_ms=50)
+    good = Image.new("RGB", (300, 400), (10, 20, 30))
+
+    bad_future = scheduler.submit("image", [BrokenImage()])
+    good_future = scheduler.submit("image", [good])
+
+    with pytest.raises(OSError):
+        bad_future.result(timeout=5)
+    assert good_future.result(timeout=5).shape == (1, 512)
+
+    # El thread del scheduler sigue vivo: los pedidos siguientes se resuelven
+    later = scheduler.submit("image", [good]).result(timeout=5)
+    np.testing.assert_array_equal(later, good_future.result())
+
+
+def test_prepare_image_is_idempotent():
+    image = Image.new("RGBA", (1000, 600))
+    prepared = prepare_image(image)
+    assert prepared.mode == "RGB"
+    assert min(prepared.size) == CLIP_IMAGE_SIZE
+    assert prepare_image(prepared).tobytes() == prepared.tobytes()
+
+
+def test_requests_are_batched_fanned_out_and_deduped():
+    model = CountingCLIP()
+    # Sin modelo los pedidos esperan en la cola: al llegar van todos en una pasada
+    scheduler = InferenceScheduler(max_batch=32, max_wait_ms=50)
+    futures = [scheduler.submit("text", texts) for texts in (["plaza"], ["cabildo", "plaza"], ["catedral"])]
+    scheduler.set_model(model)
+
+    results = [f.result(timeout=5) for f in futures]
+    assert [len(r) for r in results] == [1, 2, 1]
+    np.testing.assert_array_equal(results[1][0], model.encode("cabildo"))
+    np.testing.assert_array_equal(results[0][0], results[1][1])
+    # "plaza" se codificó una sola vez
+    assert model.calls[0] == ["plaza", "cabildo", "catedral"]
+    assert scheduler.stats()["batches"] == 1
+
+
+def test_model_failure_fails_the_batch_and_recovers():
+    model = CountingCLIP(fail=True)
+    scheduler = InferenceScheduler(max_wait_ms=50)
+    futures = [scheduler.submit("text", [t]) for t in ("uno", "dos")]
+    scheduler.set_model(model)
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+
+    model.fail = False
+    assert scheduler.submit("text", ["tres"]).result(timeout=5).shape == (1, 512)
+
+
+def test_texts_and_images_are_not_mixed():
+    model = CountingCLIP()
+    scheduler = InferenceScheduler(max_wait_ms=50)
+    text = scheduler.submit("text", ["rio suquia"])
+    image = scheduler.submit("image", [Image.new("RGB", (224, 224), (1, 2, 3))])
+    scheduler.set_model(model)
+
+    assert text.result(timeout=5).shape == image.result(timeout=5).shape == (1, 512)
+    # Dos pasadas, cada una de un solo tipo
+    assert sorted(isinstance(call[0], str) for call in model.calls) == [False, True]
+    assert all(len(call) == 1 for call in model.calls)
+
+
+def test_empty_request_resolves_immediately():
+    scheduler = InferenceScheduler()
+    assert scheduler.submit("image", []).result(timeout=1).shape[0] == 0
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Miniaturas de las imágenes indexadas (256 y 1024 px de lado mayor).
+
+El frontend mostraba los originales de ../images, que pesan varios MB cada
+uno: una grilla de 100 resultados bajaba cientos de MB. Las miniaturas se
+generan al indexar (con la imagen que ya se decodificó para CLIP) y se
+sirven desde /thumbs con cache largo: el nombre sale del hash del contenido,
+así que un archivo de /thumbs nunca cambia.
+
+Para generar las de imágenes indexadas antes de que existieran:
+    cd backend
+    python thumbnails.py
+    python thumbnails.py --workers 8 --force
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, features
+
+THUMB_DIR = "../thumbs"
+# Lado mayor de cada miniatura (el frontend usa la chica en la grilla y la grande al ampliar)
+THUMB_SIZES = (256, 1024)
+# "webp" (default) o "jpeg"; si Pillow no tiene soporte para WebP se usa JPEG
+THUMB_FORMAT = os.environ.get("THUMB_FORMAT", "webp").lower()
+if THUMB_FORMAT == "webp" and not features.check("webp"):
+    THUMB_FORMAT = "jpeg"
+THUMB_QUALITY = int(os.environ.get("THUMB_QUALITY", "80"))
+
+_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+
+def thumb_name(content_hash: str, size: int) -> str:
+    """Ruta de la miniatura relativa a THUMB_DIR (y a /thumbs)."""
+    return f"{size}/{content_hash[:32]}.{_EXTENSIONS[THUMB_FORMAT]}"
+
+
+def thumb_urls(content_hash: str):
+    """URLs de las miniaturas por tamaño, o None si la fila no tiene hash."""
+    if not content_hash:
+        return None
+    return {str(size): f"/thumbs/{thumb_name(content_hash, size)}" for size in THUMB_SIZES}
+
+
+def has_thumbnails(content_hash: str) -> bool:
+    return all(os.path.exists(os.path.join(THUMB_DIR, thumb_name(content_hash, size))) for size in THUMB_SIZES)
+
+
+def make_thumbnails(image, content_hash: str, force: bool = False) -> int:
+    """
+    Genera las miniaturas de una imagen ya decodificada.
+
+    Args:
+        image: PIL.Image (no se modifica)
+        content_hash: sha256 del archivo original (da el nombre)
+        force: Regenerar aunque ya existan
+
+    Returns:
+        Cantidad de miniaturas escritas
+    """
+    pending = [size for size in sorted(THUMB_SIZES, reverse=True)
+               if force or not os.path.exists(os.path.join(THUMB_DIR, thumb_name(content_hash, size)))]
+    if not pending:
+        return 0
+
+    # Respetar la orientación EXIF, como hace el navegador con el original
+    thumb = ImageOps.exif_transpose(image).convert("RGB")
+    for size in pending:
+        # De la más grande a la más chica: cada una se achica a partir de la anterior
+        thumb.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+        path = os.path.join(THUMB_DIR, thumb_name(content_hash, size))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        thumb.save(tmp, format=THUMB_FORMAT.upper(), quality=THUMB_QUALITY)
+        os.replace(tmp, path)
+    return len(pending)
+
+
+def backfill_image(row_id: int, filename: str, content_hash: str, force: bool = False):
+    """
+    Genera las miniaturas de una imagen de ../images (corre en el pool).
+
+    Devuelve (id, hash, miniaturas escritas) o un string con el error. El hash
+    se calcula si la fila no lo tenía (filas indexadas antes de guardarlo).
+    """
+    try:
+        path = f"../images/{filename}"
+        if not content_hash:
+            with open(path, "rb") as f:
+                content_hash = hashlib.sha256(f.read()).hexdigest()
+        if not force and has_thumbnails(content_hash):
+            return row_id, content_hash, 0
+        with Image.open(path) as img:
+            # En JPEG, draft decodifica directamente a menor resolución
+            img.draft("RGB", (max(THUMB_SIZES), max(THUMB_SIZES)))
+            return row_id, content_hash, make_thumbnails(img, content_hash, force)
+    except Exception as e:
+        return f"{filename}: {type(e).__name__}: {e}"
+
+
+def backfill(db_path: str, workers: int, force: bool = False):
+    """Genera las miniaturas que faltan para todas las filas de la DB."""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT id, filename, content_hash FROM imagenes ORDER BY id").fetchall()
+    print(f"📁 {len(rows)} imágenes en la DB")
+
+    written = 0
+    errors = 0
+    hashes = []  # (hash, id) de filas que no lo tenían
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(backfill_image, *zip(*rows), [force] * len(rows), chunksize=32) if rows else []
+        for (row_id, _, previous_hash), result in zip(rows, results):
+            if isinstance(result, str):
+                print(f"❌ {result}")
+                errors += 1
+                continue
+            written += result[2]
+            if not previous_hash:
+                hashes.append((result[1], row_id))
+
+    if hashes:
+        with conn:
+            conn.executemany("UPDATE imagenes SET content_hash = ? WHERE id = ?", hashes)
+    conn.close()
+    return written, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generar miniaturas de imágenes ya indexadas")
+    parser.add_argument("--db", default="../cordoba.db")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="Regenerar aunque ya existan")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    written, errors = backfill(args.db, args.workers, args.force)
+    print(f"✅ {written} miniaturas generadas ({THUMB_FORMAT}) en {time.perf_counter() - t0:.1f}s")
+    if errors:
+        print(f"❌ Errores: {errors}")
+
+
+if __name__ == "__main__":
+    main()
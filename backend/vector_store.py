@@ -0,0 +1,443 @@
+"""
+Matriz de embeddings residente en memoria para la búsqueda semántica.
+
+Se carga una sola vez al levantar el backend y se actualiza en el lugar
+con cada /index, así el scoring es un único producto matriz-vector.
+
+Las filas pueden estar en dos tramos: una base de solo lectura (el snapshot
+mapeado en memoria, compartido entre procesos, ver snapshot.py) y un buffer
+propio del proceso con lo que se agregó después.
+"""
+
+import json
+import threading
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+# Columnas de `imagenes` que se pueden usar como filtro
+FACETS = ("barrio", "localidad", "categoria")
+
+# Formatos binarios soportados para la columna `embedding`
+EMBEDDING_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def encode_embedding(embedding, dtype: str = "float32") -> bytes:
+    """Serializa un embedding como BLOB (float32 o float16, little-endian)."""
+    return np.asarray(embedding, dtype=np.dtype(EMBEDDING_DTYPES[dtype]).newbyteorder("<")).tobytes()
+
+
+def decode_embedding(value, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """
+    Lee un embedding guardado en la DB.
+
+    Acepta el formato binario (el dtype se deduce del largo del BLOB) y el
+    formato viejo en JSON (TEXT), para bases todavía no migradas.
+    """
+    if isinstance(value, str):
+        return np.array(json.loads(value), dtype=np.float32)
+    if len(value) == dim * 2:
+        return np.frombuffer(value, dtype="<f2").astype(np.float32)
+    return np.frombuffer(value, dtype="<f4").astype(np.float32)
+
+
+def decode_embeddings(values, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """Decodifica muchos embeddings de una vez a una matriz (n, dim) float32."""
+    if not values:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    # Camino rápido: todos BLOBs del mismo tamaño → una sola copia de memoria
+    first = values[0]
+    if isinstance(first, bytes) and all(isinstance(v, bytes) and len(v) == len(first) for v in values):
+        dtype = "<f2" if len(first) == dim * 2 else "<f4"
+        matrix = np.frombuffer(b"".join(values), dtype=dtype).reshape(len(values), dim)
+        return matrix.astype(np.float32)
+
+    return np.stack([decode_embedding(v, dim) for v in values])
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Posiciones de los k scores más altos, ordenadas de mayor a menor.
+
+    Usa argpartition: O(n + k log k) en vez de ordenar todo.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def normalize(vectors):
+    """Normaliza (L2) un vector o una matriz de vectores fila a float32."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class EmbeddingStore:
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        """
+        Guarda los embeddings normalizados en una matriz float32 contigua.
+
+        Args:
+            dim: Dimensión de los embeddings (512 para CLIP ViT-B/32)
+        """
+        self.dim = dim
+        self._lock = threading.Lock()
+        # Filas 0..len(_base)-1: snapshot mapeado en memoria (copy-on-write:
+        # reemplazar una fila copia solo esa página en este proceso)
+        self._base = np.zeros((0, dim), dtype=np.float32)
+        # Filas siguientes: buffer con capacidad extra para que agregar sea O(1) amortizado
+        self._buffer = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        self._positions = {}  # id de la DB -> fila en la matriz
+        # Facetas: por cada columna, valor -> set de filas con ese valor
+        self._facets = {facet: {} for facet in FACETS}
+        self._row_facets = {}  # fila -> (barrio, localidad, categoria)
+        self._facet_cache = {}  # (faceta, valor) -> array ordenado de filas
+        # Grupo de casi-duplicados de cada fila (el id de la primera del grupo;
+        # el propio id si no tiene copias). Ver duplicates.py
+        self._clusters = np.zeros(0, dtype=np.int64)
+        self._visible = None  # filas que quedan al colapsar duplicados (None = todas)
+        self._visible_valid = False  # si _visible está calculado (None también es un resultado)
+        # Cambia con cada modificación: invalida lo que se haya cacheado de búsquedas anteriores
+        self.version = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        Las filas ocupadas (ya normalizadas).
+
+        Es una vista salvo que haya base y filas agregadas a la vez: ahí se
+        copia todo (para herramientas offline; las búsquedas usan `dot` y `rows`).
+        """
+        base, buffer, size = self._segments()
+        if len(base) == 0:
+            return buffer[:size]
+        if size == len(base):
+            return base
+        return np.concatenate([base, buffer[:size - len(base)]])
+
+    def _segments(self):
+        """(base, buffer, filas) leídos juntos: `rebase` puede cambiar los tres."""
+        with self._lock:
+            return self._base, self._buffer, self._size
+
+    def rows(self, positions) -> np.ndarray:
+        """Copia de las filas dadas (de la base o del buffer)."""
+        positions = np.asarray(positions, dtype=np.int64)
+        base, buffer, _ = self._segments()
+        if len(base) == 0:
+            return buffer[positions]
+        if len(positions) == 0 or positions.max() < len(base):
+            return base[positions]
+        result = np.empty((len(positions), self.dim), dtype=np.float32)
+        in_base = positions < len(base)
+        result[in_base] = base[positions[in_base]]
+        result[~in_base] = buffer[positions[~in_base] - len(base)]
+        return result
+
+    def dot(self, other: np.ndarray) -> np.ndarray:
+        """`matrix @ other` sin juntar los dos tramos (other: vector (dim,) o matriz (dim, m))."""
+        base, buffer, size = self._segments()
+        if len(base) == 0:
+            return buffer[:size] @ other
+        if size == len(base):
+            return base @ other
+        return np.concatenate([base @ other, buffer[:size - len(base)] @ other])
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Ids de la tabla `imagenes` en el mismo orden que `matrix`."""
+        return self._ids[:self._size]
+
+    def load_from_db(self, conn):
+        """Carga todos los embeddings (sus facetas y grupos de duplicados) de la tabla `imagenes`."""
+        c = conn.cursor()
+        columns = {r[1] for r in c.execute("PRAGMA table_info(imagenes)")}
+        cluster = "cluster_id" if "cluster_id" in columns else "NULL"
+        c.execute(f"SELECT id, {', '.join(FACETS)}, {cluster}, embedding FROM imagenes ORDER BY id")
+        rows = c.fetchall()
+
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        matrix = decode_embeddings([r[-1] for r in rows], self.dim)
+        clusters = np.array([r[-2] if r[-2] is not None else r[0] for r in rows], dtype=np.int64)
+
+        self._load(ids, np.zeros((0, self.dim), dtype=np.float32), normalize(matrix), clusters,
+                   [row[1:1 + len(FACETS)] for row in rows])
+
+    def load_base(self, conn, ids: np.ndarray, base: np.ndarray):
+        """
+        Carga un snapshot: los embeddings ya normalizados en `base` (en el
+        orden de `ids`, sin copiarlos) y las facetas y grupos desde la DB.
+        Los ids que no están en la DB quedan sin facetas.
+        """
+        c = conn.cursor()
+        columns = {r[1] for r in c.execute("PRAGMA table_info(imagenes)")}
+        cluster = "cluster_id" if "cluster_id" in columns else "NULL"
+        c.execute(f"SELECT id, {', '.join(FACETS)}, {cluster} FROM imagenes")
+        meta = {r[0]: r[1:] for r in c.fetchall()}
+
+        ids = np.asarray(ids, dtype=np.int64)
+        empty = ("",) * len(FACETS) + (None,)
+        rows = [meta.get(row_id, empty) for row_id in ids.tolist()]
+        clusters = np.array([r[-1] if r[-1] is not None else row_id for row_id, r in zip(ids.tolist(), rows)],
+                            dtype=np.int64)
+        self._load(ids.copy(), base, np.zeros((0, self.dim), dtype=np.float32), clusters,
+                   [r[:len(FACETS)] for r in rows])
+
+    def _load(self, ids, base, buffer, clusters, facets):
+        with self._lock:
+            self._base = base
+            self._buffer = buffer
+            self._ids = ids
+            self._clusters = clusters
+            self._visible_valid = False
+            self._size = len(ids)
+            self._positions = {int(row_id): pos for pos, row_id in enumerate(ids)}
+            self._facets = {facet: {} for facet in FACETS}
+            self._row_facets = {}
+            self._facet_cache = {}
+            for pos, values in enumerate(facets):
+                self._set_facets(pos, values)
+            self.version += 1
+
+    def rebase(self, base: np.ndarray):
+        """
+        Pasa a usar una base más larga cuyas filas son exactamente las
+        primeras len(base) filas actuales (un snapshot compactado): las que
+        estaban en el buffer se liberan. No cambia ninguna posición.
+        """
+        with self._lock:
+            old = len(self._base)
+            if not old <= len(base) <= self._size:
+                raise ValueError("La base nueva no coincide con las filas cargadas")
+            rest = self._buffer[len(base) - old:self._size - old]
+            buffer = np.zeros((max(len(rest), 1024), self.dim), dtype=np.float32)
+            buffer[:len(rest)] = rest
+            self._base = base
+            self._buffer = buffer
+
+    def _set_facets(self, pos: int, values):
+        """Registra los valores de faceta de una fila (reemplaza los anteriores)."""
+        old = self._row_facets.get(pos)
+        for facet, value in zip(FACETS, values):
+            value = value or ""
+            if old is not None:
+                previous = old[FACETS.index(facet)]
+                if previous == value:
+                    continue
+                self._facets[facet][previous].discard(pos)
+                self._facet_cache.pop((facet, previous), None)
+            self._facets[facet].setdefault(value, set()).add(pos)
+            self._facet_cache.pop((facet, value), None)
+        self._row_facets[pos] = tuple(v or "" for v in values)
+
+    def _reserve(self, extra: int):
+        """Agranda el buffer (duplicando) si no entran `extra` filas más."""
+        base = len(self._base)
+        needed = self._size + extra
+        if needed <= base + len(self._buffer) and needed <= len(self._ids):
+            return
+        capacity = max(needed - base, 2 * len(self._buffer), 1024)
+        buffer = np.zeros((capacity, self.dim), dtype=np.float32)
+        buffer[:self._size - base] = self._buffer[:self._size - base]
+        capacity += base
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        clusters = np.zeros(capacity, dtype=np.int64)
+        clusters[:self._size] = self._clusters[:self._size]
+        # Se reemplazan los arrays (no se modifican) para que las vistas
+        # que tengan otras búsquedas en curso sigan siendo válidas
+        self._buffer = buffer
+        self._ids = ids
+        self._clusters = clusters
+
+    def add(self, row_ids, embeddings, facets=None):
+        """
+        Agrega (o reemplaza) embeddings para los ids dados.
+
+        Args:
+            row_ids: Id o lista de ids de la tabla `imagenes`
+            embeddings: Vector o matriz de embeddings (sin normalizar)
+            facets: Por cada id, tupla (barrio, localidad, categoria)
+        """
+        row_ids = [int(r) for r in np.atleast_1d(row_ids)]
+        vectors = normalize(np.atleast_2d(embeddings))
+
+        with self._lock:
+            nuevos = [i for i, r in enumerate(row_ids) if r not in self._positions]
+            self._reserve(len(nuevos))
+            for i, row_id in enumerate(row_ids):
+                pos = self._positions.get(row_id)
+                if pos is None:
+                    pos = self._size
+                    self._ids[pos] = row_id
+                    self._clusters[pos] = row_id
+                    self._positions[row_id] = pos
+                    self._size += 1
+                if pos < len(self._base):
+                    self._base[pos] = vectors[i]
+                else:
+                    self._buffer[pos - len(self._base)] = vectors[i]
+                if facets is not None:
+                    self._set_facets(pos, facets[i])
+            if nuevos:
+                self._visible_valid = False
+            self.version += 1
+
+    def set_facets(self, row_id: int, facets):
+        """Actualiza barrio/localidad/categoría de una fila ya cargada."""
+        with self._lock:
+            pos = self._positions.get(int(row_id))
+            if pos is not None:
+                self._set_facets(pos, facets)
+                self.version += 1
+
+    def set_clusters(self, clusters: dict):
+        """
+        Reemplaza los grupos de casi-duplicados.
+
+        Args:
+            clusters: id -> id del grupo (la primera imagen del grupo). Las
+                filas que no aparecen quedan solas
+        """
+        with self._lock:
+            ids = self._ids[:self._size]
+            self._clusters[:self._size] = [clusters.get(int(r), int(r)) for r in ids]
+            self._visible_valid = False
+            self.version += 1
+
+    @property
+    def hidden(self) -> int:
+        """Cantidad de filas que se ocultan al colapsar duplicados."""
+        return int(np.count_nonzero(self._clusters[:self._size] != self._ids[:self._size]))
+
+    def cluster_ids(self, row_ids) -> np.ndarray:
+        """Grupo de cada id (el propio id si no está cargado o no tiene copias)."""
+        clusters = np.array(row_ids, dtype=np.int64)
+        pos = self.positions(clusters)
+        valid = pos >= 0
+        clusters[valid] = self._clusters[pos[valid]]
+        return clusters
+
+    def _collapse(self, positions: np.ndarray = None):
+        """
+        Deja una fila por grupo de duplicados: la primera (menor id) de las
+        candidatas. Sin candidatas (todo el store) el resultado se cachea.
+        """
+        if positions is None:
+            if not self._visible_valid:
+                keep = self._clusters[:self._size] == self._ids[:self._size]
+                self._visible = None if keep.all() else np.nonzero(keep)[0]
+                self._visible_valid = True
+            return self._visible
+        clusters = self._clusters[positions]
+        if len(positions) == 0 or np.array_equal(clusters, self._ids[positions]):
+            return positions
+        _, first = np.unique(clusters, return_index=True)
+        return positions[np.sort(first)]
+
+    def positions(self, row_ids) -> np.ndarray:
+        """Filas de la matriz para los ids dados (-1 si no están cargados)."""
+        return np.array([self._positions.get(int(r), -1) for r in row_ids], dtype=np.int64)
+
+    def _facet_positions(self, facet: str, value: str) -> np.ndarray:
+        key = (facet, value)
+        cached = self._facet_cache.get(key)
+        if cached is None:
+            cached = np.array(sorted(self._facets[facet].get(value, ())), dtype=np.int64)
+            self._facet_cache[key] = cached
+        return cached
+
+    def select(self, collapse: bool = False, **filters) -> np.ndarray:
+        """
+        Filas que cumplen todos los filtros de faceta dados.
+
+        Ej: store.select(categoria="Transporte Público", barrio="Centro")
+        Los filtros vacíos o None se ignoran. Sin filtros devuelve None
+        (todas las filas). Con `collapse` queda una sola fila por grupo de
+        casi-duplicados.
+        """
+        with self._lock:
+            selected = None
+            # Empezar por la faceta más chica para que la intersección sea barata
+            arrays = sorted(
+                (self._facet_positions(facet, value) for facet, value in filters.items() if value),
+                key=len
+            )
+            if collapse and not arrays:
+                return self._collapse()
+        for positions in arrays:
+            selected = positions if selected is None else np.intersect1d(selected, positions, assume_unique=True)
+        if collapse:
+            selected = self._collapse(selected)
+        return selected
+
+    def candidate_scores(self, query_embedding, positions: np.ndarray = None):
+        """
+        Similitud de la query contra las filas candidatas, en un solo paso vectorizado.
+
+        Args:
+            query_embedding: Embedding de la query (se normaliza acá)
+            positions: Filas candidatas (de `select`). None = todo el store
+
+        Returns:
+            (ids, similitudes) en el orden de las filas (sin ordenar)
+        """
+        query = normalize(query_embedding)
+        ids = self.ids
+
+        if positions is None:
+            return ids, self.dot(query)
+        if len(positions) > len(ids) // 2:
+            # Casi todo el store (ej. sin duplicados): más barato que copiar las filas
+            return ids[positions], self.dot(query)[positions]
+        return ids[positions], self.rows(positions) @ query
+
+    def top(self, query_embedding, limit: int, positions: np.ndarray = None):
+        """Los `limit` más similares a la query: (ids, similitudes) de mayor a menor."""
+        ids, similarities = self.candidate_scores(query_embedding, positions)
+        order = top_k(similarities, limit)
+        return ids[order], similarities[order]
+
+    def vector(self, row_id: int):
+        """Embedding normalizado de una fila (copia), o None si no está cargada."""
+        pos = self._positions.get(int(row_id))
+        if pos is None:
+            return None
+        return self.rows([pos])[0]
+
+    def scores(self, query_embedding, row_ids=None) -> np.ndarray:
+        """
+        Similitud coseno entre la query y las imágenes.
+
+        Args:
+            query_embedding: Embedding de la query (se normaliza acá)
+            row_ids: Ids a puntuar, en ese orden. Si es None se puntúa todo
+                el store en el orden de `ids`.
+
+        Returns:
+            Array float32 de similitudes (NaN para ids sin embedding cargado)
+        """
+        query = normalize(query_embedding)
+
+        if row_ids is None:
+            return self.dot(query)
+
+        pos = self.positions(row_ids)
+        valid = pos >= 0
+        result = np.full(len(pos), np.nan, dtype=np.float32)
+        result[valid] = self.rows(pos[valid]) @ query
+        return result
@@ -4,9 +4,14 @@ from pathlib import Path
 from typing import List, Tuple
 import sys
 import random
+import time
+import threading
+import queue
+from collections import OrderedDict
 
 class ImageGridViewer:
-    def __init__(self, image_dir: str, columnas: int = 3, filas: int = 5, fade_speed: float = 3.0):
+    def __init__(self, image_dir: str, columnas: int = 3, filas: int = 5, fade_speed: float = 3.0,
+                 cache_pages: int = 4):
         """
         Inicializa el visualizador de imágenes en grilla.
         
@@ -15,6 +20,8 @@ class ImageGridViewer:
             columnas: Número de columnas en la grilla
             filas: Número de filas en la grilla
             fade_speed: Velocidad del fade in (1.0 = lento, 10.0 = muy rápido)
+            cache_pages: Páginas de imágenes ya escaladas que se guardan en memoria
+                         (mínimo 3: la actual, la siguiente y la anterior)
         """
         pygame.init()
         
@@ -41,6 +48,12 @@ class ImageGridViewer:
         self.spiral_mode = False  # Toggle para modo espiral
         self.spiral_positions = []  # Posiciones de las imágenes en modo espiral
         
+        # Estado de render: sólo se redibujan las imágenes que cambiaron
+        self.image_rects = []  # Rectángulo en pantalla de cada imagen
+        self._applied_alphas = []  # Último alpha aplicado a cada Surface
+        self._dirty = set()  # Imágenes a redibujar en el próximo cuadro
+        self._full_redraw = True  # Redibujar toda la pantalla
+        
         # Colores
         self.BG_COLOR = (0, 0, 0)  # Negro
         
@@ -54,8 +67,30 @@ class ImageGridViewer:
         
         # Clock para controlar FPS
         self.clock = pygame.time.Clock()
+        self.target_fps = 60
         self.running = True
         
+        # Estadísticas de render, se informan cada stats_interval segundos
+        self.stats_interval = 5.0
+        self._stats_start = time.perf_counter()
+        self._frames_drawn = 0
+        self._frames_dropped = 0
+        self._draw_time_total = 0.0
+        self._draw_time_max = 0.0
+        
+        # Precarga en segundo plano: un hilo decodifica y escala las páginas
+        # vecinas; la conversión al formato de pantalla se hace en el hilo
+        # principal (convert_alpha necesita el display) al recibir cada imagen.
+        self.cache_size = max(cache_pages, 3) * self.images_per_page
+        self._image_cache = OrderedDict()  # ruta -> Surface convertida (LRU)
+        self._prefetch_ready = queue.Queue()  # (ruta, Surface escalada o None)
+        self._prefetch_wanted = []  # Rutas pendientes, en orden de prioridad
+        self._prefetch_cond = threading.Condition()
+        self._prefetch_thread = threading.Thread(
+            target=self._prefetch_worker, name="prefetch", daemon=True
+        )
+        self._prefetch_thread.start()
+        
     def _load_image_paths(self, directory: str) -> List[str]:
         """Carga todas las rutas de imágenes válidas del directorio."""
         valid_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp'}
@@ -110,34 +145,124 @@ class ImageGridViewer:
         
         return pygame.transform.smoothscale(image, (new_width, new_height))
     
-    def _load_page_images(self):
-        """Carga y procesa las imágenes de la página actual."""
-        self.loaded_images = []
-        self.image_alphas = []
-        start_idx = self.current_page * self.images_per_page
+    def _decode_image(self, path: str) -> pygame.Surface:
+        """Decodifica una imagen y la escala al tamaño de celda (sin convertir)."""
+        img = pygame.image.load(path)
+        return self._fit_image_to_cell(img)
+    
+    def _placeholder(self) -> pygame.Surface:
+        """Imagen gris que reemplaza a las que no se pudieron cargar."""
+        placeholder = pygame.Surface((100, 100), pygame.SRCALPHA)
+        placeholder.fill((50, 50, 50, 255))
+        return placeholder
+    
+    def _page_paths(self, page: int) -> List[str]:
+        """Rutas de las imágenes de una página (vacío si está fuera de rango)."""
+        if page < 0:
+            return []
+        start_idx = page * self.images_per_page
         end_idx = min(start_idx + self.images_per_page, len(self.image_paths))
-        
-        for i in range(start_idx, end_idx):
+        return self.image_paths[start_idx:end_idx]
+    
+    def _cache_put(self, path: str, img: pygame.Surface):
+        """Guarda una imagen convertida en el LRU, descartando las más viejas."""
+        self._image_cache[path] = img
+        self._image_cache.move_to_end(path)
+        while len(self._image_cache) > self.cache_size:
+            self._image_cache.popitem(last=False)
+    
+    def _prefetch_worker(self):
+        """Hilo de precarga: decodifica y escala las rutas pedidas en orden."""
+        while True:
+            with self._prefetch_cond:
+                while not self._prefetch_wanted and self.running:
+                    self._prefetch_cond.wait()
+                if not self.running:
+                    return
+                path = self._prefetch_wanted.pop(0)
+            try:
+                img = self._decode_image(path)
+            except Exception as e:
+                print(f"Error cargando {path}: {e}")
+                img = None
+            self._prefetch_ready.put((path, img))
+    
+    def _collect_prefetched(self):
+        """Convierte en el hilo principal las imágenes que ya dejó el hilo de precarga."""
+        while True:
             try:
-                img = pygame.image.load(self.image_paths[i])
-                img = self._fit_image_to_cell(img)
+                path, img = self._prefetch_ready.get_nowait()
+            except queue.Empty:
+                return
+            if img is None:
+                img = self._placeholder()
+            else:
                 # Convertir a formato que soporte alpha
                 img = img.convert_alpha()
-                self.loaded_images.append(img)
-                self.image_alphas.append(0)  # Empezar invisible
-            except Exception as e:
-                print(f"Error cargando {self.image_paths[i]}: {e}")
-                # Crear una imagen placeholder en caso de error
-                placeholder = pygame.Surface((100, 100), pygame.SRCALPHA)
-                placeholder.fill((50, 50, 50, 255))
-                self.loaded_images.append(placeholder)
-                self.image_alphas.append(0)
+            self._cache_put(path, img)
+    
+    def _schedule_prefetch(self):
+        """Pide al hilo de precarga la página siguiente y la anterior."""
+        wanted = []
+        for page in (self.current_page + 1, self.current_page - 1):
+            for path in self._page_paths(page):
+                if path in self._image_cache:
+                    # Refrescar en el LRU para que no se descarte antes de usarla
+                    self._image_cache.move_to_end(path)
+                elif path not in wanted:
+                    wanted.append(path)
+        with self._prefetch_cond:
+            # Reemplaza lo pendiente: al pasar rápido de página sólo importan
+            # las vecinas de la página actual
+            self._prefetch_wanted = wanted
+            self._prefetch_cond.notify()
+    
+    def _stop_prefetch(self):
+        """Detiene el hilo de precarga."""
+        with self._prefetch_cond:
+            self._prefetch_wanted = []
+            self._prefetch_cond.notify()
+        self._prefetch_thread.join(timeout=1.0)
+    
+    def _load_page_images(self):
+        """
+        Carga y procesa las imágenes de la página actual.
+        
+        Usa las imágenes ya precargadas; las que falten (primera página o si
+        se avanza más rápido que la precarga) se cargan acá mismo.
+        """
+        self.loaded_images = []
+        self.image_alphas = []
+        with self._prefetch_cond:
+            # Lo pendiente era para la página anterior; las vecinas nuevas se
+            # piden al final
+            self._prefetch_wanted = []
+        self._collect_prefetched()
+        
+        for path in self._page_paths(self.current_page):
+            img = self._image_cache.get(path)
+            if img is None:
+                try:
+                    img = self._decode_image(path)
+                    # Convertir a formato que soporte alpha
+                    img = img.convert_alpha()
+                except Exception as e:
+                    print(f"Error cargando {path}: {e}")
+                    # Crear una imagen placeholder en caso de error
+                    img = self._placeholder()
+            self._cache_put(path, img)
+            self.loaded_images.append(img)
+            self.image_alphas.append(0)  # Empezar invisible
+        
+        # Precargar las páginas vecinas mientras se muestra esta
+        self._schedule_prefetch()
         
         # Generar orden de aparición
         self._generate_fade_order()
         
         # Calcular posiciones en espiral
         self._calculate_spiral_positions()
+        self._layout_images()
         
         # Iniciar animación de fade in
         self.current_fade_index = 0
@@ -195,6 +320,7 @@ class ImageGridViewer:
             
             # Incrementar el alpha de la imagen actual
             self.image_alphas[actual_image_index] += self.fade_speed * delta_time * 255
+            self._dirty.add(actual_image_index)
             
             # Si esta imagen completó su fade, pasar a la siguiente
             if self.image_alphas[actual_image_index] >= 255:
@@ -205,46 +331,124 @@ class ImageGridViewer:
                 if self.current_fade_index >= len(self.loaded_images):
                     self.fade_active = False
     
-    def _draw_grid(self):
-        """Dibuja todas las imágenes en la grilla con su alpha correspondiente."""
+    def _layout_images(self):
+        """Calcula el rectángulo de cada imagen según el modo (grilla o espiral)."""
+        self.image_rects = []
         for idx, img in enumerate(self.loaded_images):
-            # Solo dibujar imágenes que ya tienen algo de alpha
-            if idx < len(self.image_alphas) and self.image_alphas[idx] > 0:
-                
-                if self.spiral_mode:
-                    # Modo espiral: usar posiciones calculadas
-                    if idx < len(self.spiral_positions):
-                        spiral_x, spiral_y = self.spiral_positions[idx]
-                        img_width, img_height = img.get_size()
-                        
-                        # Centrar la imagen en la posición espiral
-                        x = spiral_x - img_width / 2
-                        y = spiral_y - img_height / 2
-                else:
-                    # Modo grilla normal
-                    row = idx // self.columnas
-                    col = idx % self.columnas
-                    
-                    # Calcular posición de la celda
-                    cell_x = self.margin + col * (self.cell_width + self.margin)
-                    cell_y = self.margin + row * (self.cell_height + self.margin)
-                    
-                    # Centrar la imagen dentro de la celda
-                    img_width, img_height = img.get_size()
-                    x = cell_x + (self.cell_width - img_width) // 2
-                    y = cell_y + (self.cell_height - img_height) // 2
+            img_width, img_height = img.get_size()
+            
+            if self.spiral_mode:
+                # Modo espiral: centrar la imagen en la posición calculada
+                spiral_x, spiral_y = self.spiral_positions[idx]
+                x = int(spiral_x - img_width / 2)
+                y = int(spiral_y - img_height / 2)
+            else:
+                # Modo grilla normal
+                row = idx // self.columnas
+                col = idx % self.columnas
                 
-                # Aplicar alpha a la imagen
-                img_copy = img.copy()
-                img_copy.set_alpha(int(self.image_alphas[idx]))
+                # Calcular posición de la celda
+                cell_x = self.margin + col * (self.cell_width + self.margin)
+                cell_y = self.margin + row * (self.cell_height + self.margin)
                 
-                self.screen.blit(img_copy, (x, y))
+                # Centrar la imagen dentro de la celda
+                x = cell_x + (self.cell_width - img_width) // 2
+                y = cell_y + (self.cell_height - img_height) // 2
+            
+            self.image_rects.append(pygame.Rect(x, y, img_width, img_height))
+        
+        # Las Surfaces vienen del cache con el alpha de la última vez que se usaron
+        self._applied_alphas = [-1] * len(self.loaded_images)
+        self._dirty.clear()
+        self._full_redraw = True
+    
+    def _blit_image(self, idx: int):
+        """Dibuja una imagen con su alpha actual, sin copiar la Surface."""
+        alpha = int(self.image_alphas[idx])
+        if alpha <= 0:
+            return
+        
+        img = self.loaded_images[idx]
+        # Aplicar alpha sobre la misma Surface sólo cuando cambia
+        if self._applied_alphas[idx] != alpha:
+            img.set_alpha(alpha)
+            self._applied_alphas[idx] = alpha
+        
+        self.screen.blit(img, self.image_rects[idx])
+    
+    def _draw_grid(self) -> List[pygame.Rect]:
+        """
+        Dibuja lo que cambió desde el cuadro anterior.
+        
+        Devuelve las zonas de pantalla a actualizar; vacío si la página está
+        quieta (fade terminado), en cuyo caso no se toca la pantalla.
+        """
+        if self._full_redraw:
+            self._full_redraw = False
+            self._dirty.clear()
+            self.screen.fill(self.BG_COLOR)
+            for idx in range(len(self.loaded_images)):
+                self._blit_image(idx)
+            return [self.screen.get_rect()]
+        
+        if not self._dirty:
+            return []
+        
+        screen_rect = self.screen.get_rect()
+        rects = []
+        for idx in sorted(self._dirty):
+            rect = self.image_rects[idx].clip(screen_rect)
+            if rect.width and rect.height:
+                rects.append(rect)
+        self._dirty.clear()
+        
+        # Limpiar cada zona y volver a dibujar, en orden, las imágenes que la
+        # tocan (en modo espiral se superponen)
+        for rect in rects:
+            self.screen.set_clip(rect)
+            self.screen.fill(self.BG_COLOR, rect)
+            for idx in rect.collidelistall(self.image_rects):
+                self._blit_image(idx)
+        self.screen.set_clip(None)
+        
+        return rects
+    
+    def _record_frame(self, frame_ms: int, draw_seconds: float):
+        """Acumula el tiempo de un cuadro dibujado y si se pasó del presupuesto."""
+        self._frames_drawn += 1
+        self._draw_time_total += draw_seconds
+        self._draw_time_max = max(self._draw_time_max, draw_seconds)
+        # Cuadro perdido: tardó más de 1.5 veces lo que corresponde al FPS objetivo
+        if frame_ms > 1500 / self.target_fps:
+            self._frames_dropped += 1
+    
+    def _report_render_stats(self, force: bool = False):
+        """Informa por consola cuadros dibujados, perdidos y tiempo de dibujo."""
+        now = time.perf_counter()
+        elapsed = now - self._stats_start
+        if not force and elapsed < self.stats_interval:
+            return
+        
+        if self._frames_drawn:
+            avg_ms = self._draw_time_total / self._frames_drawn * 1000
+            print(f"Render: {self._frames_drawn} cuadros en {elapsed:.1f}s, "
+                  f"{self._frames_dropped} perdidos, "
+                  f"dibujo medio {avg_ms:.1f} ms, máx {self._draw_time_max * 1000:.1f} ms")
+        
+        self._stats_start = now
+        self._frames_drawn = 0
+        self._frames_dropped = 0
+        self._draw_time_total = 0.0
+        self._draw_time_max = 0.0
     
     def _handle_events(self):
         """Maneja los eventos de pygame."""
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
+            elif event.type == pygame.VIDEOEXPOSE:
+                # La ventana quedó tapada o se restauró: redibujar todo
+                self._full_redraw = True
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE or event.key == pygame.K_q:
                     self.running = False
@@ -308,6 +512,7 @@ class ImageGridViewer:
         
         # Recalcular posiciones espirales
         self._calculate_spiral_positions()
+        self._layout_images()
         
         self.current_fade_index = 0
         self.fade_active = True
@@ -328,11 +533,16 @@ class ImageGridViewer:
                 pygame.NOFRAME
             )
             print("Modo: VENTANA")
+        
+        # La Surface de pantalla es nueva
+        self._full_redraw = True
     
     def run(self):
         """Loop principal del visualizador."""
         if not self.image_paths:
             print("No hay imágenes para mostrar")
+            self.running = False
+            self._stop_prefetch()
             return
         
         # Cargar primera página
@@ -354,18 +564,28 @@ class ImageGridViewer:
         
         while self.running:
             # Calcular delta time para animaciones suaves
-            delta_time = self.clock.tick(60) / 1000.0  # Convertir a segundos
+            frame_ms = self.clock.tick(self.target_fps)
+            delta_time = frame_ms / 1000.0  # Convertir a segundos
             
             self._handle_events()
             
+            # Recibir imágenes precargadas en segundo plano
+            self._collect_prefetched()
+            
             # Actualizar animaciones
             self._update_fade(delta_time)
             
-            # Dibujar
-            self.screen.fill(self.BG_COLOR)
-            self._draw_grid()
-            pygame.display.flip()
-        
+            # Dibujar sólo las zonas que cambiaron; con la página quieta no se
+            # dibuja nada
+            draw_start = time.perf_counter()
+            rects = self._draw_grid()
+            if rects:
+                pygame.display.update(rects)
+                self._record_frame(frame_ms, time.perf_counter() - draw_start)
+            self._report_render_stats()
+        
+        self._report_render_stats(force=True)
+        self._stop_prefetch()
         pygame.quit()
 
 